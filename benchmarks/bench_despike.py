@@ -0,0 +1,84 @@
+"""
+Benchmark the vectorized despiking filter against the original voxel-wise loop.
+
+Run as ``python benchmarks/bench_despike.py [--shape X Y Z] [--nthreads N]``.
+
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+
+from sdcflows.interfaces.fmap import _despike
+
+
+def _despike2d_loop(data, thres, neigh=None):
+    """The original (pure Python) implementation of the despiking filter."""
+    if neigh is None:
+        neigh = [-1, 0, 1]
+    nslices = data.shape[-1]
+
+    for k in range(nslices):
+        data2d = data[..., k]
+
+        for i in range(data2d.shape[0]):
+            for j in range(data2d.shape[1]):
+                vals = []
+                thisval = data2d[i, j]
+                for ii in neigh:
+                    for jj in neigh:
+                        try:
+                            vals.append(data2d[i + ii, j + jj])
+                        except IndexError:
+                            pass
+                vals = np.array(vals)
+                patch_range = vals.max() - vals.min()
+                patch_med = np.median(vals)
+
+                if (patch_range > 1e-6 and
+                        (abs(thisval - patch_med) / patch_range) > thres):
+                    data[i, j, k] = patch_med
+    return data
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = perf_counter()
+    retval = func(*args, **kwargs)
+    return perf_counter() - t0, retval
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=(96, 96, 60))
+    parser.add_argument('--nthreads', type=int, default=4)
+    parser.add_argument('--skip-loop', action='store_true',
+                        help='do not time the (slow) original implementation')
+    opts = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    data = rng.normal(scale=50, size=opts.shape).astype(np.float32)
+    data[rng.rand(*data.shape) > 0.99] = 1000.
+
+    print('Field of %s voxels' % 'x'.join('%d' % s for s in opts.shape))
+    elapsed, vectorized = _timeit(_despike, data.copy(), 0.2)
+    if not opts.skip_loop:
+        elapsed_loop, original = _timeit(_despike2d_loop, data.copy(), 0.2)
+        print('  loop (original)      %8.3fs' % elapsed_loop)
+    print('  vectorized 2D        %8.3fs' % elapsed)
+    print('  vectorized 2D, %2d th %8.3fs' % (
+        opts.nthreads, _timeit(_despike, data.copy(), 0.2, num_threads=opts.nthreads)[0]))
+    print('  vectorized 3D, %2d th %8.3fs' % (
+        opts.nthreads, _timeit(_despike, data.copy(), 0.2, ndim=3,
+                               num_threads=opts.nthreads)[0]))
+
+    if not opts.skip_loop:
+        absdiff = np.abs(vectorized - original)
+        print('Deviation of vectorized 2D from the original loop')
+        print('  differing voxels     %8.2f%%' % (100 * np.mean(absdiff > 1e-4)))
+        print('  median / 95th pct.   %8.3f / %.3f' % (
+            np.median(absdiff), np.percentile(absdiff, 95)))
+        print('  maximum              %8.3f' % absdiff.max())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Benchmark the construction of SDC workflows for many runs.
+
+Compares building the workflows probing the versions of external tools for every
+run (as before they were cached) against the process-wide cache of
+:mod:`sdcflows.utils.versions`.
+
+Run as ``python benchmarks/bench_graph.py [--runs N]``.
+
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+from sdcflows.utils import versions
+from sdcflows.workflows.pepolar import init_pepolar_unwarp_wf
+from sdcflows.workflows.syn import init_syn_sdc_wf
+
+
+def _build(nruns, cached):
+    versions._VERSIONS.clear()
+    t0 = perf_counter()
+    for i in range(nruns):
+        if not cached:
+            versions._VERSIONS.clear()
+        init_pepolar_unwarp_wf(name='pepolar_unwarp_%03d_wf' % i)
+        init_syn_sdc_wf(omp_nthreads=1, bold_pe='j', name='syn_sdc_%03d_wf' % i)
+    return perf_counter() - t0
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=50)
+    opts = parser.parse_args()
+
+    print('Building PEPOLAR + SyN workflows for %d runs' % opts.runs)
+    print('  probing versions every run   %8.3fs' % _build(opts.runs, cached=False))
+    print('  cached versions              %8.3fs' % _build(opts.runs, cached=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark the parallel gzip writer of NIfTI images against NiBabel's.
+
+Run as ``python benchmarks/bench_gzip.py [--shape X Y Z T] [--nthreads N] [--levels L ...]``.
+
+"""
+import gzip
+import os
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+import nibabel as nb
+from nibabel.openers import ImageOpener
+
+from sdcflows.utils.nifti import to_filename
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = perf_counter()
+    func(*args, **kwargs)
+    return perf_counter() - t0
+
+
+def _nibabel(img, filename, level):
+    ImageOpener.default_compresslevel, default = level, ImageOpener.default_compresslevel
+    try:
+        img.to_filename(filename)
+    finally:
+        ImageOpener.default_compresslevel = default
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs='+', default=(96, 96, 60, 200))
+    parser.add_argument('--nthreads', type=int, default=4)
+    parser.add_argument('--levels', type=int, nargs='+', default=(1, 6))
+    opts = parser.parse_args()
+
+    # A smooth field with noise, which compresses like real (float) images
+    rng = np.random.RandomState(0)
+    data = np.cumsum(rng.normal(size=opts.shape), axis=0).astype(np.float32)
+    img = nb.Nifti1Image(data, np.eye(4))
+    nbytes = data.nbytes
+
+    print('Image of %s voxels (%.1f MB)' % ('x'.join('%d' % s for s in opts.shape),
+                                            nbytes / 1e6))
+    with TemporaryDirectory() as tmpdir:
+        reference = os.path.join(tmpdir, 'reference.nii.gz')
+        _nibabel(img, reference, 1)
+        with gzip.open(reference) as fobj:
+            expected = fobj.read()
+
+        for level in opts.levels:
+            for name, nthreads in (('nibabel', None), ('parallel', 1),
+                                   ('parallel', opts.nthreads)):
+                out_file = os.path.join(tmpdir, 'level%d_%s%s.nii.gz' % (
+                    level, name, nthreads or ''))
+                if nthreads is None:
+                    elapsed = _timeit(_nibabel, img, out_file, level)
+                    label = '%s' % name
+                else:
+                    elapsed = _timeit(to_filename, img, out_file, num_threads=nthreads,
+                                      level=level)
+                    label = '%s, %2d th' % (name, nthreads)
+
+                with gzip.open(out_file) as fobj:
+                    assert fobj.read() == expected, 'decompressed data differ'
+                print('  level %d, %-16s %8.3fs %8.1f MB/s  ratio %.3f' % (
+                    level, label, elapsed, nbytes / 1e6 / elapsed,
+                    os.path.getsize(out_file) / nbytes))
+
+
+if __name__ == '__main__':
+    main()
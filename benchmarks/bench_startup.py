@@ -0,0 +1,69 @@
+"""
+Benchmark the startup of the ``sdcflows`` command line.
+
+Times fresh interpreters running the entry point up to the parsing of
+arguments (``sdcflows --version``), and checks that parsing arguments does not
+import heavy dependencies (which are only required to plan and build workflows).
+Exits with an error when startup regresses, so that it can run in CI.
+
+Run as ``python benchmarks/bench_startup.py [--repeats N] [--max-seconds S]``.
+
+"""
+import sys
+import subprocess as sp
+from argparse import ArgumentParser
+from statistics import median
+from time import perf_counter
+
+#: Modules that must not be imported before arguments are parsed
+HEAVY_MODULES = ('bids', 'nibabel', 'nipype', 'niworkflows', 'numpy', 'pkg_resources',
+                 'scipy')
+
+_VERSION = """\
+import sys
+from sdcflows.cli.run import main
+sys.argv = ['sdcflows', '--version']
+main()
+"""
+
+_PARSE = """\
+import sys
+from sdcflows.cli.run import get_parser
+get_parser().parse_args(['bids', 'out', 'participant', '--dry-run'])
+print(' '.join(sorted({name.split('.')[0] for name in sys.modules} & set(%r))))
+""" % (HEAVY_MODULES, )
+
+
+def _time(code, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = perf_counter()
+        sp.run([sys.executable, '-c', code], check=True, stdout=sp.DEVNULL)
+        times.append(perf_counter() - t0)
+    return median(times)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--max-seconds', type=float,
+                        help='fail if the median startup time is larger')
+    opts = parser.parse_args()
+
+    elapsed = _time(_VERSION, opts.repeats)
+    print('Interpreter startup            %8.3fs' % _time('pass', opts.repeats))
+    print('sdcflows --version             %8.3fs' % elapsed)
+
+    imported = sp.run([sys.executable, '-c', _PARSE], check=True,
+                      stdout=sp.PIPE, universal_newlines=True).stdout.split()
+    print('Heavy modules after parsing    %s' % (', '.join(imported) or 'none'))
+
+    failed = bool(imported)
+    if opts.max_seconds is not None and elapsed > opts.max_seconds:
+        print('Startup is slower than %.3fs' % opts.max_seconds)
+        failed = True
+    sys.exit(int(failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ def get_parser():
     from argparse import ArgumentParser
     from argparse import RawTextHelpFormatter
     from ..__about__ import __version__ as _vstr
+    from ..utils.hashing import STRATEGIES
 
     parser = ArgumentParser(description='SDC Workflows',
                             formatter_class=RawTextHelpFormatter)
@@ -42,6 +43,9 @@ def get_parser():
                         help='select a specific run identifier to be processed')
     g_bids.add_argument('--suffix', action='store', type=str, nargs='*', default='bold',
                         help='select a specific run identifier to be processed')
+    g_bids.add_argument('--bids-database-dir', action='store', type=Path,
+                        help='path where the indexes of the BIDS dataset are stored and '
+                             'reused (only subjects with changed files are reindexed)')
 
     g_perfm = parser.add_argument_group('Options to handle performance')
     g_perfm.add_argument("-v", "--verbose", dest="verbose_count", action="count", default=0,
@@ -50,10 +54,41 @@ def get_parser():
                          help='maximum number of threads across all processes')
     g_perfm.add_argument('--nthreads', '--omp-nthreads', action='store', type=int,
                          help='maximum number of threads per-process')
+    g_perfm.add_argument('--mem-gb', '--mem_gb', action='store', type=float,
+                         help='upper bound of the memory (in GB) used by all processes')
+    g_perfm.add_argument('--profile', action='store', type=Path,
+                         help='write the runtime, CPU time, peak memory and I/O of every node '
+                              '(and the critical path) to this JSON file (and CSV alongside)')
+    g_perfm.add_argument('--resource-estimates', action='store', type=Path,
+                         help='set the memory and threads of nodes from a previous --profile')
+    g_perfm.add_argument('--uncompressed-intermediates', action='store_true', default=False,
+                         help='write intermediate images as uncompressed NIfTI (.nii), '
+                              'which the next nodes memory-map instead of decompressing')
+    g_perfm.add_argument('--gzip-level', action='store', type=int, choices=range(1, 10),
+                         metavar='{1..9}',
+                         help='compression level of the gzipped images written by nodes '
+                              '(default: 1, the fastest)')
+    g_perfm.add_argument('--fmap-cache', action='store', type=Path,
+                         help='path of a persistent store of estimated fieldmaps, which are '
+                              'reused by later invocations (across working directories)')
+    g_perfm.add_argument('--fmap-cache-size', action='store', type=float,
+                         help='maximum size (in GB) of the store of fieldmaps, where the least '
+                              'recently used fieldmaps are evicted (default: the size last '
+                              'set for the store, or unbounded)')
+    g_perfm.add_argument('--hash-strategy', action='store', choices=STRATEGIES,
+                         help='how nodes hash their input files to decide whether they must '
+                              'run: by contents, by size and modification time, or by '
+                              'contents only for the files of the BIDS dataset (mixed)')
+    g_perfm.add_argument('--collect-workdir', action='store_true', default=False,
+                         help='free the scratch space of intermediate files as soon as the '
+                              'nodes reading them finish (hash files are kept, and the peak '
+                              'scratch usage of each run is reported)')
 
     g_other = parser.add_argument_group('Other options')
     g_other.add_argument('-w', '--work-dir', action='store', type=Path,
                          help='path where intermediate results should be stored')
+    g_other.add_argument('--dry-run', action='store_true', default=False,
+                         help='only list the runs to be processed and their fieldmaps')
 
     return parser
 
@@ -61,21 +96,21 @@ def get_parser():
 def main():
     """Entry point"""
     from os import cpu_count
-    from multiprocessing import set_start_method
-    from bids.layout import BIDSLayout
-    from nipype import logging as nlogging
-    from ..workflows.base import init_sdc_wf
-    set_start_method('forkserver')
 
-    opts = get_parser().parse_args()
+    # Parsing and validating arguments must not import heavy dependencies
+    parser = get_parser()
+    opts = parser.parse_args()
+    if not opts.bids_dir.is_dir():
+        parser.error('BIDS root folder "%s" does not exist.' % opts.bids_dir)
+    if opts.resource_estimates is not None and not opts.resource_estimates.is_file():
+        parser.error('Profile "%s" does not exist.' % opts.resource_estimates)
+    if opts.fmap_cache_size is not None and opts.fmap_cache is None:
+        parser.error('--fmap-cache-size requires --fmap-cache.')
 
     # Retrieve logging level
     log_level = int(max(25 - 5 * opts.verbose_count, logging.DEBUG))
     # Set logging
     logger.setLevel(log_level)
-    nlogging.getLogger('nipype.workflow').setLevel(log_level)
-    nlogging.getLogger('nipype.interface').setLevel(log_level)
-    nlogging.getLogger('nipype.utils').setLevel(log_level)
 
     # Resource management options
     plugin_settings = {
@@ -90,17 +125,20 @@ def main():
     # Permit overriding plugin config with specific CLI options
     if not opts.ncpus or opts.ncpus < 1:
         plugin_settings['plugin_args']['n_procs'] = cpu_count()
+    # Nodes are only submitted while their estimated memory fits within this bound
+    if opts.mem_gb:
+        plugin_settings['plugin_args']['memory_gb'] = opts.mem_gb
 
     nthreads = opts.nthreads
     if not nthreads or nthreads < 1:
         nthreads = cpu_count()
+    nthreads = min(nthreads, plugin_settings['plugin_args']['n_procs'])
 
     output_dir = opts.output_dir.resolve()
     bids_dir = opts.bids_dir or output_dir.parent
 
     # Get absolute path to BIDS directory
     bids_dir = opts.bids_dir.resolve()
-    layout = BIDSLayout(str(bids_dir), validate=False, derivatives=str(output_dir))
     query = {'suffix': opts.suffix, 'extension': ['.nii', '.nii.gz']}
 
     for entity in ('subject', 'task', 'dir', 'acquisition', 'run'):
@@ -108,6 +146,122 @@ def main():
         if arg is not None:
             query[entity] = arg
 
+    # Planning only requires pyBIDS
+    from ..utils.bids import get_layouts, collect_runs
+
+    layout_kwargs = {'validate': False}
+    if opts.bids_database_dir is None:
+        # Persisted indexes are partitioned by subject and do not include derivatives
+        layout_kwargs['derivatives'] = str(output_dir)
+    layouts = get_layouts(bids_dir, opts.bids_database_dir, opts.subject, **layout_kwargs)
+    runs = [run for layout in layouts for run in collect_runs(layout, **query)]
+    if opts.dry_run:
+        for boldref, fmaps in runs:
+            print(boldref.path)
+            for fmap in sorted(f.path for values in fmaps.values() for f in values):
+                print('    %s' % fmap)
+        return
+
+    if 'participant' not in opts.analysis_level:
+        return
+    if not runs:
+        logger.warning('No runs matched the query %s.', query)
+        return
+
+    # Nipype and the workflows are only imported when workflows are built
+    from multiprocessing import set_start_method
+    from nipype import logging as nlogging
+    from ..workflows.base import init_sdc_participant_wf
+    set_start_method('forkserver')
+
+    if opts.uncompressed_intermediates:
+        # Kept in the environment, which the processes running nodes inherit
+        from ..utils.nifti import set_compress_intermediates
+        set_compress_intermediates(False)
+    if opts.gzip_level is not None:
+        from ..utils.nifti import set_gzip_level
+        set_gzip_level(opts.gzip_level)
+
+    nlogging.getLogger('nipype.workflow').setLevel(log_level)
+    nlogging.getLogger('nipype.interface').setLevel(log_level)
+    nlogging.getLogger('nipype.utils').setLevel(log_level)
+
+    fmap_cache = None
+    if opts.fmap_cache is not None:
+        from ..utils.cache import FieldmapCache
+        # The size bound is saved in the store, where the nodes storing fieldmaps read it
+        # back; entries looked up (during the last day) are kept for running workflows
+        fmap_cache = str(FieldmapCache(
+            opts.fmap_cache.resolve(), keep_recent=24 * 3600,
+            max_size=None if opts.fmap_cache_size is None
+            else int(opts.fmap_cache_size * 1024 ** 3)).root)
+
+    # A single graph of all participants, so that one scheduler shares the resources
+    # among subjects and each shared fieldmap is estimated only once
+    sdcflows_wf = init_sdc_participant_wf(
+        [boldref for boldref, _ in runs], output_dir, omp_nthreads=nthreads,
+        fmap_cache=fmap_cache, layouts=layouts)
+    sdcflows_wf.base_dir = str((opts.work_dir or Path('work')).resolve())
+
+    if opts.hash_strategy is not None:
+        from ..utils.hashing import set_hash_strategy
+        hashed = set_hash_strategy(sdcflows_wf, opts.hash_strategy,
+                                   raw_dirs=[opts.bids_dir.resolve()])
+        logger.info('Hashing the contents of the inputs of %d nodes.', len(hashed))
+
+    if opts.resource_estimates is not None:
+        from ..utils.profiling import apply_profile
+        nupdated = apply_profile(sdcflows_wf, opts.resource_estimates, max_threads=nthreads)
+        logger.log(25, 'Resource estimates of %d nodes set from <%s>.',
+                   nupdated, opts.resource_estimates)
+
+    callbacks = []
+    if opts.profile is not None:
+        from nipype import config as ncfg
+        from ..utils.profiling import NodeProfiler, dependencies, write_profile
+        ncfg.enable_resource_monitor()
+        profiler = NodeProfiler()
+        callbacks.append(profiler)
+
+    if opts.collect_workdir:
+        from ..utils.workdir import WorkdirCollector, workflow_dependencies
+        # Groups of depth 3 are the runs (sdcflows_wf.sdc_sub_<label>_wf.<run workflow>)
+        collector = WorkdirCollector(workflow_dependencies(sdcflows_wf), group_depth=3)
+        callbacks.append(collector)
+
+    if callbacks:
+        plugin_settings['plugin_args']['status_callback'] = _chain_callbacks(callbacks)
+
+    if opts.hash_strategy in ('content', 'mixed'):
+        from ..utils.hashing import memoize_content_hashes
+        with memoize_content_hashes():
+            graph = sdcflows_wf.run(**plugin_settings)
+    else:
+        graph = sdcflows_wf.run(**plugin_settings)
+
+    if opts.profile is not None:
+        profile = write_profile(profiler.records, opts.profile.resolve(),
+                                dependencies(graph))
+        critical = profile['critical_path']
+        logger.log(25, 'Critical path (%.1fs): %s', critical['duration'],
+                   ' -> '.join(critical['nodes']))
+
+    if opts.collect_workdir:
+        scratch = collector.summary()
+        logger.log(25, 'Peak scratch usage: %.1f MB (%.1f MB freed from %d nodes).',
+                   scratch['peak_bytes'] / 1e6, scratch['collected_bytes'] / 1e6,
+                   scratch['collected_nodes'])
+        for group, peak in scratch['groups'].items():
+            logger.log(25, '  %s: peak scratch usage %.1f MB.', group, peak / 1e6)
+
+
+def _chain_callbacks(callbacks):
+    """Call several status callbacks of nipype plugins, in order."""
+    def _callback(node, status):
+        for callback in callbacks:
+            callback(node, status)
+    return _callback
+
 
 if __name__ == '__main__':
     raise RuntimeError("sdcflows/cli/run.py should not be run directly;\n"
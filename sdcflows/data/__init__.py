@@ -0,0 +1,24 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Data files packaged with *sdcflows*.
+
+Paths are resolved relative to this module, which (unlike
+``pkg_resources.resource_filename``) does not require scanning the installed
+distributions at import time.
+
+"""
+from pathlib import Path
+
+DATA_DIR = Path(__file__).parent
+
+
+def data_path(fname):
+    """
+    Return the absolute path of a packaged data file.
+
+    >>> Path(data_path('affine.json')).exists()
+    True
+
+    """
+    return str(DATA_DIR / fname)
@@ -0,0 +1,75 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Interfaces to the persistent store of estimated fieldmaps.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+
+"""
+from nipype.interfaces.base import (
+    BaseInterfaceInputSpec, TraitedSpec, File, isdefined, traits,
+    SimpleInterface, InputMultiObject)
+
+from ..utils.cache import FieldmapCache, fieldmap_key
+
+STORED_FIELDS = ('fmap', 'fmap_ref', 'fmap_mask', 'out_warp')
+
+
+class StoreFieldmapInputSpec(BaseInterfaceInputSpec):
+    cache = traits.Either(traits.Instance(FieldmapCache), traits.Str, mandatory=True,
+                          nohash=True, desc='the store (or its path)')
+    in_files = InputMultiObject(File(exists=True), mandatory=True,
+                                desc='input images of the estimation')
+    metadata = traits.Either(traits.Dict, traits.List(traits.Dict),
+                             desc='metadata of the inputs')
+    estimator = traits.Str(mandatory=True, desc='name of the estimation strategy')
+    params = traits.Dict(usedefault=True, desc='parameters of the estimator')
+    fmap = File(exists=True, desc='the estimated fieldmap')
+    fmap_ref = File(exists=True, desc='the reference image of the fieldmap')
+    fmap_mask = File(exists=True, desc='a brain mask of the fieldmap')
+    out_warp = File(exists=True, desc='the estimated displacements field')
+
+
+class StoreFieldmapOutputSpec(TraitedSpec):
+    key = traits.Str(desc='the key of the stored estimation')
+    fmap = File(desc='the stored fieldmap')
+    fmap_ref = File(desc='the stored reference image')
+    fmap_mask = File(desc='the stored brain mask')
+    out_warp = File(desc='the stored displacements field')
+
+
+class StoreFieldmap(SimpleInterface):
+    """
+    Store the results of a fieldmap estimation, for later invocations to reuse them.
+
+    >>> from pathlib import Path
+    >>> from sdcflows.utils.cache import lookup_fieldmap
+    >>> Path('phasediff.nii.gz').write_bytes(b'phasediff') and None
+    >>> Path('fmap.nii.gz').write_bytes(b'fmap') and None
+    >>> store = StoreFieldmap(cache='cache', in_files=['phasediff.nii.gz'],
+    ...                       estimator='phdiff', fmap='fmap.nii.gz').run()
+    >>> lookup_fieldmap('cache', ['phasediff.nii.gz'], estimator='phdiff')['fmap'] \\
+    ...     == store.outputs.fmap
+    True
+
+    """
+    input_spec = StoreFieldmapInputSpec
+    output_spec = StoreFieldmapOutputSpec
+
+    def _run_interface(self, runtime):
+        cache = self.inputs.cache
+        if not isinstance(cache, FieldmapCache):
+            cache = FieldmapCache(cache)
+
+        self._results['key'] = fieldmap_key(
+            self.inputs.in_files,
+            self.inputs.metadata if isdefined(self.inputs.metadata) else None,
+            self.inputs.estimator, self.inputs.params)
+
+        files = {name: getattr(self.inputs, name) for name in STORED_FIELDS
+                 if isdefined(getattr(self.inputs, name))}
+        self._results.update(cache.put(self._results['key'], files) or {})
+        return runtime
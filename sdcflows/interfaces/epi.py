@@ -0,0 +1,169 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Interfaces to process EPI images.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+
+"""
+import numpy as np
+import nibabel as nb
+from nipype.interfaces.base import (
+    BaseInterfaceInputSpec, TraitedSpec, File, isdefined, traits,
+    SimpleInterface, InputMultiObject)
+
+from ..utils.nifti import intermediate_fname, to_filename
+from ..utils.pepolar import DEFAULT_LEVELS, estimate_pe_shift
+from ..utils.template import robust_template
+
+
+class RobustTemplateInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiObject(File(exists=True), mandatory=True,
+                                desc='3D or 4D EPI images on the same grid')
+    max_volumes = traits.Int(20, usedefault=True,
+                             desc='maximum number of (evenly spaced) volumes used')
+    max_iter = traits.Int(5, usedefault=True,
+                          desc='maximum number of template updates')
+    tol = traits.Float(1e-3, usedefault=True,
+                       desc='stop when the template changes less than this')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of volumes aligned in parallel')
+
+
+class RobustTemplateOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='the robust template')
+
+
+class RobustTemplate(SimpleInterface):
+    """
+    Build a robust (median) template of rigidly aligned, intensity-scaled EPI volumes.
+
+    A native replacement of FreeSurfer's ``mri_robust_template`` for EPI series
+    (see :func:`~sdcflows.utils.template.robust_template`).
+
+    >>> data = np.zeros((20, 20, 20, 3), dtype='float32')
+    >>> data[5:15, 6:14, 4:12] = 100.0
+    >>> nb.Nifti1Image(data, np.eye(4)).to_filename('epi.nii.gz')
+    >>> result = RobustTemplate(in_files=['epi.nii.gz']).run()
+    >>> nb.load(result.outputs.out_file).shape
+    (20, 20, 20)
+
+    """
+    input_spec = RobustTemplateInputSpec
+    output_spec = RobustTemplateOutputSpec
+
+    def _run_interface(self, runtime):
+        imgs = [nb.load(f) for f in self.inputs.in_files]
+        if any(img.shape[:3] != imgs[0].shape[:3] for img in imgs):
+            raise ValueError('Input images must be defined on the same grid.')
+
+        data = np.concatenate([
+            np.asanyarray(img.dataobj, dtype='float32').reshape(img.shape[:3] + (-1,))
+            for img in imgs], axis=-1)
+
+        template, _, _ = robust_template(
+            data, zooms=imgs[0].header.get_zooms()[:3],
+            max_volumes=self.inputs.max_volumes, max_iter=self.inputs.max_iter,
+            tol=self.inputs.tol, num_threads=self.inputs.num_threads)
+
+        hdr = imgs[0].header.copy()
+        hdr.set_data_dtype('<f4')
+        hdr.set_data_shape(template.shape)
+        hdr.set_xyzt_units('mm')
+        self._results['out_file'] = intermediate_fname(
+            self.inputs.in_files[0], suffix='_template', newpath=runtime.cwd)
+        to_filename(nb.Nifti1Image(template, imgs[0].affine, hdr),
+                    self._results['out_file'], num_threads=self.inputs.num_threads)
+        return runtime
+
+
+class PEPolarWarpInputSpec(BaseInterfaceInputSpec):
+    in_matched = File(exists=True, mandatory=True,
+                      desc='EPI image acquired with pe_dir (defines the output space)')
+    in_opposed = File(exists=True, mandatory=True,
+                      desc='EPI image acquired with the opposed PE blip, same grid')
+    pe_dir = traits.Enum('i', 'i-', 'j', 'j-', 'k', 'k-', mandatory=True,
+                         desc='the phase-encoding direction of in_matched')
+    in_mask = File(exists=True, desc='restrict the comparison of images to this mask')
+    levels = traits.List(traits.Tuple(traits.Float, traits.Float),
+                         value=list(DEFAULT_LEVELS), usedefault=True,
+                         desc='distance between control points and blurring FWHM '
+                              '(in mm) of each level of the pyramid')
+    regularization = traits.Float(0.05, usedefault=True,
+                                  desc='weight of the smoothness penalty')
+    jacobian = traits.Bool(False, usedefault=True,
+                           desc='model the intensity modulation of distortions')
+    max_iter = traits.Int(100, usedefault=True,
+                          desc='maximum number of iterations per level')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of slabs evaluated in parallel')
+
+
+class PEPolarWarpOutputSpec(TraitedSpec):
+    out_warp = File(exists=True, desc='ANTs-compatible displacements field that '
+                                      'unwarps in_matched')
+
+
+class PEPolarWarp(SimpleInterface):
+    """
+    Estimate the displacements field from two EPI images with opposed PE blips.
+
+    A native replacement of AFNI's ``3dQwarp -plusminus`` with displacements
+    restricted to the PE axis (see :func:`~sdcflows.utils.pepolar.estimate_pe_shift`).
+    The output displacements field (in mm, ITK conventions) unwarps ``in_matched``.
+
+    >>> from sdcflows.utils.pepolar import distort_pe
+    >>> template = np.fromfunction(
+    ...     lambda i, j, k: np.exp(-((i - 12) ** 2 + (j - 16) ** 2) / 40.), (24, 32, 4))
+    >>> matched, opposed = distort_pe(template, np.full(template.shape, 1.5), 1)
+    >>> nb.Nifti1Image(matched, np.diag([2., 2., 2., 1.])).to_filename('matched.nii.gz')
+    >>> nb.Nifti1Image(opposed, np.diag([2., 2., 2., 1.])).to_filename('opposed.nii.gz')
+    >>> result = PEPolarWarp(in_matched='matched.nii.gz', in_opposed='opposed.nii.gz',
+    ...                      pe_dir='j', levels=[(16., 4.), (8., 0.)]).run()
+    >>> warp = nb.load(result.outputs.out_warp).get_fdata()
+    >>> warp.shape
+    (24, 32, 4, 1, 3)
+    >>> round(float(np.median(warp[6:18, 8:24, :, 0, 1])), 1)  # -1.5 voxels of 2 mm
+    -3.0
+
+    """
+    input_spec = PEPolarWarpInputSpec
+    output_spec = PEPolarWarpOutputSpec
+
+    def _run_interface(self, runtime):
+        from .unwarp import _pe_shift_voxels
+
+        matched = nb.load(self.inputs.in_matched)
+        opposed = nb.load(self.inputs.in_opposed)
+        if matched.shape[:3] != opposed.shape[:3]:
+            raise ValueError('Input images must be defined on the same grid.')
+
+        mask = None
+        if isdefined(self.inputs.in_mask):
+            mask = np.asanyarray(nb.load(self.inputs.in_mask).dataobj)
+
+        axis = 'ijk'.index(self.inputs.pe_dir[0])
+        shift = estimate_pe_shift(
+            np.squeeze(np.asanyarray(matched.dataobj, dtype='float32')),
+            np.squeeze(np.asanyarray(opposed.dataobj, dtype='float32')),
+            axis, zooms=matched.header.get_zooms()[:3], mask=mask,
+            levels=self.inputs.levels, regularization=self.inputs.regularization,
+            jacobian=self.inputs.jacobian, max_iter=self.inputs.max_iter,
+            num_threads=self.inputs.num_threads)
+
+        # Voxel shifts to displacements in mm (LPS), as written by 3dQwarp + _fix_hdr
+        field = np.zeros(shift.shape + (1, 3), dtype='<f4')
+        field[..., 0, axis] = shift / _pe_shift_voxels(1.0, axis, matched.affine)
+
+        hdr = matched.header.copy()
+        hdr.set_data_dtype('<f4')
+        hdr.set_data_shape(field.shape)
+        hdr.set_intent('vector', (), '')
+        self._results['out_warp'] = intermediate_fname(
+            self.inputs.in_matched, suffix='_warpfield', newpath=runtime.cwd)
+        to_filename(nb.Nifti1Image(field, matched.affine, hdr), self._results['out_warp'],
+                    num_threads=self.inputs.num_threads)
+        return runtime
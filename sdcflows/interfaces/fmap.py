@@ -16,11 +16,12 @@ Interfaces to deal with the various types of fieldmap sources.
 import numpy as np
 import nibabel as nb
 from nipype import logging
-from nipype.utils.filemanip import fname_presuffix
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec, TraitedSpec, File, isdefined, traits,
     SimpleInterface)
 
+from ..utils.nifti import intermediate_fname, to_filename
+
 LOGGER = logging.getLogger('nipype.interface')
 
 
@@ -29,10 +30,14 @@ class FieldEnhanceInputSpec(BaseInterfaceInputSpec):
     in_mask = File(exists=True, desc='brain mask')
     in_magnitude = File(exists=True, desc='input magnitude')
     unwrap = traits.Bool(False, usedefault=True, desc='run phase unwrap')
+    unwrap_method = traits.Enum('prelude', 'laplacian', usedefault=True,
+                                desc='phase unwrapping engine')
     despike = traits.Bool(True, usedefault=True, desc='run despike filter')
     bspline_smooth = traits.Bool(True, usedefault=True, desc='run 3D bspline smoother')
     mask_erode = traits.Int(1, usedefault=True, desc='mask erosion iterations')
     despike_threshold = traits.Float(0.2, usedefault=True, desc='mask erosion iterations')
+    despike_3d = traits.Bool(False, usedefault=True,
+                             desc='despike within a 3D neighborhood (instead of in-plane)')
     num_threads = traits.Int(1, usedefault=True, nohash=True, desc='number of jobs')
 
 
@@ -57,7 +62,9 @@ class FieldEnhance(SimpleInterface):
 
         # Despike / denoise (no-mask)
         if self.inputs.despike:
-            data = _despike2d(data, self.inputs.despike_threshold)
+            data = _despike(data, self.inputs.despike_threshold,
+                            ndim=3 if self.inputs.despike_3d else 2,
+                            num_threads=self.inputs.num_threads)
 
         mask = None
         if isdefined(self.inputs.in_mask):
@@ -72,19 +79,22 @@ class FieldEnhance(SimpleInterface):
                     iterations=self.inputs.mask_erode
                 ).astype(np.uint8)  # pylint: disable=no-member
 
-        self._results['out_file'] = fname_presuffix(
+        self._results['out_file'] = intermediate_fname(
             self.inputs.in_file, suffix='_enh', newpath=runtime.cwd)
         datanii = nb.Nifti1Image(data, fmap_nii.affine, fmap_nii.header)
 
         if self.inputs.unwrap:
-            data = _unwrap(data, self.inputs.in_magnitude, mask)
-            self._results['out_unwrapped'] = fname_presuffix(
+            data = _unwrap(data, self.inputs.in_magnitude, mask,
+                           method=self.inputs.unwrap_method,
+                           num_threads=self.inputs.num_threads)
+            self._results['out_unwrapped'] = intermediate_fname(
                 self.inputs.in_file, suffix='_unwrap', newpath=runtime.cwd)
-            nb.Nifti1Image(data, fmap_nii.affine, fmap_nii.header).to_filename(
-                self._results['out_unwrapped'])
+            to_filename(nb.Nifti1Image(data, fmap_nii.affine, fmap_nii.header),
+                        self._results['out_unwrapped'], num_threads=self.inputs.num_threads)
 
         if not self.inputs.bspline_smooth:
-            datanii.to_filename(self._results['out_file'])
+            to_filename(datanii, self._results['out_file'],
+                        num_threads=self.inputs.num_threads)
             return runtime
         else:
             from ..utils import bspline as fbsp
@@ -127,8 +137,8 @@ class FieldEnhance(SimpleInterface):
             else:
                 final = smoothed1.get_data()
 
-            nb.Nifti1Image(final, datanii.affine, datanii.header).to_filename(
-                self._results['out_file'])
+            to_filename(nb.Nifti1Image(final, datanii.affine, datanii.header),
+                        self._results['out_file'], num_threads=self.inputs.num_threads)
 
         return runtime
 
@@ -181,6 +191,122 @@ class FieldToHz(SimpleInterface):
         return runtime
 
 
+class PhaseUnwrapInputSpec(BaseInterfaceInputSpec):
+    phase_file = File(exists=True, mandatory=True, desc='wrapped phase map (in rad)')
+    mask_file = File(exists=True, desc='brain mask')
+    num_threads = traits.Int(1, usedefault=True, nohash=True, desc='number of threads')
+
+
+class PhaseUnwrapOutputSpec(TraitedSpec):
+    unwrapped_phase_file = File(desc='the unwrapped phase map (in rad)')
+
+
+class PhaseUnwrap(SimpleInterface):
+    """
+    Unwrap a phase map in-process with the Laplacian method
+    (an alternative to FSL PRELUDE).
+    """
+    input_spec = PhaseUnwrapInputSpec
+    output_spec = PhaseUnwrapOutputSpec
+
+    def _run_interface(self, runtime):
+        from ..utils.phasemanip import unwrap_laplacian
+
+        phasenii = nb.load(self.inputs.phase_file)
+        mask = None
+        if isdefined(self.inputs.mask_file):
+            mask = np.asanyarray(nb.load(self.inputs.mask_file).dataobj) > 0
+
+        unwrapped = unwrap_laplacian(np.asanyarray(phasenii.dataobj), mask,
+                                     num_threads=self.inputs.num_threads)
+
+        self._results['unwrapped_phase_file'] = intermediate_fname(
+            self.inputs.phase_file, suffix='_unwrapped', newpath=runtime.cwd)
+        out_img = nb.Nifti1Image(unwrapped, phasenii.affine, phasenii.header)
+        out_img.set_data_dtype('float32')
+        to_filename(out_img, self._results['unwrapped_phase_file'],
+                    num_threads=self.inputs.num_threads)
+        return runtime
+
+
+class FieldToWarpInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='input fieldmap (in Hz), sampled on the grid of the EPI')
+    in_mask = File(exists=True, desc='brain mask, where the median shift is calculated')
+    metadata = traits.Dict(mandatory=True, desc='BIDS metadata dictionary of the EPI')
+    pe_dir = traits.Enum('i', 'i-', 'j', 'j-', 'k', 'k-',
+                         desc='phase-encoding direction (overrides the metadata)')
+    demean = traits.Bool(True, usedefault=True, desc='demean the voxel-shift map')
+    jacobian = traits.Bool(False, usedefault=True,
+                           desc='calculate the Jacobian determinant of the warp')
+
+
+class FieldToWarpOutputSpec(TraitedSpec):
+    out_vsm = File(desc='the voxel-shift map (VSM)')
+    out_warp = File(desc='the displacements field (DFM), compatible with ANTs')
+    out_jacobian = File(desc='the Jacobian determinant of the displacements field')
+
+
+class FieldToWarp(SimpleInterface):
+    """
+    Convert a fieldmap in Hz into a voxel-shift map and an ANTs-compatible
+    displacements field, in one pass.
+
+    Replaces the chain of :class:`FieldToRadS`, FSL FUGUE (``--saveshift``),
+    :class:`~niworkflows.interfaces.images.DemeanImage` and
+    :class:`~niworkflows.interfaces.itk.FUGUEvsm2ANTSwarp`.
+    """
+    input_spec = FieldToWarpInputSpec
+    output_spec = FieldToWarpOutputSpec
+
+    def _run_interface(self, runtime):
+        metadata = self.inputs.metadata.copy()
+        if isdefined(self.inputs.pe_dir):
+            metadata['PhaseEncodingDirection'] = self.inputs.pe_dir
+
+        (self._results['out_vsm'], self._results['out_warp'],
+         jac_file) = _fmap2warp(
+            self.inputs.in_file, metadata,
+            in_mask=self.inputs.in_mask if isdefined(self.inputs.in_mask) else None,
+            demean=self.inputs.demean, jacobian=self.inputs.jacobian,
+            newpath=runtime.cwd)
+        if jac_file is not None:
+            self._results['out_jacobian'] = jac_file
+        return runtime
+
+
+class WarpToFieldInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='displacements field (ANTs or compact format) along the PE axis')
+    metadata = traits.Dict(mandatory=True,
+                           desc='BIDS metadata dictionary of the EPI the field unwarps')
+    pe_dir = traits.Enum('i', 'i-', 'j', 'j-', 'k', 'k-',
+                         desc='phase-encoding direction (overrides the metadata)')
+
+
+class WarpToFieldOutputSpec(TraitedSpec):
+    out_file = File(desc='the fieldmap (in Hz)')
+
+
+class WarpToField(SimpleInterface):
+    """
+    Convert a displacements field back into a fieldmap in Hz (the inverse of
+    :class:`FieldToWarp`), so that the field can be mapped onto EPI runs with
+    different readout parameters.
+    """
+    input_spec = WarpToFieldInputSpec
+    output_spec = WarpToFieldOutputSpec
+
+    def _run_interface(self, runtime):
+        metadata = self.inputs.metadata.copy()
+        if isdefined(self.inputs.pe_dir):
+            metadata['PhaseEncodingDirection'] = self.inputs.pe_dir
+
+        self._results['out_file'] = _warp2fmap(self.inputs.in_file, metadata,
+                                               newpath=runtime.cwd)
+        return runtime
+
+
 class Phasediff2FieldmapInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc='input fieldmap')
     metadata = traits.Dict(mandatory=True, desc='BIDS metadata dictionary')
@@ -205,42 +331,215 @@ class Phasediff2Fieldmap(SimpleInterface):
         return runtime
 
 
-def _despike2d(data, thres, neigh=None):
+class ProcessPhasediffInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='input phase-difference map')
+    in_mask = File(exists=True, mandatory=True, desc='brain mask')
+    metadata = traits.Dict(mandatory=True, desc='BIDS metadata dictionary')
+    median_radius = traits.Float(3.0, usedefault=True,
+                                 desc='radius (in mm) of the spherical median filter')
+    despike_threshold = traits.Float(2.1, usedefault=True,
+                                     desc='threshold of the edge despiking filter')
+    num_threads = traits.Int(1, usedefault=True, nohash=True, desc='number of threads')
+
+
+class ProcessPhasediffOutputSpec(TraitedSpec):
+    out_file = File(desc='the output fieldmap (in Hz)')
+
+
+class ProcessPhasediff(SimpleInterface):
+    """
+    Convert a phase difference map into a fieldmap in Hz within one process.
+
+    This interface fuses the chain of nodes of :func:`~sdcflows.workflows.phdiff.init_phdiff_wf`
+    (``siemens2rads``, phase unwrapping, median filtering, demeaning, edge cleanup and
+    :class:`Phasediff2Fieldmap`), operating on one in-memory float32 array and writing
+    only the final fieldmap.
+    """
+    input_spec = ProcessPhasediffInputSpec
+    output_spec = ProcessPhasediffOutputSpec
+
+    def _run_interface(self, runtime):
+        phdiffnii = nb.load(self.inputs.in_file)
+        mask = np.squeeze(np.asanyarray(nb.load(self.inputs.in_mask).dataobj)) > 0
+
+        data = _process_phdiff(
+            np.asanyarray(phdiffnii.dataobj).astype(np.float32),
+            mask,
+            _delta_te(self.inputs.metadata),
+            phdiffnii.header.get_zooms()[:3],
+            median_radius=self.inputs.median_radius,
+            despike_threshold=self.inputs.despike_threshold,
+            num_threads=self.inputs.num_threads,
+        )
+
+        self._results['out_file'] = intermediate_fname(
+            self.inputs.in_file, suffix='_fmap', newpath=runtime.cwd)
+        hdr = phdiffnii.header.copy()
+        hdr.set_data_shape(data.shape)
+        hdr.set_data_dtype(np.float32)
+        to_filename(nb.Nifti1Image(data, phdiffnii.affine, hdr), self._results['out_file'],
+                    num_threads=self.inputs.num_threads)
+        return runtime
+
+
+def _process_phdiff(data, mask, delta_te, zooms, median_radius=3.0,
+                    despike_threshold=2.1, num_threads=1):
+    """
+    Run the phase-difference to fieldmap (Hz) conversion on an array.
+
+    >>> phase = np.fromfunction(lambda i, j, k: 0.25 * j, (20, 20, 6)) % (2 * np.pi)
+    >>> mask = np.zeros(phase.shape, dtype=bool)
+    >>> mask[2:-2, 2:-2, :] = True
+    >>> fmap = _process_phdiff(phase.astype('float32'), mask, 0.00246, (2., 2., 2.))
+    >>> fmap.dtype, fmap.shape
+    (dtype('float32'), (20, 20, 6))
+    >>> bool(np.all(fmap[~mask] == 0))
+    True
+
+    """
+    from math import pi
+    from scipy import ndimage as sim
+    from ..utils.phasemanip import unwrap_laplacian
+
+    # Phase difference to radians (as siemens2rads)
+    if data.ndim == 4 and data.shape[-1] == 2:
+        data = data[..., 1] - data[..., 0]
+    data = np.squeeze(data)
+    imin, imax = data.min(), data.max()
+    data = (2.0 * pi * (data - imin) / (imax - imin)) - pi
+
+    # Phase unwrapping
+    data = unwrap_laplacian(data, mask, num_threads=num_threads)
+
+    # Spherical median filter (as fslmaths -kernel sphere <radius> -fmedian)
+    zooms = np.array(zooms, dtype=float)
+    grid = np.ogrid[tuple(slice(-h, h + 1)
+                          for h in np.floor(median_radius / zooms).astype(int))]
+    footprint = sum((g * z) ** 2 for g, z in zip(grid, zooms)) <= median_radius ** 2
+    data = sim.median_filter(data, footprint=footprint, mode='nearest')
+
+    # Demean (as demean_image, without mask)
+    data -= np.median(data)
+
+    # Despike the edge of the mask (as cleanup_edge_pipeline)
+    eroded = sim.binary_erosion(mask, structure=np.ones((3, 3, 1), dtype=bool),
+                                border_value=1)
+    edge = mask & ~eroded
+    despiked = _despike(data.copy(), despike_threshold, ndim=2, mask=mask,
+                        num_threads=num_threads)
+    data = np.where(eroded, data, 0) + np.where(edge, despiked, 0)
+
+    # Radians to Hz (as phdiff2fmap)
+    return (data / (2. * pi * delta_te)).astype(np.float32)
+
+
+def _despike2d(data, thres, neigh=None, num_threads=1):
     """
     despiking as done in FSL fugue
+
+    >>> data = np.zeros((5, 5, 2), dtype=np.float32)
+    >>> data[..., 1] = np.arange(25).reshape(5, 5)
+    >>> data[2, 2, 1] = 100.
+    >>> float(_despike2d(data, 0.2)[2, 2, 1])
+    13.0
+
+    """
+    return _despike(data, thres, neigh=neigh, ndim=2, num_threads=num_threads)
+
+
+def _despike(data, thres, neigh=None, ndim=2, mask=None, num_threads=1, slab_size=8):
+    """
+    Replace spikes by the median of their neighborhood (FSL fugue rule).
+
+    A voxel is considered a spike when its absolute difference to the median
+    of its neighborhood, normalized by the range of the neighborhood, is above
+    ``thres``.
+    The neighborhood is the in-plane window (``ndim=2``) or the full 3D
+    window (``ndim=3``) spanned by the offsets in ``neigh``, truncated at
+    the borders of the field of view.
+    When a ``mask`` is given, only voxels within the mask are considered, both
+    as candidate spikes and as neighbors.
+    All windows are evaluated on the input values at once, slab-wise along
+    the last axis, and slabs are distributed across ``num_threads``.
+    Therefore, results differ from the original voxel-wise loop (which read
+    already despiked neighbors and wrapped around the lower borders) at the
+    noise level; this deviation is bounded in ``test_despike_baseline``.
+
+    >>> data = np.zeros((5, 5, 5), dtype=np.float32)
+    >>> data[2, 2, 2] = 100.
+    >>> float(_despike(data, 0.2, ndim=3)[2, 2, 2])
+    0.0
+
     """
+    from concurrent.futures import ThreadPoolExecutor
+    from itertools import product
+
+    if ndim not in (2, 3):
+        raise ValueError('Despiking is only possible in 2D or 3D neighborhoods.')
 
     if neigh is None:
         neigh = [-1, 0, 1]
-    nslices = data.shape[-1]
+    neigh = [int(n) for n in neigh]
+    pad = max(abs(n) for n in neigh)
+    offsets = list(product(neigh, repeat=ndim))
+
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float32
+    values = data.astype(dtype)
+    if mask is not None:
+        values[np.asanyarray(mask) == 0] = np.nan
+    padded = np.pad(
+        values,
+        [(pad, pad)] * ndim + [(0, 0)] * (data.ndim - ndim),
+        mode='constant', constant_values=np.nan)
 
-    for k in range(nslices):
-        data2d = data[..., k]
-
-        for i in range(data2d.shape[0]):
-            for j in range(data2d.shape[1]):
-                vals = []
-                thisval = data2d[i, j]
-                for ii in neigh:
-                    for jj in neigh:
-                        try:
-                            vals.append(data2d[i + ii, j + jj])
-                        except IndexError:
-                            pass
-                vals = np.array(vals)
-                patch_range = vals.max() - vals.min()
-                patch_med = np.median(vals)
-
-                if (patch_range > 1e-6 and
-                        (abs(thisval - patch_med) / patch_range) > thres):
-                    data[i, j, k] = patch_med
+    nslices = data.shape[-1]
+    slab_size = max(1, min(int(slab_size), -(-nslices // max(1, num_threads))))
+    halo = pad if ndim == 3 else 0
+
+    def _run_slab(start):
+        stop = min(start + slab_size, nslices)
+        shape = data.shape[:-1] + (stop - start, )
+        slab = padded[..., start:stop + 2 * halo]
+        spikes, patch_med = _despike_slab(slab, thres, offsets, shape, pad)
+        data[..., start:stop][spikes] = patch_med[spikes]
+
+    starts = range(0, nslices, slab_size)
+    if num_threads > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(_run_slab, starts))
+    else:
+        for start in starts:
+            _run_slab(start)
     return data
 
 
-def _unwrap(fmap_data, mag_file, mask=None):
+def _despike_slab(padded, thres, offsets, shape, pad):
+    """Apply the despiking rule to a padded slab, returning spikes and local medians."""
+    def _window(offset):
+        return padded[tuple(slice(pad + o, pad + o + s)
+                            for o, s in zip(offset, shape))]
+
+    center = _window((0, ) * len(offsets[0]))
+    # Out-of-FoV neighbors are NaNs, which are sorted to the end
+    stack = np.stack([_window(offset) for offset in offsets], axis=-1)
+    stack.sort(axis=-1)
+    nvalid = np.count_nonzero(~np.isnan(stack), axis=-1)[..., np.newaxis]
+
+    def _take(index):
+        return np.take_along_axis(stack, index, axis=-1)[..., 0]
+
+    patch_med = 0.5 * (_take((nvalid - 1) // 2) + _take(nvalid // 2))
+    patch_range = _take(nvalid - 1) - stack[..., 0]
+
+    with np.errstate(invalid='ignore'):
+        valid = (patch_range > 1e-6) & ~np.isnan(center)
+    spikes = np.zeros_like(valid)
+    spikes[valid] = (np.abs(center[valid] - patch_med[valid]) / patch_range[valid]) > thres
+    return spikes, patch_med
+
+
+def _unwrap(fmap_data, mag_file, mask=None, method='prelude', num_threads=1):
     from math import pi
-    from nipype.interfaces.fsl import PRELUDE
-    magnii = nb.load(mag_file)
 
     if mask is None:
         mask = np.ones_like(fmap_data, dtype=np.uint8)
@@ -248,9 +547,18 @@ def _unwrap(fmap_data, mag_file, mask=None):
     fmapmax = max(abs(fmap_data[mask > 0].min()), fmap_data[mask > 0].max())
     fmap_data *= pi / fmapmax
 
-    nb.Nifti1Image(fmap_data, magnii.affine).to_filename('fmap_rad.nii.gz')
-    nb.Nifti1Image(mask, magnii.affine).to_filename('fmap_mask.nii.gz')
-    nb.Nifti1Image(magnii.get_data(), magnii.affine).to_filename('fmap_mag.nii.gz')
+    if method == 'laplacian':
+        from ..utils.phasemanip import unwrap_laplacian
+        return unwrap_laplacian(fmap_data, mask, num_threads=num_threads) * (fmapmax / pi)
+
+    from nipype.interfaces.fsl import PRELUDE
+    magnii = nb.load(mag_file)
+    to_filename(nb.Nifti1Image(fmap_data, magnii.affine), 'fmap_rad.nii.gz',
+                num_threads=num_threads)
+    to_filename(nb.Nifti1Image(mask, magnii.affine), 'fmap_mask.nii.gz',
+                num_threads=num_threads)
+    to_filename(nb.Nifti1Image(magnii.get_data(), magnii.affine), 'fmap_mag.nii.gz',
+                num_threads=num_threads)
 
     # Run prelude
     res = PRELUDE(phase_file='fmap_rad.nii.gz',
@@ -312,33 +620,12 @@ def get_ees(in_meta, in_file=None):
 
     """
 
-    import nibabel as nb
-    from sdcflows.interfaces.fmap import _get_pe_index
+    from ..utils.epimanip import get_readout
 
-    # Use case 1: EES is defined
-    ees = in_meta.get('EffectiveEchoSpacing', None)
+    ees = get_readout(in_meta, in_file)[0]
     if ees is not None:
         return ees
 
-    # All other cases require the parallel acc and npe (N vox in PE dir)
-    acc = float(in_meta.get('ParallelReductionFactorInPlane', 1.0))
-    npe = nb.load(in_file).shape[_get_pe_index(in_meta)]
-    etl = npe // acc
-
-    # Use case 2: TRT is defined
-    trt = in_meta.get('TotalReadoutTime', None)
-    if trt is not None:
-        return trt / (etl - 1)
-
-    # Use case 3 (philips scans)
-    wfs = in_meta.get('WaterFatShift', None)
-    if wfs is not None:
-        fstrength = in_meta['MagneticFieldStrength']
-        wfd_ppm = 3.4  # water-fat diff in ppm
-        g_ratio_mhz_t = 42.57  # gyromagnetic ratio for proton (1H) in MHz/T
-        wfs_hz = fstrength * wfd_ppm * g_ratio_mhz_t
-        return wfs / (wfs_hz * etl)
-
     raise ValueError('Unknown effective echo-spacing specification')
 
 
@@ -385,30 +672,12 @@ def get_trt(in_meta, in_file=None):
 
     """
 
-    # Use case 1: TRT is defined
-    trt = in_meta.get('TotalReadoutTime', None)
+    from ..utils.epimanip import get_readout
+
+    trt = get_readout(in_meta, in_file)[1]
     if trt is not None:
         return trt
 
-    # All other cases require the parallel acc and npe (N vox in PE dir)
-    acc = float(in_meta.get('ParallelReductionFactorInPlane', 1.0))
-    npe = nb.load(in_file).shape[_get_pe_index(in_meta)]
-    etl = npe // acc
-
-    # Use case 2: TRT is defined
-    ees = in_meta.get('EffectiveEchoSpacing', None)
-    if ees is not None:
-        return ees * (etl - 1)
-
-    # Use case 3 (philips scans)
-    wfs = in_meta.get('WaterFatShift', None)
-    if wfs is not None:
-        fstrength = in_meta['MagneticFieldStrength']
-        wfd_ppm = 3.4  # water-fat diff in ppm
-        g_ratio_mhz_t = 42.57  # gyromagnetic ratio for proton (1H) in MHz/T
-        wfs_hz = fstrength * wfd_ppm * g_ratio_mhz_t
-        return wfs / wfs_hz
-
     raise ValueError('Unknown total-readout time specification')
 
 
@@ -431,9 +700,9 @@ def _torads(in_file, fmap_range=None, newpath=None):
     """
     from math import pi
     import nibabel as nb
-    from nipype.utils.filemanip import fname_presuffix
+    from ..utils.nifti import intermediate_fname, to_filename
 
-    out_file = fname_presuffix(in_file, suffix='_rad', newpath=newpath)
+    out_file = intermediate_fname(in_file, suffix='_rad', newpath=newpath)
     fmapnii = nb.load(in_file)
     fmapdata = fmapnii.get_data()
 
@@ -442,7 +711,7 @@ def _torads(in_file, fmap_range=None, newpath=None):
     fmapdata = fmapdata * (pi / fmap_range)
     out_img = nb.Nifti1Image(fmapdata, fmapnii.affine, fmapnii.header)
     out_img.set_data_dtype('float32')
-    out_img.to_filename(out_file)
+    to_filename(out_img, out_file)
     return out_file, fmap_range
 
 
@@ -450,18 +719,140 @@ def _tohz(in_file, range_hz, newpath=None):
     """Convert a field map to Hz units"""
     from math import pi
     import nibabel as nb
-    from nipype.utils.filemanip import fname_presuffix
+    from ..utils.nifti import intermediate_fname, to_filename
 
-    out_file = fname_presuffix(in_file, suffix='_hz', newpath=newpath)
+    out_file = intermediate_fname(in_file, suffix='_hz', newpath=newpath)
     fmapnii = nb.load(in_file)
     fmapdata = fmapnii.get_data()
     fmapdata = fmapdata * (range_hz / pi)
     out_img = nb.Nifti1Image(fmapdata, fmapnii.affine, fmapnii.header)
     out_img.set_data_dtype('float32')
-    out_img.to_filename(out_file)
+    to_filename(out_img, out_file)
     return out_file
 
 
+def _fmap2warp(in_file, metadata, in_mask=None, demean=True, jacobian=False,
+               newpath=None):
+    """
+    Calculate the voxel-shift map and displacements field of a fieldmap in Hz.
+
+    The voxel-shift map (in voxels) is :math:`\\Delta B_0 (\\text{Hz})\\, t_\\text{ees}
+    \\, N_\\text{PE}`, and the displacements field stores it in mm along the
+    phase-encoding axis, with the signs and conventions of
+    :class:`~niworkflows.interfaces.itk.FUGUEvsm2ANTSwarp`.
+
+    >>> fmap = np.zeros((90, 90, 60), dtype=np.float32)
+    >>> fmap[..., 30:] = 20.
+    >>> nb.Nifti1Image(fmap, np.diag([2., 2., 2., 1.]), None).to_filename('fmap.nii.gz')
+    >>> vsm, warp, jac = _fmap2warp(
+    ...     'fmap.nii.gz', {'EffectiveEchoSpacing': 0.00059,
+    ...                     'PhaseEncodingDirection': 'j-'},
+    ...     demean=False, jacobian=True)
+    >>> round(float(nb.load(vsm).get_fdata()[0, 0, -1]), 3)
+    1.062
+    >>> nb.load(warp).shape
+    (90, 90, 60, 1, 3)
+    >>> round(float(nb.load(warp).get_fdata()[0, 0, -1, 0, 1]), 3)
+    2.124
+    >>> bool(np.allclose(nb.load(jac).get_fdata(), 1.0))
+    True
+
+    """
+    from ..utils.nifti import intermediate_fname
+
+    fmapnii = nb.load(in_file)
+    fmap = np.squeeze(np.asanyarray(fmapnii.dataobj)).astype(np.float32)
+    pe_dir = metadata['PhaseEncodingDirection']
+    axis = _get_pe_index(metadata)
+
+    vsm = fmap * np.float32(get_ees(metadata, in_file) * fmap.shape[axis])
+    if demean:
+        mask = np.ones(vsm.shape, dtype=bool)
+        if in_mask is not None:
+            mask = np.squeeze(np.asanyarray(nb.load(in_mask).dataobj)) > 0
+        vsm -= np.median(vsm[mask])
+
+    hdr = fmapnii.header.copy()
+    hdr.set_data_dtype('<f4')
+    vsm_file = intermediate_fname(in_file, suffix='_vsm', newpath=newpath)
+    to_filename(nb.Nifti1Image(vsm, fmapnii.affine, hdr), vsm_file)
+
+    # Displacements in mm, signed as FUGUEvsm2ANTSwarp
+    polarity = 1.0 if pe_dir.endswith('-') else -1.0
+    component = vsm * np.float32(polarity * fmapnii.header.get_zooms()[axis])
+    field = np.zeros(vsm.shape + (1, 3), dtype='<f4')
+    field[..., 0, axis] = component
+
+    hdr.set_intent('vector', (), '')
+    warp_file = intermediate_fname(in_file, suffix='_warp', newpath=newpath)
+    to_filename(nb.Nifti1Image(field, fmapnii.affine, hdr), warp_file)
+
+    jac_file = None
+    if jacobian:
+        jac_file = intermediate_fname(in_file, suffix='_jacobian', newpath=newpath)
+        jachdr = fmapnii.header.copy()
+        jachdr.set_data_dtype('<f4')
+        to_filename(nb.Nifti1Image(_warp_jacobian(component, axis, fmapnii.affine),
+                                   fmapnii.affine, jachdr), jac_file)
+
+    return vsm_file, warp_file, jac_file
+
+
+def _warp2fmap(in_file, metadata, newpath=None):
+    """
+    Calculate the fieldmap (in Hz) corresponding to a displacements field.
+
+    >>> fmap = np.fromfunction(lambda i, j, k: 10. * np.cos(i / 3.), (12, 14, 6))
+    >>> nb.Nifti1Image(fmap.astype('f4'), np.diag([2.5, 2.5, 3., 1.])).to_filename(
+    ...     'fmap.nii.gz')
+    >>> meta = {'PhaseEncodingDirection': 'i-', 'TotalReadoutTime': 0.05}
+    >>> _, warp, _ = _fmap2warp('fmap.nii.gz', meta, demean=False)
+    >>> np.allclose(nb.load(_warp2fmap(warp, meta)).get_fdata(), fmap, atol=1e-4)
+    True
+
+    """
+    from ..utils.nifti import intermediate_fname
+    from .unwarp import load_pe_displacements
+
+    warpnii = nb.load(in_file)
+    pe_dir = metadata['PhaseEncodingDirection']
+    component, axis = load_pe_displacements(warpnii, pe_dir)
+
+    polarity = 1.0 if pe_dir.endswith('-') else -1.0
+    vsm = component / np.float32(polarity * warpnii.header.get_zooms()[axis])
+    fmap = vsm / np.float32(get_ees(metadata, in_file) * component.shape[axis])
+
+    hdr = warpnii.header.copy()
+    hdr.set_data_shape(fmap.shape)
+    hdr.set_data_dtype('<f4')
+    hdr.set_dim_info()
+    hdr.set_intent('none', (), '')
+    out_file = intermediate_fname(in_file, suffix='_fieldmap', newpath=newpath)
+    to_filename(nb.Nifti1Image(fmap.astype('<f4'), warpnii.affine, hdr), out_file)
+    return out_file
+
+
+def _warp_jacobian(component, axis, affine):
+    """
+    Calculate the Jacobian determinant of a displacements field with one nonzero
+    component (along ``axis``), given in mm and ITK (LPS) coordinates.
+
+    Since :math:`\\mathbf{u} = u\\,\\mathbf{e}_\\text{axis}`, the determinant of
+    :math:`\\mathbf{I} + \\nabla\\mathbf{u}` is just
+    :math:`1 + \\partial u / \\partial x_\\text{axis}`.
+
+    >>> affine = np.diag([2., 2., 2., 1.])
+    >>> u = np.fromfunction(lambda i, j, k: -0.1 * j, (5, 5, 5))
+    >>> np.allclose(_warp_jacobian(u, 1, affine), 1.05)
+    True
+
+    """
+    lps = np.diag([-1., -1., 1.]).dot(affine[:3, :3])
+    grad = np.gradient(component.astype(np.float32))
+    coeffs = np.linalg.inv(lps)[:, axis]
+    return (1.0 + sum(c * g for c, g in zip(coeffs, grad))).astype(np.float32)
+
+
 def phdiff2fmap(in_file, delta_te, newpath=None):
     r"""
     Converts the input phase-difference map into a fieldmap in Hz,
@@ -483,15 +874,15 @@ def phdiff2fmap(in_file, delta_te, newpath=None):
     import math
     import numpy as np
     import nibabel as nb
-    from nipype.utils.filemanip import fname_presuffix
+    from ..utils.nifti import intermediate_fname, to_filename
     #  GYROMAG_RATIO_H_PROTON_MHZ = 42.576
 
-    out_file = fname_presuffix(in_file, suffix='_fmap', newpath=newpath)
+    out_file = intermediate_fname(in_file, suffix='_fmap', newpath=newpath)
     image = nb.load(in_file)
     data = (image.get_data().astype(np.float32) / (2. * math.pi * delta_te))
     nii = nb.Nifti1Image(data, image.affine, image.header)
     nii.set_data_dtype(np.float32)
-    nii.to_filename(out_file)
+    to_filename(nii, out_file)
     return out_file
 
 
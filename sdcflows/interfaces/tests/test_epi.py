@@ -0,0 +1,32 @@
+"""Test the interfaces to process EPI images."""
+import numpy as np
+import nibabel as nb
+import pytest
+
+from ...utils.pepolar import distort_pe
+from ..epi import PEPolarWarp
+from ..unwarp import ApplyPEWarp
+
+
+@pytest.mark.parametrize('pe_dir', ['j', 'j-'])
+@pytest.mark.parametrize('flip', [False, True])
+def test_pepolar_warp(tmpdir, pe_dir, flip):
+    """The estimated warp unwarps the matched-PE image onto the template."""
+    tmpdir.chdir()
+
+    ii, jj, kk = np.indices((32, 40, 6))
+    template = 100 * np.exp(-((ii - 16) ** 2 + (jj - 20) ** 2) / 80.) * (1 + 0.3 * np.cos(ii))
+    shift = 2.0 * np.exp(-((ii - 16) ** 2 + (jj - 24) ** 2) / 100.) - 0.5
+    matched, opposed = distort_pe(template, shift, 1)
+
+    affine = np.diag([2.5, -2.5 if flip else 2.5, 3., 1.])
+    nb.Nifti1Image(matched, affine).to_filename('matched.nii.gz')
+    nb.Nifti1Image(opposed, affine).to_filename('opposed.nii.gz')
+
+    warp = PEPolarWarp(in_matched='matched.nii.gz', in_opposed='opposed.nii.gz',
+                       pe_dir=pe_dir, levels=[(20., 5.), (10., 2.), (7.5, 0.)]).run()
+    unwarped = ApplyPEWarp(in_file='matched.nii.gz', in_warp=warp.outputs.out_warp,
+                           pe_dir=pe_dir, interpolation='linear').run()
+
+    brain = template > 10
+    assert np.abs(nb.load(unwarped.outputs.out_file).get_fdata() - template)[brain].max() < 5
@@ -0,0 +1,194 @@
+"""Test the fieldmap manipulation utilities."""
+import os
+from itertools import product
+import numpy as np
+import nibabel as nb
+import pytest
+
+from ...utils.nifti import COMPRESS_ENV, GZIP_LEVEL_ENV
+from ..fmap import _despike, _despike2d, PhaseUnwrap, ProcessPhasediff
+
+
+def _despike_loop(data, thres, ndim=2):
+    """Voxel-wise reference of the FSL fugue despiking rule."""
+    out = data.copy()
+    for ijk in np.ndindex(*data.shape):
+        vals = []
+        for offset in product([-1, 0, 1], repeat=ndim):
+            nijk = tuple(c + o for c, o in zip(ijk, offset)) + ijk[ndim:]
+            if all(0 <= c < s for c, s in zip(nijk, data.shape)):
+                vals.append(data[nijk])
+        vals = np.array(vals)
+        patch_range = vals.max() - vals.min()
+        patch_med = np.median(vals)
+        if patch_range > 1e-6 and (abs(data[ijk] - patch_med) / patch_range) > thres:
+            out[ijk] = patch_med
+    return out
+
+
+def _despike2d_baseline(data, thres, neigh=None):
+    """The original implementation, updating ``data`` in place as it goes."""
+    if neigh is None:
+        neigh = [-1, 0, 1]
+
+    for k in range(data.shape[-1]):
+        data2d = data[..., k]
+        for i in range(data2d.shape[0]):
+            for j in range(data2d.shape[1]):
+                vals = []
+                for ii in neigh:
+                    for jj in neigh:
+                        try:
+                            vals.append(data2d[i + ii, j + jj])
+                        except IndexError:
+                            pass
+                vals = np.array(vals)
+                patch_range = vals.max() - vals.min()
+                patch_med = np.median(vals)
+                if (patch_range > 1e-6 and
+                        (abs(data2d[i, j] - patch_med) / patch_range) > thres):
+                    data[i, j, k] = patch_med
+    return data
+
+
+@pytest.mark.parametrize('ndim', [2, 3])
+@pytest.mark.parametrize('num_threads', [1, 3])
+def test_despike(ndim, num_threads):
+    """Check the vectorized despiking matches the voxel-wise rule."""
+    rng = np.random.RandomState(1234)
+    data = rng.normal(size=(12, 10, 9)).astype(np.float32)
+    data[rng.rand(*data.shape) > 0.95] = 50.
+
+    expected = _despike_loop(data, 0.2, ndim=ndim)
+    result = _despike(data.copy(), 0.2, ndim=ndim, num_threads=num_threads,
+                      slab_size=2)
+    assert np.allclose(result, expected)
+
+
+@pytest.mark.parametrize('seed', [0, 2])
+def test_despike_baseline(seed):
+    """
+    Bound the deviation from the original (in-place, border-wrapping) loop.
+
+    The synthetic fieldmap is a smooth field (in Hz) corrupted with Gaussian
+    noise (sigma = 5 Hz) and 1% of +/-300 Hz spikes.
+    Since the original loop reads values it has already despiked, and wraps
+    negative indices at the lower borders, both outputs cannot be identical.
+    Tolerances: most voxels are identical, the 95th percentile of the absolute
+    difference stays below 1.5 sigma, the error with respect to the clean
+    field is within 10% of the baseline's, and no more than 1% of the spikes
+    survive.
+    """
+    rng = np.random.RandomState(seed)
+    shape = (48, 48, 12)
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing='ij')
+    field = (120 * np.exp(-((x - 0.2) ** 2 + (y + 0.3) ** 2) / 0.3) -
+             60 * np.exp(-((x + 0.4) ** 2 + (y - 0.4) ** 2 + z ** 2) / 0.2))
+    sigma = 5.
+    data = (field + rng.normal(scale=sigma, size=shape)).astype(np.float32)
+    spikes = rng.rand(*shape) > 0.99
+    data[spikes] += rng.choice([-300., 300.], size=spikes.sum())
+
+    baseline = _despike2d_baseline(data.copy(), 0.2)
+    result = _despike(data.copy(), 0.2)
+
+    absdiff = np.abs(result - baseline)
+    assert np.median(absdiff) == 0
+    assert np.percentile(absdiff, 95) < 1.5 * sigma
+
+    def _rmse(x):
+        return np.sqrt(np.mean((x - field) ** 2))
+
+    assert _rmse(result) < 1.1 * _rmse(baseline)
+    assert (np.abs(result - field) > 100).sum() <= 0.01 * spikes.sum()
+
+
+def test_despike2d_flat():
+    """Flat patches (null range) are never modified."""
+    data = np.ones((5, 5, 3), dtype=np.float32)
+    assert np.all(_despike2d(data.copy(), 0.2) == data)
+
+
+def test_phase_unwrap(tmpdir):
+    """Check the in-process unwrapper recovers a smooth phase within the mask."""
+    tmpdir.chdir()
+
+    truth = np.fromfunction(
+        lambda i, j, k: 0.01 * (i - 20.) ** 2 + 0.25 * j - 0.3 * k, (40, 40, 12))
+    mask = np.zeros(truth.shape, dtype=np.uint8)
+    mask[5:-5, 5:-5, 2:-2] = 1
+
+    nb.Nifti1Image(np.angle(np.exp(1j * truth)).astype(np.float32),
+                   np.eye(4)).to_filename('phase.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii.gz')
+
+    result = PhaseUnwrap(phase_file='phase.nii.gz', mask_file='mask.nii.gz').run()
+    unwrapped = nb.load(result.outputs.unwrapped_phase_file).get_fdata()
+
+    diff = (unwrapped - truth)[mask > 0]
+    diff -= 2 * np.pi * np.round(np.median(diff) / (2 * np.pi))
+    assert np.allclose(diff, 0, atol=1e-4)
+    assert np.all(unwrapped[mask == 0] == 0)
+
+
+def test_process_phasediff(tmpdir):
+    """Check the fused phase-difference conversion on a wrapped phase ramp."""
+    tmpdir.chdir()
+
+    phase = np.fromfunction(lambda i, j, k: 0.25 * j, (30, 40, 10)) % (2 * np.pi)
+    mask = np.zeros(phase.shape, dtype=np.uint8)
+    mask[3:-3, 3:-3, :] = 1
+    nb.Nifti1Image(phase.astype(np.float32), np.eye(4)).to_filename('phasediff.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii.gz')
+
+    delta_te = 0.00246
+    result = ProcessPhasediff(
+        in_file='phasediff.nii.gz', in_mask='mask.nii.gz',
+        metadata={'EchoTime1': 0.00492, 'EchoTime2': 0.00738}).run()
+    fmap = nb.load(result.outputs.out_file).get_fdata()
+
+    # Rescaling to (-pi, pi) expands the ramp slightly
+    slope = 0.25 * 2 * np.pi / (phase.max() - phase.min()) / (2 * np.pi * delta_te)
+    steps = np.diff(fmap[5:-5, 5:-5, :], axis=1)
+    assert np.all(steps > 0)  # unwrapped
+    assert np.isclose(np.median(steps), slope, rtol=1e-3)
+    assert np.all(fmap[mask == 0] == 0)
+
+
+@pytest.mark.parametrize('compress', ['1', '0'])
+def test_intermediates_format(tmpdir, monkeypatch, compress):
+    """Check that intermediates follow the package-wide storage setting."""
+    tmpdir.chdir()
+    monkeypatch.setenv(COMPRESS_ENV, compress)
+
+    phase = np.fromfunction(lambda i, j, k: 0.1 * j, (20, 30, 6)).astype(np.float32)
+    nb.Nifti1Image(phase, np.eye(4)).to_filename('phasediff.nii.gz')
+    nb.Nifti1Image(np.ones(phase.shape, dtype=np.uint8), np.eye(4)).to_filename(
+        'mask.nii.gz')
+
+    result = ProcessPhasediff(
+        in_file='phasediff.nii.gz', in_mask='mask.nii.gz',
+        metadata={'EchoTime1': 0.00492, 'EchoTime2': 0.00738}).run()
+
+    ext = '.nii.gz' if compress == '1' else '.nii'
+    assert result.outputs.out_file.endswith('phasediff_fmap' + ext)
+    assert nb.load(result.outputs.out_file).shape == phase.shape
+
+
+def test_gzip_level(tmpdir, monkeypatch):
+    """Unwrapped phases are written at the configured compression level."""
+    tmpdir.chdir()
+    phase = np.fromfunction(lambda i, j, k: 0.1 * j, (20, 30, 6)).astype(np.float32)
+    nb.Nifti1Image(phase, np.eye(4)).to_filename('phase.nii.gz')
+    phase_file = str(tmpdir.join('phase.nii.gz'))
+
+    sizes = {}
+    for level in ('0', '9'):
+        monkeypatch.setenv(GZIP_LEVEL_ENV, level)
+        tmpdir.mkdir(level).chdir()
+        result = PhaseUnwrap(phase_file=phase_file, num_threads=2).run()
+        sizes[level] = os.path.getsize(result.outputs.unwrapped_phase_file)
+
+    # Level 0 stores the data uncompressed
+    assert sizes['0'] > phase.nbytes
+    assert sizes['9'] < phase.nbytes // 2
@@ -0,0 +1,138 @@
+"""Test the interfaces to apply SDC."""
+import numpy as np
+import nibabel as nb
+import pytest
+
+from ..fmap import _fmap2warp
+from ..unwarp import (
+    WarpJacobian, CompactWarp, ExpandWarp, ApplyPEWarp, ResampleSeries)
+
+
+def test_warp_jacobian(tmpdir):
+    """Check the Jacobian of a generated warp and the intensity modulation."""
+    tmpdir.chdir()
+
+    affine = np.diag([2.5, 2.5, 3., 1.])
+    fmap = np.fromfunction(lambda i, j, k: 5. * np.sin(j / 6.), (16, 24, 8))
+    nb.Nifti1Image(fmap.astype(np.float32), affine).to_filename('fmap.nii.gz')
+    nb.Nifti1Image(np.ones(fmap.shape, dtype=np.float32), affine).to_filename('ref.nii.gz')
+
+    meta = {'EffectiveEchoSpacing': 0.0005, 'PhaseEncodingDirection': 'j'}
+    vsm, warp, jac = _fmap2warp('fmap.nii.gz', meta, jacobian=True)
+
+    result = WarpJacobian(in_file=warp, in_image='ref.nii.gz').run()
+    jacobian = nb.load(result.outputs.out_jacobian).get_fdata()
+
+    # For 'j' with a RAS+ affine, J = 1 + d(vsm)/dj
+    expected = 1.0 + np.gradient(nb.load(vsm).get_fdata(), axis=1)
+    assert np.allclose(jacobian, expected, atol=1e-5)
+    assert np.allclose(nb.load(jac).get_fdata(), jacobian)
+    assert np.allclose(nb.load(result.outputs.out_modulated).get_fdata(), jacobian)
+
+
+@pytest.mark.parametrize('pe_dir', ['i', 'j-', 'k'])
+def test_compact_warp(tmpdir, pe_dir):
+    """Check the compact warps roundtrip and are readable by WarpJacobian."""
+    tmpdir.chdir()
+
+    axis = 'ijk'.index(pe_dir[0])
+    affine = np.diag([2.5, 2.5, 3., 1.])
+    field = np.zeros((12, 10, 8, 1, 3), dtype='<f4')
+    field[..., 0, axis] = np.random.normal(size=field.shape[:3])
+    nii = nb.Nifti1Image(field, affine, None)
+    nii.header.set_intent('vector', (), '')
+    nii.to_filename('warp.nii.gz')
+
+    compact = CompactWarp(in_file='warp.nii.gz', pe_dir=pe_dir).run().outputs.out_file
+    assert nb.load(compact).shape == field.shape[:3]
+
+    expanded = ExpandWarp(in_file=compact).run().outputs.out_file
+    assert np.array_equal(nb.load(expanded).get_fdata(), field)
+    assert np.allclose(nb.load(expanded).affine, affine)
+
+    jac_full = nb.load(WarpJacobian(in_file='warp.nii.gz').run().outputs.out_jacobian)
+    jac_compact = nb.load(WarpJacobian(in_file=compact).run().outputs.out_jacobian)
+    assert np.allclose(jac_full.get_fdata(), jac_compact.get_fdata())
+
+
+def test_compact_warp_offaxis(tmpdir):
+    """Fields with displacements off the PE axis cannot be compacted."""
+    tmpdir.chdir()
+
+    field = np.zeros((6, 6, 6, 1, 3), dtype='<f4')
+    field[..., 0, 1] = 1.0
+    field[1, 1, 1, 0, 0] = 0.5
+    nb.Nifti1Image(field, np.eye(4), None).to_filename('warp.nii.gz')
+
+    with pytest.raises(ValueError):
+        CompactWarp(in_file='warp.nii.gz', pe_dir='j').run()
+
+
+@pytest.mark.parametrize('pe_dir', ['j', 'j-'])
+@pytest.mark.parametrize('compact', [True, False])
+def test_apply_pe_warp(tmpdir, pe_dir, compact):
+    """Check the streamed unwarping of a 4D series against a reference resampling."""
+    from scipy.ndimage import map_coordinates
+    tmpdir.chdir()
+
+    affine = np.diag([2.5, 2.5, 3., 1.])
+    fmap = np.fromfunction(lambda i, j, k: 20. * np.sin(j / 6.) + i, (16, 24, 8))
+    nb.Nifti1Image(fmap.astype(np.float32), affine).to_filename('fmap.nii.gz')
+    series = np.random.normal(size=(16, 24, 8, 9)).astype(np.float32)
+    nb.Nifti1Image(series, affine).to_filename('bold.nii.gz')
+
+    meta = {'EffectiveEchoSpacing': 0.0005, 'PhaseEncodingDirection': pe_dir}
+    vsm, warp, _ = _fmap2warp('fmap.nii.gz', meta)
+    if compact:
+        warp = CompactWarp(in_file=warp, pe_dir=pe_dir).run().outputs.out_file
+
+    result = ApplyPEWarp(in_file='bold.nii.gz', in_warp=warp, interpolation='linear',
+                         chunk_size=2, num_threads=3).run()
+    unwarped = nb.load(result.outputs.out_file).get_fdata()
+
+    # Unwarped voxels are sampled at the location given by the VSM (in voxels)
+    coords = np.indices(fmap.shape).astype(float)
+    coords[1] += nb.load(vsm).get_fdata() * (-1.0 if pe_dir.endswith('-') else 1.0)
+    inside = (coords[1] > -0.5) & (coords[1] < fmap.shape[1] - 0.5)
+    for t in range(series.shape[-1]):
+        expected = map_coordinates(series[..., t], coords, order=1, mode='nearest')
+        assert np.allclose(unwarped[..., t][inside], expected[inside], atol=1e-4)
+        assert not np.any(unwarped[..., t][~inside])
+
+
+def test_resample_series(tmpdir):
+    """Check the single-shot resampling with head-motion transforms and SDC."""
+    tmpdir.chdir()
+
+    affine = np.diag([2.5, 2.5, 3., 1.])
+    series = np.random.normal(size=(12, 14, 6, 3)).astype(np.float32)
+    nb.Nifti1Image(series, affine).to_filename('bold.nii.gz')
+
+    # One voxel along the PE axis (j): -2.5 mm in LPS is +1 voxel (RAS+ affine)
+    field = np.zeros((12, 14, 6, 1, 3), dtype='<f4')
+    field[..., 0, 1] = -2.5
+    nii = nb.Nifti1Image(field, affine, None)
+    nii.header.set_intent('vector', (), '')
+    nii.to_filename('warp.nii.gz')
+
+    # Volume t moved t voxels along i (-2.5 * t mm in LPS)
+    xfms = []
+    for t in range(series.shape[-1]):
+        xfms.append('hmc%d.txt' % t)
+        with open(xfms[-1], 'w') as f:
+            f.write('#Insight Transform File V1.0\n#Transform 0\n'
+                    'Transform: AffineTransform_double_3_3\n'
+                    'Parameters: 1 0 0 0 1 0 0 0 1 %g 0 0\n'
+                    'FixedParameters: 0 0 0\n' % (-2.5 * t))
+
+    result = ResampleSeries(in_file='bold.nii.gz', in_xfms=xfms, in_warp='warp.nii.gz',
+                            order=1, num_threads=2).run()
+    resampled = nb.load(result.outputs.out_file)
+    assert resampled.shape == series.shape
+    assert np.allclose(resampled.affine, affine)
+
+    data = resampled.get_fdata()
+    for t in range(series.shape[-1]):
+        assert np.allclose(data[:12 - t, :-1, :, t], series[t:, 1:, :, t], atol=1e-5)
+        assert not np.any(data[12 - t:, :, :, t])
+        assert not np.any(data[:, -1, :, t])
@@ -0,0 +1,402 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Interfaces to apply the estimated susceptibility distortions.
+
+Displacements fields (DFMs) are either ITK/ANTs-compatible vector images
+(shape :math:`X \\times Y \\times Z \\times 1 \\times 3`), or *compact* 3D images
+that only store the displacement (in mm) along the phase-encoding (PE) axis.
+Compact DFMs record the PE axis in the ``dim_info`` field of the NIfTI header,
+and the PE direction (axis and polarity) in the ``intent_name`` (e.g.,
+``sdcflows:j-``).
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+        >>> field = np.zeros((10, 10, 10, 1, 3), dtype='<f4')
+        >>> field[..., 0, 1] = np.fromfunction(lambda i, j, k: -0.1 * j, (10, 10, 10))
+        >>> nii = nb.Nifti1Image(field, np.diag([2., 2., 2., 1.]), None)
+        >>> nii.header.set_intent('vector', (), '')
+        >>> nii.to_filename(tmpdir.join('warp.nii.gz').strpath)
+
+
+"""
+import numpy as np
+import nibabel as nb
+from nipype.interfaces.base import (
+    BaseInterfaceInputSpec, TraitedSpec, File, isdefined, traits,
+    SimpleInterface, InputMultiObject)
+
+from ..utils.nifti import intermediate_fname, to_filename
+from .fmap import _warp_jacobian
+
+
+class WarpJacobianInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='displacements field (ANTs or compact format) along the PE axis')
+    pe_dir = traits.Enum('i', 'i-', 'j', 'j-', 'k', 'k-',
+                         desc='phase-encoding direction (detected if not set)')
+    in_image = File(exists=True, desc='unwarped image to be modulated by the Jacobian')
+
+
+class WarpJacobianOutputSpec(TraitedSpec):
+    out_jacobian = File(desc='the Jacobian determinant of the displacements field')
+    out_modulated = File(desc='the input image, modulated by the Jacobian')
+
+
+class WarpJacobian(SimpleInterface):
+    """
+    Calculate the Jacobian determinant of a displacements field that is only
+    nonzero along the phase-encoding axis (i.e., :math:`1 + \\partial u / \\partial x_{PE}`),
+    and optionally modulate the intensities of an unwarped image with it.
+
+    >>> jac = WarpJacobian(in_file='warp.nii.gz').run()
+    >>> np.allclose(nb.load(jac.outputs.out_jacobian).get_fdata(), 1.05)
+    True
+
+    """
+    input_spec = WarpJacobianInputSpec
+    output_spec = WarpJacobianOutputSpec
+
+    def _run_interface(self, runtime):
+        warpnii = nb.load(self.inputs.in_file)
+        component, axis = load_pe_displacements(
+            warpnii, self.inputs.pe_dir if isdefined(self.inputs.pe_dir) else None)
+        jacobian = _warp_jacobian(component, axis, warpnii.affine)
+
+        hdr = warpnii.header.copy()
+        hdr.set_data_shape(jacobian.shape)
+        hdr.set_data_dtype('<f4')
+        hdr.set_intent('none')
+        self._results['out_jacobian'] = intermediate_fname(
+            self.inputs.in_file, suffix='_jacobian', newpath=runtime.cwd)
+        to_filename(nb.Nifti1Image(jacobian, warpnii.affine, hdr),
+                    self._results['out_jacobian'])
+
+        if isdefined(self.inputs.in_image):
+            imgnii = nb.load(self.inputs.in_image)
+            data = np.asanyarray(imgnii.dataobj).astype(np.float32)
+            if data.ndim == 4:
+                jacobian = jacobian[..., np.newaxis]
+            hdr = imgnii.header.copy()
+            hdr.set_data_dtype('<f4')
+            self._results['out_modulated'] = intermediate_fname(
+                self.inputs.in_image, suffix='_modulated', newpath=runtime.cwd)
+            to_filename(nb.Nifti1Image(data * jacobian, imgnii.affine, hdr),
+                        self._results['out_modulated'])
+        return runtime
+
+
+class ApplyPEWarpInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='the 3D or 4D image to be unwarped')
+    in_warp = File(exists=True, mandatory=True,
+                   desc='displacements field (ANTs or compact format) along the PE axis')
+    pe_dir = traits.Enum('i', 'i-', 'j', 'j-', 'k', 'k-',
+                         desc='phase-encoding direction (detected if not set)')
+    interpolation = traits.Enum('cubic', 'linear', 'lanczos', 'nearest', usedefault=True,
+                                desc='interpolation kernel along the PE axis')
+    jacobian = traits.Bool(False, usedefault=True,
+                           desc='modulate intensities with the Jacobian determinant')
+    chunk_size = traits.Int(4, usedefault=True, nohash=True,
+                            desc='number of volumes resampled per task')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of threads')
+
+
+class ApplyPEWarpOutputSpec(TraitedSpec):
+    out_file = File(desc='the unwarped image')
+
+
+class ApplyPEWarp(SimpleInterface):
+    """
+    Unwarp a full 3D or 4D series with a displacements field along the PE axis.
+
+    The sampling locations and weights along the PE axis are calculated once and
+    then applied to all volumes, which are streamed through a thread pool in
+    chunks (see :mod:`sdcflows.utils.resampling`).
+
+    >>> data = np.random.normal(size=(10, 10, 10, 5)).astype('<f4')
+    >>> nb.Nifti1Image(data, np.diag([2., 2., 2., 1.]), None).to_filename('bold.nii.gz')
+    >>> result = ApplyPEWarp(in_file='bold.nii.gz', in_warp='warp.nii.gz',
+    ...                      num_threads=2).run()
+    >>> nb.load(result.outputs.out_file).shape
+    (10, 10, 10, 5)
+
+    """
+    input_spec = ApplyPEWarpInputSpec
+    output_spec = ApplyPEWarpOutputSpec
+
+    def _run_interface(self, runtime):
+        from ..utils.resampling import stream_resample_pe
+
+        warpnii = nb.load(self.inputs.in_warp)
+        imgshape = nb.load(self.inputs.in_file).shape[:3]
+        if warpnii.shape[:3] != imgshape:
+            raise ValueError('Displacements field and image have different grids '
+                             '(%s and %s).' % (warpnii.shape[:3], imgshape))
+
+        component, axis = load_pe_displacements(
+            warpnii, self.inputs.pe_dir if isdefined(self.inputs.pe_dir) else None)
+
+        self._results['out_file'] = intermediate_fname(
+            self.inputs.in_file, suffix='_unwarped', newpath=runtime.cwd)
+        stream_resample_pe(
+            self.inputs.in_file, self._results['out_file'],
+            _pe_shift_voxels(component, axis, warpnii.affine), axis,
+            kernel=self.inputs.interpolation,
+            modulation=_warp_jacobian(component, axis, warpnii.affine)
+            if self.inputs.jacobian else None,
+            chunk_size=self.inputs.chunk_size,
+            num_threads=self.inputs.num_threads)
+        return runtime
+
+
+class ResampleSeriesInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='the 3D or 4D image to be resampled')
+    in_xfms = InputMultiObject(
+        File(exists=True),
+        desc='one ITK rigid/affine transform (reference-to-volume) per volume (HMC)')
+    in_warp = File(exists=True,
+                   desc='displacements field (ANTs or compact format) along the PE axis')
+    reference = File(exists=True, desc='image defining the output grid (defaults to '
+                                       'the grid of in_warp, then of in_file)')
+    pe_dir = traits.Enum('i', 'i-', 'j', 'j-', 'k', 'k-',
+                         desc='phase-encoding direction (detected if not set)')
+    order = traits.Range(low=0, high=5, value=3, usedefault=True,
+                         desc='order of the spline interpolation')
+    jacobian = traits.Bool(False, usedefault=True,
+                           desc='modulate intensities with the Jacobian determinant')
+    chunk_size = traits.Int(1, usedefault=True, nohash=True,
+                            desc='number of volumes resampled per task')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of threads')
+
+
+class ResampleSeriesOutputSpec(TraitedSpec):
+    out_file = File(desc='the resampled image')
+
+
+class ResampleSeries(SimpleInterface):
+    """
+    Resample a series with per-volume head-motion transforms and the SDC warp at once.
+
+    Each volume is interpolated one single time, on a sampling grid resulting from
+    composing the displacements field and the volume's transform in memory
+    (see :func:`~sdcflows.utils.resampling.stream_resample_composed`).
+
+    >>> data = np.random.normal(size=(10, 10, 10, 2)).astype('<f4')
+    >>> nb.Nifti1Image(data, np.diag([2., 2., 2., 1.]), None).to_filename('bold.nii.gz')
+    >>> for i in range(2):
+    ...     with open('hmc%d.txt' % i, 'w') as f:
+    ...         _ = f.write(
+    ...             'Transform: MatrixOffsetTransformBase_double_3_3\\n'
+    ...             'Parameters: 1 0 0 0 1 0 0 0 1 %.1f 0 0\\n'
+    ...             'FixedParameters: 0 0 0\\n' % (0.1 * i))
+    >>> result = ResampleSeries(in_file='bold.nii.gz', in_xfms=['hmc0.txt', 'hmc1.txt'],
+    ...                         in_warp='warp.nii.gz', num_threads=2).run()
+    >>> nb.load(result.outputs.out_file).shape
+    (10, 10, 10, 2)
+
+    """
+    input_spec = ResampleSeriesInputSpec
+    output_spec = ResampleSeriesOutputSpec
+
+    def _run_interface(self, runtime):
+        from ..utils.resampling import load_itk_affine, stream_resample_composed
+
+        refnii = None
+        if isdefined(self.inputs.reference):
+            refnii = nb.load(self.inputs.reference)
+
+        displacements = modulation = None
+        if isdefined(self.inputs.in_warp):
+            warpnii = nb.load(self.inputs.in_warp)
+            refnii = refnii or warpnii
+            if warpnii.shape[:3] != refnii.shape[:3]:
+                raise ValueError('Displacements field and reference have different '
+                                 'grids (%s and %s).' % (warpnii.shape[:3],
+                                                         refnii.shape[:3]))
+            component, axis = load_pe_displacements(
+                warpnii, self.inputs.pe_dir if isdefined(self.inputs.pe_dir) else None)
+            displacements = np.zeros(component.shape + (3, ), dtype=np.float32)
+            displacements[..., axis] = component
+            if self.inputs.jacobian:
+                modulation = _warp_jacobian(component, axis, warpnii.affine)
+
+        refnii = refnii or nb.load(self.inputs.in_file)
+        xfms = None
+        if isdefined(self.inputs.in_xfms):
+            xfms = [load_itk_affine(f) for f in self.inputs.in_xfms]
+
+        self._results['out_file'] = intermediate_fname(
+            self.inputs.in_file, suffix='_resampled', newpath=runtime.cwd)
+        stream_resample_composed(
+            self.inputs.in_file, self._results['out_file'],
+            refnii.shape[:3], refnii.affine, xfms=xfms,
+            displacements=displacements, order=self.inputs.order,
+            modulation=modulation, chunk_size=self.inputs.chunk_size,
+            num_threads=self.inputs.num_threads)
+        return runtime
+
+
+def _pe_shift_voxels(component, axis, affine):
+    """
+    Convert displacements along the PE axis from physical (LPS, mm) to voxel units.
+
+    >>> float(_pe_shift_voxels(np.ones((2, 2, 2)), 1, np.diag([2., 2., 2., 1.]))[0, 0, 0])
+    -0.5
+
+    """
+    lps = np.diag([-1., -1., 1.]).dot(np.asanyarray(affine)[:3, :3])
+    return np.linalg.inv(lps)[axis, axis] * component
+
+
+def _get_warp_axis(field, pe_dir=None):
+    """
+    Find the axis of the only nonzero component of a displacements field.
+
+    >>> field = np.zeros((5, 5, 5, 3))
+    >>> field[..., 2] = 1.
+    >>> _get_warp_axis(field)
+    2
+    >>> _get_warp_axis(field, 'j-')
+    1
+
+    """
+    if pe_dir is not None:
+        return 'ijk'.index(pe_dir[0])
+    return int(np.argmax(np.abs(field.reshape(-1, 3)).max(0)))
+
+
+class CompactWarpInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='displacements field (ANTs format)')
+    pe_dir = traits.Enum('i', 'i-', 'j', 'j-', 'k', 'k-',
+                         desc='phase-encoding direction (axis is detected if not set)')
+
+
+class CompactWarpOutputSpec(TraitedSpec):
+    out_file = File(desc='the compact displacements field')
+
+
+class CompactWarp(SimpleInterface):
+    """Store an ANTs displacements field with the compact (PE-axis only) format."""
+    input_spec = CompactWarpInputSpec
+    output_spec = CompactWarpOutputSpec
+
+    def _run_interface(self, runtime):
+        self._results['out_file'] = compress_warp(
+            self.inputs.in_file,
+            pe_dir=self.inputs.pe_dir if isdefined(self.inputs.pe_dir) else None,
+            newpath=runtime.cwd)
+        return runtime
+
+
+class ExpandWarpInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='displacements field (compact or ANTs format)')
+
+
+class ExpandWarpOutputSpec(TraitedSpec):
+    out_file = File(desc='the displacements field in ANTs format')
+
+
+class ExpandWarp(SimpleInterface):
+    """Expand a compact displacements field into the ANTs format (when necessary)."""
+    input_spec = ExpandWarpInputSpec
+    output_spec = ExpandWarpOutputSpec
+
+    def _run_interface(self, runtime):
+        self._results['out_file'] = expand_warp(self.inputs.in_file, newpath=runtime.cwd)
+        return runtime
+
+
+def compress_warp(in_file, pe_dir=None, newpath=None):
+    """
+    Store the only nonzero component of an ANTs displacements field.
+
+    >>> compact = compress_warp('warp.nii.gz', pe_dir='j-')
+    >>> nii = nb.load(compact)
+    >>> nii.shape, nii.header.get_dim_info()[1], _get_compact_pe(nii)
+    ((10, 10, 10), 1, 'j-')
+    >>> expanded = nb.load(expand_warp(compact))
+    >>> expanded.shape, expanded.header.get_intent()[0]
+    ((10, 10, 10, 1, 3), 'vector')
+    >>> np.allclose(expanded.get_fdata(), nb.load('warp.nii.gz').get_fdata())
+    True
+
+    """
+    warpnii = nb.load(in_file)
+    if _get_compact_pe(warpnii) is not None:
+        return in_file
+
+    field = np.asanyarray(warpnii.dataobj).reshape(warpnii.shape[:3] + (3, ))
+    axis = _get_warp_axis(field, pe_dir)
+    others = [i for i in range(3) if i != axis]
+    if np.any(field[..., others]):
+        raise ValueError('Displacements field "%s" has nonzero components off the '
+                         'phase-encoding axis and cannot be stored in compact format.'
+                         % in_file)
+
+    hdr = warpnii.header.copy()
+    hdr.set_data_shape(field.shape[:3])
+    hdr.set_data_dtype('<f4')
+    hdr.set_dim_info(phase=axis)
+    hdr.set_intent('none', (), name='sdcflows:%s' % (pe_dir or 'ijk'[axis]))
+
+    out_file = intermediate_fname(in_file, suffix='_pewarp', newpath=newpath)
+    to_filename(nb.Nifti1Image(field[..., axis].astype('<f4'), warpnii.affine, hdr),
+                out_file)
+    return out_file
+
+
+def expand_warp(in_file, newpath=None):
+    """Write out the ANTs (vector) format of a compact displacements field."""
+    warpnii = nb.load(in_file)
+    if _get_compact_pe(warpnii) is None:
+        return in_file
+
+    component, axis = load_pe_displacements(warpnii)
+    field = np.zeros(component.shape + (1, 3), dtype='<f4')
+    field[..., 0, axis] = component
+
+    hdr = warpnii.header.copy()
+    hdr.set_data_shape(field.shape)
+    hdr.set_data_dtype('<f4')
+    hdr.set_dim_info()
+    hdr.set_intent('vector', (), '')
+
+    out_file = intermediate_fname(in_file, suffix='_xfm', newpath=newpath)
+    to_filename(nb.Nifti1Image(field, warpnii.affine, hdr), out_file)
+    return out_file
+
+
+def load_pe_displacements(warp, pe_dir=None):
+    """
+    Read the displacements (in mm) along the PE axis of a field in any format.
+
+    Returns the 3D displacements array and the PE axis.
+
+    >>> component, axis = load_pe_displacements('warp.nii.gz')
+    >>> component.shape, axis
+    ((10, 10, 10), 1)
+
+    """
+    if isinstance(warp, str):
+        warp = nb.load(warp)
+
+    compact_pe = _get_compact_pe(warp)
+    if compact_pe is not None:
+        return np.asanyarray(warp.dataobj).astype(np.float32), 'ijk'.index(compact_pe[0])
+
+    field = np.asanyarray(warp.dataobj).reshape(warp.shape[:3] + (3, ))
+    axis = _get_warp_axis(field, pe_dir)
+    return field[..., axis].astype(np.float32), axis
+
+
+def _get_compact_pe(nii):
+    """Return the PE direction of a compact displacements field (``None`` otherwise)."""
+    name = nii.header.get_intent()[2]
+    if len(nii.shape) == 3 and name.startswith('sdcflows:'):
+        return name.split(':', 1)[1]
+    return None
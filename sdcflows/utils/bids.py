@@ -0,0 +1,153 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Querying BIDS datasets for EPI runs and their fieldmaps.
+
+These utilities only require *pyBIDS*, so that runs can be planned (e.g., by
+``sdcflows --dry-run``) without importing *nipype* or the workflows.
+
+Indexing large datasets is slow, so :func:`get_layouts` can persist the index
+in a database folder, partitioned by subject: each subject's index is stored in
+an SQLite file, alongside a manifest of the size and modification time of the
+files it was built from.
+Only the indexes of subjects whose files (or the top-level files of the dataset,
+e.g., inherited sidecars) changed are rebuilt.
+The indexes also store the ``IntendedFor``/``InformedBy`` associations of
+files, so that :func:`get_fmaps` does not read any metadata.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+        >>> os.makedirs('ds/sub-01/func')
+        >>> os.makedirs('ds/sub-02/func')
+        >>> _ = Path('ds/dataset_description.json').write_text(
+        ...     '{"Name": "test", "BIDSVersion": "1.4.0"}')
+        >>> for sub in ('01', '02'):
+        ...     _ = Path('ds/sub-%s/func/sub-%s_task-rest_bold.nii.gz' % (sub, sub)).write_text('')
+
+"""
+import os
+import re
+import json
+from collections import defaultdict
+from tempfile import mkstemp
+
+
+def get_fmaps(boldref):
+    """Collect the fieldmaps associated to an EPI run, by type."""
+    fmaps = defaultdict(list, [])
+    for associated in boldref.get_associations(kind='InformedBy'):
+        if associated.suffix == 'epi':
+            fmaps[associated.suffix].append(associated)
+        # elif associated.suffix in ('phase', 'phasediff', 'fieldmap'):
+        #     fmaps['fieldmap'].append(associated)
+    return fmaps
+
+
+def collect_runs(layout, **query):
+    """
+    List the EPI runs matching a query, with their associated fieldmaps.
+
+    Returns a list of ``(boldref, fmaps)`` tuples, where ``fmaps`` is
+    the output of :func:`get_fmaps`.
+    """
+    return [(boldref, get_fmaps(boldref)) for boldref in layout.get(**query)]
+
+
+def get_layouts(bids_dir, database_dir=None, subjects=None, **kwargs):
+    """
+    Index a BIDS dataset, optionally reusing indexes persisted in ``database_dir``.
+
+    Without ``database_dir``, the whole dataset is indexed in memory.
+    Otherwise, one layout is returned for each of the ``subjects``
+    (all, by default), and only outdated indexes are rebuilt.
+    Keyword arguments are passed on to :class:`~bids.layout.BIDSLayout`.
+
+    >>> layouts = get_layouts('ds', 'db', validate=False)
+    >>> [layout.get_subjects() for layout in layouts]
+    [['01'], ['02']]
+    >>> sorted(os.listdir('db'))
+    ['sub-01.json', 'sub-01.sqlite', 'sub-02.json', 'sub-02.sqlite']
+    >>> [len(layout.get(suffix='bold')) for layout in get_layouts(
+    ...     'ds', 'db', subjects=['sub-02'], validate=False)]
+    [1]
+
+    """
+    from bids.layout import BIDSLayout
+
+    bids_dir = os.path.abspath(str(bids_dir))
+    if database_dir is None:
+        return [BIDSLayout(bids_dir, **kwargs)]
+
+    database_dir = os.path.abspath(str(database_dir))
+    os.makedirs(database_dir, exist_ok=True)
+    if subjects is None:
+        subjects = sorted(entry.name for entry in os.scandir(bids_dir)
+                          if entry.is_dir() and entry.name.startswith('sub-'))
+    return [_subject_layout(bids_dir, database_dir, subject[4:] if subject.startswith('sub-')
+                            else subject, **kwargs)
+            for subject in subjects]
+
+
+def _subject_layout(bids_dir, database_dir, subject, **kwargs):
+    """Load the persisted index of a subject, (re)building it if outdated."""
+    from bids import __version__ as bids_version
+    from bids.layout import BIDSLayout
+
+    # Skip the folders of all other subjects
+    ignore = list(kwargs.pop('ignore', None) or BIDSLayout._default_ignore)
+    ignore.append(re.compile(r'^%s/sub-(?!%s(/|$))' % (
+        re.escape(bids_dir), re.escape(subject))))
+
+    database_file = os.path.join(database_dir, 'sub-%s.sqlite' % subject)
+    manifest_file = os.path.join(database_dir, 'sub-%s.json' % subject)
+    manifest = {
+        'pybids': bids_version,
+        'options': sorted('%s=%r' % item for item in kwargs.items()),
+        'files': _fingerprint(bids_dir, subject),
+    }
+
+    if not os.path.exists(database_file) or _read_manifest(manifest_file) != manifest:
+        # Index in a temporary file, so that concurrent processes never read
+        # a partial index
+        tmp_file = os.path.join(database_dir, '.sub-%s-%d.sqlite' % (subject, os.getpid()))
+        layout = BIDSLayout(bids_dir, ignore=ignore, database_file=tmp_file,
+                            reset_database=True, **kwargs)
+        layout.session.close()
+        layout.session.get_bind().dispose()
+        os.replace(tmp_file, database_file)
+        _write_manifest(manifest_file, manifest)
+
+    return BIDSLayout(bids_dir, ignore=ignore, database_file=database_file, **kwargs)
+
+
+def _fingerprint(bids_dir, subject):
+    """Size and modification time of the files the index of a subject depends on."""
+    files = {}
+    for entry in os.scandir(bids_dir):  # Top-level files (e.g., inherited sidecars)
+        if entry.is_file():
+            stat = entry.stat()
+            files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+
+    for dirpath, _, filenames in os.walk(os.path.join(bids_dir, 'sub-%s' % subject)):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            stat = os.stat(path)
+            files[os.path.relpath(path, bids_dir)] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def _read_manifest(manifest_file):
+    try:
+        with open(manifest_file) as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest_file, manifest):
+    fd, tmpname = mkstemp(dir=os.path.dirname(manifest_file), prefix='.manifest-')
+    with os.fdopen(fd, 'w') as fobj:
+        json.dump(manifest, fobj)
+    os.replace(tmpname, manifest_file)
@@ -0,0 +1,232 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Tensor-product B-Spline approximation of fieldmaps.
+
+The smoothed field is modeled as :math:`f(\\mathbf{x}) = \\sum_k c_k
+\\beta(\\mathbf{x} - \\mathbf{x}_k)`, where :math:`\\beta` is the tensor
+product of three 1D cubic B-Spline kernels and :math:`\\mathbf{x}_k` are
+the knots of a regular grid of control points.
+The coefficients :math:`\\mathbf{c}` are the (weighted) least-squares fit
+of the data :math:`\\mathbf{f}`, i.e., they solve the normal equations
+
+.. math::
+
+    (\\mathbf{A}^\\top \\mathbf{W} \\mathbf{A} + \\lambda \\mathbf{I})\\, \\mathbf{c} =
+    \\mathbf{A}^\\top \\mathbf{W} \\mathbf{f},
+
+where :math:`\\mathbf{A} = \\mathbf{B}_x \\otimes \\mathbf{B}_y \\otimes \\mathbf{B}_z`
+is the design matrix.
+The design matrix is never built densely: because it is a Kronecker product of
+three narrow-banded 1D design matrices, the (sparse) normal matrix is accumulated
+with separable contractions, and the system is solved with conjugate gradients.
+The smoothed field is evaluated back on the grid with three separable 1D products.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nb
+
+BAND = 7  # Number of overlapping cubic B-Spline basis functions per axis
+
+
+def bspline_kernel(x):
+    """
+    Evaluate the cubic B-Spline kernel.
+
+    >>> bspline_kernel(np.array([-2., -1., 0., 0.5, 1., 2.])).round(4).tolist()
+    [0.0, 0.1667, 0.6667, 0.4792, 0.1667, 0.0]
+
+    """
+    x = np.abs(np.asanyarray(x, dtype=float))
+    out = np.zeros_like(x)
+    near = x < 1.0
+    far = (x >= 1.0) & (x < 2.0)
+    out[near] = (4.0 - 6.0 * x[near] ** 2 + 3.0 * x[near] ** 3) / 6.0
+    out[far] = (2.0 - x[far]) ** 3 / 6.0
+    return out
+
+
+def bspline_design_1d(npoints, spacing):
+    """
+    Build the 1D design matrix of a cubic B-Spline grid.
+
+    Control points are regularly spaced by ``spacing`` (in voxels), the first
+    one placed one spacing before the first voxel, so that the span of the
+    basis covers the whole axis.
+
+    >>> bspline_design_1d(10, 4.5).shape
+    (10, 5)
+    >>> np.allclose(bspline_design_1d(10, 4.5).sum(1), 1.0)
+    True
+
+    """
+    ncoeff = int(np.ceil((npoints - 1) / spacing)) + 3
+    knots = (np.arange(ncoeff) - 1) * spacing
+    return bspline_kernel((np.arange(npoints)[:, np.newaxis] - knots) / spacing)
+
+
+class BSplineFieldmap(object):
+    """
+    Approximate a fieldmap with a smooth, tensor-product cubic B-Spline.
+
+    >>> data = np.fromfunction(lambda i, j, k: 0.1 * i + 0.05 * j * k,
+    ...                        (20, 20, 10))
+    >>> bsp = BSplineFieldmap(nb.Nifti1Image(data, np.eye(4)),
+    ...                       knots_zooms=[5., 5., 5.])
+    >>> bsp.fit()
+    >>> np.allclose(bsp.get_smoothed().get_fdata(), data, atol=1e-2)
+    True
+
+    """
+
+    def __init__(self, fmapnii, weights=None, knots_zooms=None, regularization=1e-6,
+                 tol=1e-8, njobs=1):
+        """
+        Set up the B-Spline grid.
+
+        **Parameters**:
+
+            fmapnii : nibabel image
+                The (3D) fieldmap to be approximated.
+            weights : array_like
+                Nonnegative weights of each voxel in the fit (e.g., a brain mask).
+            knots_zooms : list of float
+                Distance between control points along each axis, in mm.
+            regularization : float
+                Ridge penalty, relative to the average diagonal of the normal matrix,
+                that keeps the coefficients outside the support of the weights at zero.
+            tol : float
+                Relative tolerance of the conjugate-gradient solver.
+            njobs : int
+                Number of threads to accumulate the normal equations.
+
+        """
+        if isinstance(fmapnii, str):
+            fmapnii = nb.load(fmapnii)
+
+        self._fmapnii = fmapnii
+        self._data = np.squeeze(np.asanyarray(fmapnii.dataobj)).astype(np.float32)
+        if self._data.ndim != 3:
+            raise ValueError('Only 3D fieldmaps can be approximated with B-Splines.')
+
+        self._weights = np.ones(self._data.shape, dtype=np.float32)
+        if weights is not None:
+            self._weights = np.squeeze(np.asanyarray(weights)).astype(np.float32)
+
+        if knots_zooms is None:
+            knots_zooms = [20., 20., 20.]
+        zooms = np.array(fmapnii.header.get_zooms()[:3], dtype=float)
+        self._spacing = np.array(knots_zooms, dtype=float) / zooms
+        self._alpha = regularization
+        self._tol = tol
+        self._njobs = max(1, int(njobs or 1))
+
+        self._design = [bspline_design_1d(n, s)
+                        for n, s in zip(self._data.shape, self._spacing)]
+        self._coeffs = None
+
+    @property
+    def coeffs_shape(self):
+        """Number of control points along each axis."""
+        return tuple(b.shape[1] for b in self._design)
+
+    def _normal_matrix(self):
+        """Accumulate the sparse normal matrix :math:`A^T W A` separably."""
+        from scipy import sparse
+
+        px, py, pz = [_band_products(b) for b in self._design]
+
+        # Contract the z-axis once for all: (Nx, Ny, Kz, BAND)
+        t1 = np.tensordot(self._weights, pz, axes=([2], [0]))
+
+        def _partial(chunk):
+            t2 = np.tensordot(t1[chunk], py, axes=([1], [0]))  # (nx, Kz, BAND, Ky, BAND)
+            return np.tensordot(px[chunk], t2, axes=([0], [0]))
+
+        bands = sum(self._map_chunks(_partial, t1.shape[0]))
+        # Reorder as (Kx, BAND, Ky, BAND, Kz, BAND)
+        bands = bands.transpose(0, 1, 4, 5, 2, 3)
+
+        kshape = self.coeffs_shape
+        idx = np.indices(bands.shape)
+        rows = np.ravel_multi_index((idx[0], idx[2], idx[4]), kshape)
+        cols = [idx[2 * d] + idx[2 * d + 1] - BAND // 2 for d in range(3)]
+        valid = np.all([(c >= 0) & (c < k) for c, k in zip(cols, kshape)], axis=0)
+        valid &= bands != 0
+        cols = np.ravel_multi_index(tuple(c[valid] for c in cols), kshape)
+
+        ncoeff = int(np.prod(kshape))
+        return sparse.csr_matrix((bands[valid], (rows[valid], cols)),
+                                 shape=(ncoeff, ncoeff))
+
+    def _map_chunks(self, func, length):
+        """Run ``func`` on contiguous chunks of the first axis."""
+        bounds = np.linspace(0, length, min(self._njobs, length) + 1).astype(int)
+        chunks = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+        if len(chunks) == 1:
+            return [func(chunks[0])]
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            return list(pool.map(func, chunks))
+
+    def fit(self):
+        """Solve the weighted least-squares fit of the B-Spline coefficients."""
+        from scipy import sparse
+        from scipy.sparse.linalg import cg
+
+        normal = self._normal_matrix()
+        diag = normal.diagonal()
+        normal = normal + sparse.identity(normal.shape[0], format='csr') * (
+            self._alpha * max(diag.mean(), np.finfo(float).eps))
+
+        rhs = _apply_transposed(self._weights * self._data, self._design)
+        cg_args = {
+            'M': sparse.diags(1.0 / normal.diagonal()),
+            'maxiter': 10 * normal.shape[0],
+        }
+        try:
+            coeffs, info = cg(normal, rhs.reshape(-1), rtol=self._tol, **cg_args)
+        except TypeError:  # SciPy < 1.12
+            coeffs, info = cg(normal, rhs.reshape(-1), tol=self._tol, **cg_args)
+        if info > 0:
+            from nipype import logging
+            logging.getLogger('nipype.interface').warning(
+                'B-Spline fit did not converge after %d iterations', info)
+        self._coeffs = coeffs.reshape(self.coeffs_shape)
+
+    def get_coeffs(self):
+        """Return the grid of fitted coefficients."""
+        if self._coeffs is None:
+            raise RuntimeError('The B-Spline model has not been fit yet.')
+        return self._coeffs
+
+    def get_smoothed(self):
+        """Evaluate the fitted B-Spline on the fieldmap grid."""
+        bx, by, bz = self._design
+        coeffs = self.get_coeffs()
+        # Contract z and y on the coefficients grid, then x: (Kx, Ny, Nz) -> (Nx, Ny, Nz)
+        tmp = np.tensordot(np.tensordot(coeffs, bz, axes=([2], [1])), by, axes=([1], [1]))
+        tmp = tmp.transpose(0, 2, 1)
+        data = np.tensordot(bx, tmp, axes=([1], [0])).astype(np.float32)
+
+        hdr = self._fmapnii.header.copy()
+        hdr.set_data_dtype(np.float32)
+        return nb.Nifti1Image(data, self._fmapnii.affine, hdr)
+
+
+def _band_products(design):
+    """Products of each basis function with its overlapping neighbors: (N, K, BAND)."""
+    half = BAND // 2
+    padded = np.pad(design, [(0, 0), (half, half)], mode='constant')
+    ncoeff = design.shape[1]
+    return np.stack([design * padded[:, j:j + ncoeff] for j in range(BAND)], axis=-1)
+
+
+def _apply_transposed(data, design):
+    """Compute :math:`A^T f` with three separable contractions."""
+    bx, by, bz = design
+    tmp = np.tensordot(data, bz, axes=([2], [0]))  # (Nx, Ny, Kz)
+    tmp = np.tensordot(tmp, by, axes=([1], [0]))  # (Nx, Kz, Ky)
+    tmp = np.tensordot(bx, tmp, axes=([0], [0]))  # (Kx, Kz, Ky)
+    return tmp.transpose(0, 2, 1)
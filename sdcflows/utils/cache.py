@@ -0,0 +1,319 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+A persistent, content-addressed store of estimated fieldmaps.
+
+Estimated fieldmaps are indexed by a hash of the contents of the input images,
+the metadata relevant to the estimation, and the parameters of the estimator
+(see :func:`fieldmap_key`), so that they can be reused across *sdcflows*
+invocations, regardless of the nipype working directory.
+
+Each entry is a folder ``<root>/<key[:2]>/<key>/`` with the stored files
+and a ``manifest.json`` file.
+Entries are first written into a temporary folder and then atomically
+renamed, so that concurrent processes either find a complete entry or none.
+The total size of the store is bounded with a least-recently-used (LRU)
+eviction policy, serialized across processes with a lock file.
+The bound is saved in the store (``config.json``), so that opening it by its
+path (e.g., in the processes running nodes) enforces the same bound.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+
+"""
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from tempfile import mkdtemp
+from time import time
+
+from .. import __version__
+
+#: Metadata entries that participate in the estimation of fieldmaps
+METADATA_KEYS = ('PhaseEncodingDirection', 'EchoTime1', 'EchoTime2', 'EchoTime',
+                 'TotalReadoutTime', 'EffectiveEchoSpacing')
+_HASH_MEMO = {}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Calculate the SHA256 hash of the contents of a file (memoized by size and time).
+
+    >>> Path('a.txt').write_text('sdcflows') and None
+    >>> file_hash('a.txt')[:12]
+    'd919d1eac002'
+
+    """
+    path = os.path.realpath(str(path))
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _HASH_MEMO:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fobj:
+            for chunk in iter(lambda: fobj.read(chunk_size), b''):
+                sha.update(chunk)
+        _HASH_MEMO[memo_key] = sha.hexdigest()
+    return _HASH_MEMO[memo_key]
+
+
+def split_cache_inputs(inputs):
+    """
+    Split the inputs identifying an estimation into files, metadata and parameters.
+
+    Paths to existing files (also within lists and tuples) are hashed by their
+    contents, dictionaries are taken as metadata, and other values as parameters
+    of the estimator (see :func:`fieldmap_key`).
+
+    >>> Path('a.txt').write_text('sdcflows') and None
+    >>> split_cache_inputs({'fmaps_epi': [('a.txt', 'j-')], 'bold_pe_dir': 'j',
+    ...                     'metadata': {'EchoTime1': 0.005}})
+    (['a.txt'], [{'EchoTime1': 0.005}], {'bold_pe_dir': 'j'})
+
+    """
+    in_files, metadata, params = [], [], {}
+    for name, value in sorted(inputs.items()):
+        if isinstance(value, dict):
+            metadata.append(value)
+        elif isinstance(value, (list, tuple)):
+            in_files += _find_files(value)
+            metadata += [v for v in value if isinstance(v, dict)]
+        elif _find_files([value]):
+            in_files.append(str(value))
+        else:
+            params[name] = value
+    return in_files, metadata, params
+
+
+def fieldmap_key(in_files, metadata=None, estimator=None, params=None):
+    """
+    Calculate the key of a fieldmap estimation.
+
+    Parameters
+    ----------
+    in_files : list of os.pathlike
+        The input images of the estimation (order is not relevant).
+    metadata : dict or list of dict
+        Metadata of the inputs (only :data:`METADATA_KEYS` are considered).
+    estimator : str
+        Name of the estimation strategy.
+    params : dict
+        Parameters of the estimator.
+
+    >>> Path('a.txt').write_text('sdcflows') and None
+    >>> key = fieldmap_key(['a.txt'], {'EchoTime1': 0.005, 'EchoTime2': 0.00746,
+    ...                                'RepetitionTime': 2.0}, 'phdiff')
+    >>> key == fieldmap_key(['a.txt'], {'EchoTime1': 0.005, 'EchoTime2': 0.00746},
+    ...                     'phdiff')
+    True
+    >>> key == fieldmap_key(['a.txt'], {'EchoTime1': 0.005, 'EchoTime2': 0.00746},
+    ...                     'phdiff', {'unwrap_method': 'laplacian'})
+    False
+
+    """
+    if isinstance(metadata, dict):
+        metadata = [metadata]
+
+    description = {
+        'inputs': sorted(file_hash(f) for f in in_files),
+        'metadata': sorted(
+            json.dumps({k: meta[k] for k in METADATA_KEYS if k in meta}, sort_keys=True)
+            for meta in metadata or []),
+        'estimator': estimator,
+        'params': params or {},
+        'version': __version__,
+    }
+    return hashlib.sha256(
+        json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class FieldmapCache:
+    """
+    A size-bounded, process-safe store of estimated fieldmaps.
+
+    >>> Path('fmap.nii.gz').write_bytes(b'0' * 1000) and None
+    >>> cache = FieldmapCache('cache', max_size=1500)
+    >>> cache.get('0123abcd') is None
+    True
+    >>> entry = cache.put('0123abcd', {'fmap': 'fmap.nii.gz'})
+    >>> sorted(cache.get('0123abcd'))
+    ['fmap']
+    >>> _ = cache.put('4567abcd', {'fmap': 'fmap.nii.gz'})
+    >>> cache.get('0123abcd') is None  # The least recently used entry was evicted
+    True
+    >>> FieldmapCache('cache').max_size  # The bound is saved in the store
+    1500
+
+    """
+
+    def __init__(self, root, max_size=None, keep_recent=None):
+        """
+        Open (or create) a fieldmap store.
+
+        Parameters
+        ----------
+        root : os.pathlike
+            Path to the store.
+        max_size : int
+            Maximum size of the store (in bytes). If ``None``, the bound saved
+            in the store is used (unbounded if none was ever set).
+        keep_recent : float
+            Entries accessed within the last ``keep_recent`` seconds are never
+            evicted (e.g., to protect fieldmaps looked up by a workflow
+            that has not finished yet). If ``None``, the value saved in the
+            store is used (``0`` if none was ever set).
+
+        """
+        self.root = Path(root).absolute()
+        (self.root / 'tmp').mkdir(parents=True, exist_ok=True)
+
+        config = self._read_config()
+        if max_size is not None or keep_recent is not None:
+            config.update({key: value for key, value in (
+                ('max_size', max_size), ('keep_recent', keep_recent)) if value is not None})
+            tmpfile = Path(mkdtemp(prefix='cfg-', dir=str(self.root / 'tmp'))) / 'config.json'
+            tmpfile.write_text(json.dumps(config, indent=2))
+            os.replace(str(tmpfile), str(self.root / 'config.json'))
+            shutil.rmtree(str(tmpfile.parent), ignore_errors=True)
+        self.max_size = config.get('max_size')
+        self.keep_recent = config.get('keep_recent', 0)
+
+    def _read_config(self):
+        try:
+            return json.loads((self.root / 'config.json').read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _entry(self, key):
+        return self.root / key[:2] / key
+
+    def get(self, key):
+        """Return a dictionary of the files stored under ``key`` (``None`` if missing)."""
+        entry = self._entry(key)
+        try:
+            manifest = json.loads((entry / 'manifest.json').read_text())
+            os.utime(str(entry))  # Record the access for LRU eviction
+        except (OSError, ValueError):
+            return None
+
+        files = {name: str(entry / fname) for name, fname in manifest['files'].items()}
+        if not all(os.path.exists(f) for f in files.values()):
+            return None
+        return files
+
+    def put(self, key, files):
+        """
+        Store a set of files under ``key`` and return the stored copies.
+
+        ``files`` is a dictionary mapping names (e.g., ``'fmap'``) onto paths.
+        If another process stored the same key first, its entry is kept.
+        """
+        tmpdir = Path(mkdtemp(prefix='put-', dir=str(self.root / 'tmp')))
+        manifest = {'files': {}, 'created': time(), 'version': __version__}
+        for name, path in files.items():
+            fname = '%s_%s' % (name, os.path.basename(str(path)))
+            shutil.copyfile(str(path), str(tmpdir / fname))
+            manifest['files'][name] = fname
+        (tmpdir / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+
+        entry = self._entry(key)
+        entry.parent.mkdir(exist_ok=True)
+        try:
+            os.rename(str(tmpdir), str(entry))
+        except OSError:  # Entry already exists
+            shutil.rmtree(str(tmpdir), ignore_errors=True)
+
+        self.evict(protect=key)
+        return self.get(key)
+
+    def size(self):
+        """Calculate the total size (in bytes) of the stored entries."""
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self, protect=None):
+        """Remove the least recently used entries until the store fits ``max_size``."""
+        if self.max_size is None:
+            return
+
+        with _FileLock(self.root / '.lock'):
+            entries = sorted(self._entries(), key=lambda e: e[1])
+            total = sum(size for _, _, size in entries)
+            now = time()
+            for entry, atime, size in entries:
+                if total <= self.max_size:
+                    break
+                if entry.name == protect or now - atime < self.keep_recent:
+                    continue
+                trash = Path(mkdtemp(prefix='del-', dir=str(self.root / 'tmp')))
+                try:
+                    os.rename(str(entry), str(trash / entry.name))
+                except OSError:
+                    continue
+                finally:
+                    shutil.rmtree(str(trash), ignore_errors=True)
+                total -= size
+
+    def _entries(self):
+        """List entries with their last access time and size."""
+        for prefix in self.root.iterdir():
+            if len(prefix.name) != 2 or not prefix.is_dir():
+                continue
+            for entry in prefix.iterdir():
+                try:
+                    atime = entry.stat().st_mtime
+                    size = sum(f.stat().st_size for f in entry.iterdir())
+                except OSError:  # Removed by a concurrent process
+                    continue
+                yield entry, atime, size
+
+
+class _FileLock:
+    """An exclusive, inter-process lock on a file (a no-op where unsupported)."""
+
+    def __init__(self, path):
+        self._path = str(path)
+        self._fobj = None
+
+    def __enter__(self):
+        self._fobj = open(self._path, 'a')
+        try:
+            import fcntl
+            fcntl.flock(self._fobj.fileno(), fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        return self
+
+    def __exit__(self, *args):
+        self._fobj.close()  # Releases the lock
+        self._fobj = None
+
+
+def _find_files(values):
+    """List the paths to existing files within a list (or tuple) of values."""
+    files = []
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            files += _find_files(value)
+        elif isinstance(value, (str, Path)) and os.path.isfile(str(value)):
+            files.append(str(value))
+    return files
+
+
+def lookup_fieldmap(cache, in_files, metadata=None, estimator=None, params=None):
+    """
+    Look up a finished estimation in a store (``cache`` may be a path).
+
+    Returns a dictionary of stored files, or ``None`` when the estimation
+    was not found.
+
+    >>> Path('a.txt').write_text('sdcflows') and None
+    >>> lookup_fieldmap('cache', ['a.txt'], estimator='fmap') is None
+    True
+
+    """
+    if not isinstance(cache, FieldmapCache):
+        cache = FieldmapCache(cache)
+    return cache.get(fieldmap_key(in_files, metadata, estimator, params))
@@ -0,0 +1,132 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Readout parameters of EPI scans.
+
+The *effective echo spacing* and the *total readout time* of an EPI scan
+are calculated from its metadata, and (when they are not directly
+set) the number of voxels along the phase-encoding axis.
+The latter is read from the NIfTI header only, and memoized for the lifetime
+of the process, so that readout parameters can be resolved at workflow-build
+time (:func:`resolve_readout`), for all the EPI scans of a BIDS dataset at once
+(:func:`resolve_readouts`), instead of within nipype nodes.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+        >>> import nibabel as nb
+        >>> nb.Nifti1Image(np.zeros((90, 90, 60)), None, None).to_filename('epi.nii.gz')
+
+"""
+import os
+
+WATER_FAT_PPM = 3.4  # water-fat difference in ppm
+GYROMAGNETIC_MHZ_T = 42.57  # gyromagnetic ratio for proton (1H) in MHz/T
+EPI_SUFFIXES = ('bold', 'sbref', 'epi', 'dwi', 'asl')
+
+_SHAPE_MEMO = {}
+
+
+def image_shape(in_file):
+    """
+    Read the shape of a NIfTI image from its header (memoized by size and time).
+
+    >>> image_shape('epi.nii.gz')
+    (90, 90, 60)
+
+    """
+    import nibabel as nb
+
+    path = os.path.realpath(str(in_file))
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _SHAPE_MEMO:
+        _SHAPE_MEMO[memo_key] = tuple(
+            int(s) for s in nb.load(path).header.get_data_shape())
+    return _SHAPE_MEMO[memo_key]
+
+
+def get_readout(metadata, in_file=None):
+    """
+    Calculate the effective echo spacing and the total readout time of an EPI scan.
+
+    See :func:`~sdcflows.interfaces.fmap.get_ees` and
+    :func:`~sdcflows.interfaces.fmap.get_trt` for the definitions.
+    The image header is only read when the metadata are insufficient, and
+    parameters that cannot be calculated are returned as ``None``.
+
+    >>> get_readout({'EffectiveEchoSpacing': 0.00059})
+    (0.00059, None)
+    >>> get_readout({'EffectiveEchoSpacing': 0.00059, 'PhaseEncodingDirection': 'j-',
+    ...              'ParallelReductionFactorInPlane': 2}, 'epi.nii.gz')
+    (0.00059, 0.02596)
+
+    """
+    ees = metadata.get('EffectiveEchoSpacing', None)
+    trt = metadata.get('TotalReadoutTime', None)
+    if ees is not None and trt is not None:
+        return ees, trt
+
+    wfs = metadata.get('WaterFatShift', None)
+    wfs_hz = None
+    if wfs is not None:
+        wfs_hz = metadata['MagneticFieldStrength'] * WATER_FAT_PPM * GYROMAGNETIC_MHZ_T
+
+    etl = None
+    if in_file is not None and 'PhaseEncodingDirection' in metadata:
+        acc = float(metadata.get('ParallelReductionFactorInPlane', 1.0))
+        axis = 'ijk'.index(metadata['PhaseEncodingDirection'][0])
+        etl = image_shape(in_file)[axis] // acc
+
+    out_ees, out_trt = ees, trt
+    if ees is None:
+        if trt is not None and etl is not None:
+            out_ees = trt / (etl - 1)
+        elif wfs is not None and etl is not None:
+            out_ees = wfs / (wfs_hz * etl)
+
+    if trt is None:
+        if ees is not None:
+            out_trt = ees * (etl - 1) if etl is not None else None
+        elif wfs is not None:
+            out_trt = wfs / wfs_hz
+
+    return out_ees, out_trt
+
+
+def resolve_readout(metadata, in_file=None):
+    """
+    Return a copy of the metadata with the readout parameters filled in.
+
+    >>> meta = resolve_readout({'TotalReadoutTime': 0.02596, 'PhaseEncodingDirection': 'j-',
+    ...                         'ParallelReductionFactorInPlane': 2}, 'epi.nii.gz')
+    >>> meta['EffectiveEchoSpacing']
+    0.00059
+
+    """
+    metadata = dict(metadata)
+    ees, trt = get_readout(metadata, in_file)
+    if ees is not None:
+        metadata['EffectiveEchoSpacing'] = ees
+    if trt is not None:
+        metadata['TotalReadoutTime'] = trt
+    return metadata
+
+
+def resolve_readouts(layout, suffix=EPI_SUFFIXES, **filters):
+    """
+    Resolve the readout parameters of all the EPI scans of a BIDS dataset.
+
+    Returns a dictionary mapping paths onto metadata with the readout parameters
+    filled in (:func:`resolve_readout`).
+    Scans without phase-encoding information are skipped.
+    """
+    readouts = {}
+    for bids_file in layout.get(suffix=list(suffix), extension=['.nii', '.nii.gz'],
+                                **filters):
+        metadata = bids_file.get_metadata()
+        if 'PhaseEncodingDirection' not in metadata:
+            continue
+        readouts[bids_file.path] = resolve_readout(metadata, bids_file.path)
+    return readouts
@@ -0,0 +1,161 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Strategies to hash the file inputs of nodes.
+
+nipype decides whether a node must run by hashing its inputs, and files are
+hashed either by their contents (``content``), which reads them whole, or by
+their size and modification time (``timestamp``).
+:func:`set_hash_strategy` chooses the method node by node: with the ``mixed``
+strategy, only the nodes given raw input files (e.g., from the BIDS dataset)
+hash contents, while nodes reading the intermediate results of other nodes
+(in the working directory, where they are only written by nipype) hash
+timestamps.
+The method is set in the configuration of each node, so that the processes
+running nodes hash them the same way.
+
+Hashing contents can also be memoized, within a ``with memoize_content_hashes():``
+block (e.g., around ``workflow.run``): each file is then read once, as long as its
+size and modification time are unchanged.
+Only the hashes calculated by the process entering the block are memoized (e.g.,
+when the scheduler checks whether nodes are cached, or runs them in-process);
+the worker processes of the ``MultiProc`` plugin hash their inputs as usual.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+        >>> _ = Path('data.txt').write_text('some data')
+
+"""
+import os
+from contextlib import contextmanager
+
+#: The hashing strategies of nodes
+STRATEGIES = ('content', 'timestamp', 'mixed')
+
+_HASHES = {}
+
+
+def set_hash_strategy(workflow, strategy, raw_dirs=None):
+    """
+    Set the method nodes hash their file inputs with.
+
+    ``content`` and ``timestamp`` set the method of all nodes, whereas ``mixed``
+    hashes contents only for the nodes given files within ``raw_dirs``.
+    Returns the (full) names of the nodes hashing contents.
+
+    >>> from nipype.pipeline import engine as pe
+    >>> from nipype.interfaces import utility as niu
+    >>> wf = pe.Workflow(name='wf')
+    >>> read = pe.Node(niu.Function(function=lambda in_file: in_file), name='read')
+    >>> read.inputs.in_file = os.path.abspath('data.txt')
+    >>> copy = pe.Node(niu.Function(function=lambda in_file: in_file), name='copy')
+    >>> wf.connect(read, 'out', copy, 'in_file')
+    >>> set_hash_strategy(wf, 'mixed', raw_dirs=[os.getcwd()])
+    ['wf.read']
+    >>> copy.config['execution']['hash_method']
+    'timestamp'
+
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError('Unknown hashing strategy "%s".' % strategy)
+
+    if strategy == 'mixed':
+        from .workdir import executed_graph
+
+        raw_dirs = [os.path.join(os.path.abspath(str(d)), '') for d in raw_dirs or []]
+        content = {node.fullname for node in executed_graph(workflow).nodes()
+                   if any(f.startswith(tuple(raw_dirs))
+                          for f in _input_files(node.inputs.get()))}
+    else:
+        content = None
+
+    hashed = []
+    for name, node in _iter_nodes(workflow):
+        method = strategy if content is None else (
+            'content' if name in content else 'timestamp')
+        node.config = node.config or {}
+        node.config.setdefault('execution', {})['hash_method'] = method
+        if method == 'content':
+            hashed.append(name)
+    return sorted(hashed)
+
+
+def hash_infile(afile, chunk_len=8192, crypto=None, raise_notfound=False):
+    """
+    Hash the contents of a file, once per process while its size and time do not change.
+
+    A memoized version of :func:`nipype.utils.filemanip.hash_infile`, which it
+    calls (hence, returning the same values).
+
+    >>> hash_infile('data.txt')
+    '1e50210a0202497fb79bc38b6ade6c34'
+    >>> any(key[0] == os.path.realpath('data.txt') for key in _HASHES)
+    True
+
+    """
+    from nipype.utils import filemanip
+
+    try:
+        stat = os.stat(afile)
+    except OSError:
+        return filemanip.hash_infile(afile, raise_notfound=raise_notfound)
+
+    key = (os.path.realpath(afile), stat.st_dev, stat.st_ino, stat.st_size,
+           stat.st_mtime_ns, chunk_len, crypto)
+    if key not in _HASHES:
+        kwargs = {} if crypto is None else {'crypto': crypto}
+        _HASHES[key] = filemanip.hash_infile(afile, chunk_len=chunk_len, **kwargs)
+    return _HASHES[key]
+
+
+@contextmanager
+def memoize_content_hashes():
+    """
+    Make nipype hash the contents of input files with :func:`hash_infile`, within the block.
+
+    nipype's own hashing is restored, and the memoized hashes dropped, on exit.
+
+    >>> from nipype.interfaces.base import specs
+    >>> original = specs.hash_infile
+    >>> with memoize_content_hashes():
+    ...     specs.hash_infile is hash_infile
+    True
+    >>> specs.hash_infile is original
+    True
+
+    """
+    from nipype.interfaces.base import specs
+
+    original = specs.hash_infile
+    specs.hash_infile = hash_infile
+    try:
+        yield
+    finally:
+        specs.hash_infile = original
+        _HASHES.clear()
+
+
+def _iter_nodes(workflow, prefix=None):
+    """Iterate over the nodes of a workflow, with their full names."""
+    from nipype.pipeline.engine import Workflow
+
+    prefix = workflow.name if prefix is None else '.'.join((prefix, workflow.name))
+    for node in workflow._graph.nodes():
+        if isinstance(node, Workflow):
+            for item in _iter_nodes(node, prefix):
+                yield item
+        else:
+            yield '.'.join((prefix, node.name)), node
+
+
+def _input_files(value):
+    """List the absolute paths of the files in a structure of inputs."""
+    if isinstance(value, dict):
+        return [f for v in value.values() for f in _input_files(v)]
+    if isinstance(value, (list, tuple)):
+        return [f for v in value for f in _input_files(v)]
+    if isinstance(value, str) and os.path.isfile(value):
+        return [os.path.abspath(value)]
+    return []
@@ -0,0 +1,209 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Storage of the NIfTI images written by the interfaces of *SDCFlows*.
+
+The intermediate results of workflows are read back only by the next nodes, so
+compressing them (and decompressing them right after) is mostly wasted CPU.
+:func:`intermediate_fname` names the images written by the native interfaces:
+compressed (``.nii.gz``, the default) or, after ``set_compress_intermediates(False)``
+(or with the environment variable ``SDCFLOWS_COMPRESS_INTERMEDIATES=0``), uncompressed
+(``.nii``), which *NiBabel* memory-maps when loading instead of decompressing.
+Final derivatives are compressed when they are stored (e.g., by
+:class:`~niworkflows.interfaces.bids.DerivativesDataSink`).
+
+Compressed images are written with :func:`to_filename` (or :func:`open_image`,
+to stream them), which compresses independent blocks of data in a pool of
+threads (:class:`ParallelGzipFile`), and emits one standard gzip stream.
+The compression level (``1`` by default, as *NiBabel*'s) is set with
+:func:`set_gzip_level` (or the environment variable ``SDCFLOWS_GZIP_LEVEL``).
+
+The settings are kept in the environment, so that the processes running nodes
+(which inherit them) write the same formats.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+
+"""
+import io
+import os
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+#: The environment variable holding the setting
+COMPRESS_ENV = 'SDCFLOWS_COMPRESS_INTERMEDIATES'
+#: The environment variable holding the gzip compression level
+GZIP_LEVEL_ENV = 'SDCFLOWS_GZIP_LEVEL'
+
+
+def compress_intermediates():
+    """Whether the intermediate images are gzip-compressed."""
+    return os.getenv(COMPRESS_ENV, '1').lower() not in ('0', 'false', 'no', 'off')
+
+
+def set_compress_intermediates(compress=True):
+    """Set whether intermediate images are gzip-compressed (for this process and its children)."""
+    os.environ[COMPRESS_ENV] = '1' if compress else '0'
+
+
+def intermediate_fname(fname, prefix='', suffix='', newpath=None):
+    """
+    Generate the name of an intermediate image, as :func:`~nipype.utils.filemanip.fname_presuffix`.
+
+    The extension follows :func:`compress_intermediates`, regardless of that of ``fname``.
+
+    >>> intermediate_fname('/data/sub-01_epi.nii', suffix='_rad', newpath='/work')
+    '/work/sub-01_epi_rad.nii.gz'
+    >>> set_compress_intermediates(False)
+    >>> intermediate_fname('/data/sub-01_epi.nii.gz', suffix='_rad')
+    '/data/sub-01_epi_rad.nii'
+    >>> set_compress_intermediates(True)
+
+    """
+    from nipype.utils.filemanip import split_filename
+
+    pth, base, _ = split_filename(str(fname))
+    if newpath is not None:
+        pth = os.path.abspath(str(newpath))
+    ext = '.nii.gz' if compress_intermediates() else '.nii'
+    return os.path.join(pth, prefix + base + suffix + ext)
+
+
+def gzip_level():
+    """The level of gzip compression (1 to 9)."""
+    return int(os.getenv(GZIP_LEVEL_ENV, '1'))
+
+
+def set_gzip_level(level):
+    """Set the level of gzip compression (for this process and its children)."""
+    if not 0 <= int(level) <= 9:
+        raise ValueError('Invalid gzip compression level %s.' % level)
+    os.environ[GZIP_LEVEL_ENV] = str(int(level))
+
+
+class ParallelGzipFile(io.BufferedIOBase):
+    """
+    A write-only gzip file, whose blocks of data are compressed in a pool of threads.
+
+    Each block is deflated independently (the compression of zlib runs
+    concurrently, without holding the GIL), primed with the 32kB of data before
+    it, and flushed to a byte boundary, so that concatenating the compressed
+    blocks gives one single, standard deflate stream (as written by *pigz*).
+
+    >>> data = os.urandom(1000) * 2000
+    >>> with ParallelGzipFile('data.gz', num_threads=4, block_size=2 ** 18) as fobj:
+    ...     _ = fobj.write(data)
+    >>> import gzip
+    >>> with gzip.open('data.gz') as fobj:
+    ...     fobj.read() == data
+    True
+    >>> os.path.getsize('data.gz') < len(data) // 10
+    True
+
+    """
+
+    def __init__(self, filename, num_threads=1, level=None, block_size=2 ** 20):
+        self.name = str(filename)
+        self.level = gzip_level() if level is None else level
+        self.block_size = block_size
+        self._num_threads = max(1, num_threads)
+        self._fobj = open(self.name, 'wb')
+        # Header: magic, deflate, no flags, no time, no extra flags, unknown OS
+        self._fobj.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+        self._pool = ThreadPoolExecutor(max_workers=self._num_threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._dictionary = b''
+        self._crc = 0
+        self._size = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def tell(self):
+        return self._size + len(self._buffer)
+
+    def seek(self, offset, whence=0):
+        if whence != 0 or offset != self.tell():
+            raise OSError('ParallelGzipFile does not support seeking.')
+        return offset
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._fobj.write(self._pending.popleft().result())
+            self._fobj.write(struct.pack('<II', self._crc & 0xffffffff,
+                                         self._size & 0xffffffff))
+        finally:
+            self._pool.shutdown()
+            self._fobj.close()
+            super().close()
+
+    def _submit(self, block, last):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(self._pool.submit(
+            _deflate, block, self._dictionary, self.level, last))
+        self._dictionary = block[-32768:]
+        # Keep the compressed blocks pending within bounds
+        while len(self._pending) > 2 * self._num_threads:
+            self._fobj.write(self._pending.popleft().result())
+
+
+def open_image(filename, num_threads=1, level=None):
+    """Open a file to write an image, compressed with :class:`ParallelGzipFile` if ``.gz``."""
+    if str(filename).endswith('.gz'):
+        return ParallelGzipFile(filename, num_threads=num_threads, level=level)
+    return open(str(filename), 'wb')
+
+
+def to_filename(img, filename, num_threads=1, level=None):
+    """
+    Write a (single-file) NIfTI image, compressing it in parallel if ``.gz``.
+
+    >>> import numpy as np
+    >>> import nibabel as nb
+    >>> img = nb.Nifti1Image(np.arange(24000, dtype='f4').reshape(20, 30, 40), np.eye(4))
+    >>> to_filename(img, 'img.nii.gz', num_threads=2)
+    >>> np.array_equal(nb.load('img.nii.gz').get_fdata(), img.get_fdata())
+    True
+
+    """
+    import nibabel as nb
+
+    filename = str(filename)
+    if not filename.endswith('.gz'):
+        img.to_filename(filename)
+        return
+
+    with ParallelGzipFile(filename, num_threads=num_threads, level=level) as fobj:
+        img.to_file_map({'image': nb.FileHolder(filename=filename, fileobj=fobj)})
+
+
+def _deflate(block, dictionary, level, last):
+    """Compress one block into raw deflate data, ending at a byte boundary."""
+    if dictionary:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(block) + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
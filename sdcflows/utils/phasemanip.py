@@ -0,0 +1,83 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Phase manipulation utilities.
+
+Phase unwrapping is performed with the Laplacian method of [Schofield2003]_:
+the Laplacian of the unwrapped phase :math:`\\phi` can be calculated from the
+wrapped phase :math:`\\psi` as
+
+.. math::
+
+    \\nabla^2 \\phi = \\cos\\psi\\, \\nabla^2 \\sin\\psi - \\sin\\psi\\, \\nabla^2 \\cos\\psi,
+
+and then inverted with discrete cosine transforms (i.e., with Neumann boundary
+conditions).
+The estimate is finally snapped to the wrapped phase, so that the output only
+differs from the input by integer multiples of :math:`2\\pi`.
+
+.. [Schofield2003] Schofield MA, Zhu Y (2003) Fast phase unwrapping algorithm for
+    interferometric applications. Opt Lett 28(14):1194-1196. doi:10.1364/OL.28.001194
+
+"""
+import numpy as np
+
+try:
+    from scipy.fft import dctn, idctn
+except ImportError:  # SciPy < 1.4
+    from scipy.fftpack import dctn, idctn
+
+
+def unwrap_laplacian(phase, mask=None, num_threads=1):
+    """
+    Unwrap a phase map (in rad) with the DCT-based Laplacian method.
+
+    >>> truth = np.fromfunction(
+    ...     lambda i, j, k: 0.04 * (i - 16.) ** 2 + 0.3 * j - 0.2 * k, (32, 32, 8))
+    >>> wrapped = np.angle(np.exp(1j * truth))
+    >>> unwrapped = unwrap_laplacian(wrapped)
+    >>> offset = np.round((truth - unwrapped).mean() / (2 * np.pi)) * 2 * np.pi
+    >>> np.allclose(unwrapped + offset, truth, atol=1e-4)
+    True
+
+    """
+    phase = np.asanyarray(phase, dtype=np.float32)
+    if mask is None:
+        mask = np.ones(phase.shape, dtype=bool)
+    mask = np.asanyarray(mask) > 0
+
+    workers = {'workers': num_threads} if num_threads > 1 else {}
+    eigen = _laplacian_eigenvalues(phase.shape)
+
+    def _lap(data):
+        return idctn(dctn(data, type=2, norm='ortho', **workers) * eigen,
+                     type=2, norm='ortho', **workers)
+
+    sin_phi, cos_phi = np.sin(phase), np.cos(phase)
+    laplacian = cos_phi * _lap(sin_phi) - sin_phi * _lap(cos_phi)
+
+    # Invert the Laplacian (the DC term is undetermined)
+    eigen[(0, ) * phase.ndim] = 1.0
+    coeffs = dctn(laplacian, type=2, norm='ortho', **workers) / eigen
+    coeffs[(0, ) * phase.ndim] = 0.0
+    estimate = idctn(coeffs, type=2, norm='ortho', **workers)
+
+    # Bring the estimate to the offset of the wrapped phase, then snap
+    if np.any(mask):
+        estimate += np.median(np.angle(np.exp(1j * (phase - estimate)))[mask])
+    unwrapped = phase + 2.0 * np.pi * np.round((estimate - phase) / (2.0 * np.pi))
+
+    # Keep the (masked) median within the principal interval
+    if np.any(mask):
+        unwrapped -= 2.0 * np.pi * np.round(np.median(unwrapped[mask]) / (2.0 * np.pi))
+    unwrapped[~mask] = 0.0
+    return unwrapped.astype(np.float32)
+
+
+def _laplacian_eigenvalues(shape):
+    """Eigenvalues of the discrete Laplacian (Neumann boundaries) in the DCT-II basis."""
+    eigen = np.zeros(shape, dtype=float)
+    for axis, size in enumerate(shape):
+        lam = 2.0 * np.cos(np.pi * np.arange(size) / size) - 2.0
+        eigen += lam.reshape([-1 if i == axis else 1 for i in range(len(shape))])
+    return eigen
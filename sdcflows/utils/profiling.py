@@ -0,0 +1,231 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Profiling the execution of workflows.
+
+:class:`NodeProfiler` is a ``status_callback`` for nipype's execution plugins,
+which records, for every node that finishes, its wall time, its CPU time and
+the peak memory (RSS) of its process (the latter two are only available when
+nipype's resource monitor is enabled, which requires *psutil*), as well as
+the size of the files it read (its inputs) and wrote (its working directory).
+:func:`write_profile` stores these records as JSON and CSV, along with the
+*critical path* of the execution: the chain of dependent nodes with the longest
+total duration, which bounds the runtime however many processors are used.
+
+Profiles drive the resource estimates of later executions with
+:func:`apply_profile`.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+
+"""
+import os
+import csv
+import json
+from math import ceil
+
+#: The fields of each record
+FIELDS = ('name', 'node', 'interface', 'start', 'finish', 'duration', 'cpu_time',
+          'mem_peak_gb', 'mem_gb', 'n_procs', 'input_bytes', 'output_bytes')
+
+
+class NodeProfiler:
+    """
+    Record the resources used by each node of a workflow.
+
+    Pass it as the ``status_callback`` argument of the plugin, and enable nipype's
+    resource monitor to record CPU times and memory::
+
+        from nipype import config
+        config.enable_resource_monitor()
+        profiler = NodeProfiler()
+        graph = workflow.run(plugin='MultiProc',
+                             plugin_args={'status_callback': profiler})
+        write_profile(profiler.records, 'profile.json', dependencies(graph))
+
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def __call__(self, node, status):
+        if status != 'end':
+            return
+
+        runtime = node.result.runtime
+        runtimes = runtime if isinstance(runtime, list) else [runtime]  # MapNodes
+        runtimes = [r for r in runtimes if getattr(r, 'startTime', None) is not None]
+
+        record = {
+            'name': node.fullname,
+            'node': node.name,
+            'interface': type(node.interface).__name__,
+            'start': min((r.startTime for r in runtimes), default=None),
+            'finish': max((r.endTime for r in runtimes), default=None),
+            'duration': sum(r.duration or 0.0 for r in runtimes),
+            'cpu_time': _sum_or_none(_cpu_time(r) for r in runtimes),
+            'mem_peak_gb': _max_or_none(getattr(r, 'mem_peak_gb', None) for r in runtimes),
+            'mem_gb': node.mem_gb,
+            'n_procs': node.n_procs,
+            'input_bytes': _input_bytes(node.inputs.get()),
+            'output_bytes': _tree_bytes(node.output_dir()),
+        }
+        self.records[record['name']] = record
+
+
+def dependencies(graph):
+    """Map the names of the nodes of an execution graph onto those of their predecessors."""
+    return {node.fullname: [pred.fullname for pred in graph.predecessors(node)]
+            for node in graph.nodes()}
+
+
+def critical_path(records, dependencies):
+    """
+    Find the chain of dependent nodes with the longest total duration.
+
+    >>> records = {'a': {'duration': 1.0}, 'b': {'duration': 5.0},
+    ...            'c': {'duration': 2.0}, 'd': {'duration': 1.0}}
+    >>> critical_path(records, {'a': [], 'b': ['a'], 'c': ['a'], 'd': ['b', 'c']})
+    (['a', 'b', 'd'], 7.0)
+
+    """
+    finish = {}
+    previous = {}
+
+    def _finish(name):
+        if name not in finish:
+            preds = dependencies.get(name, [])
+            previous[name] = max(preds, key=_finish, default=None)
+            start = finish[previous[name]] if previous[name] is not None else 0.0
+            finish[name] = start + ((records.get(name) or {}).get('duration') or 0.0)
+        return finish[name]
+
+    last = max(dependencies, key=_finish, default=None)
+    path = []
+    name = last
+    while name is not None:
+        path.insert(0, name)
+        name = previous[name]
+    return path, finish.get(last, 0.0)
+
+
+def write_profile(records, out_file, dependencies=None):
+    """
+    Write records as JSON (and CSV, with the same base name), with the critical path.
+
+    >>> records = {'a': {'name': 'a', 'duration': 1.0}, 'b': {'name': 'b', 'duration': 2.0}}
+    >>> summary = write_profile(records, 'profile.json', {'a': [], 'b': ['a']})
+    >>> summary['critical_path']
+    {'nodes': ['a', 'b'], 'duration': 3.0}
+    >>> sorted(os.listdir('.'))
+    ['profile.csv', 'profile.json']
+
+    """
+    out_file = str(out_file)
+    nodes = sorted(records.values(), key=lambda r: (r.get('start') or '', r['name']))
+    profile = {'nodes': nodes}
+    if dependencies is not None:
+        path, duration = critical_path(records, dependencies)
+        profile['critical_path'] = {'nodes': path, 'duration': duration}
+
+    with open(out_file, 'w') as fobj:
+        json.dump(profile, fobj, indent=2)
+    with open(os.path.splitext(out_file)[0] + '.csv', 'w', newline='') as fobj:
+        writer = csv.DictWriter(fobj, fieldnames=FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(nodes)
+    return profile
+
+
+def apply_profile(workflow, profile, margin=1.2, max_threads=None):
+    """
+    Set the resource estimates of the nodes of a workflow from a previous profile.
+
+    Nodes are matched by their name and interface, so that a profile also
+    applies to the workflows of other subjects and runs.
+    The memory estimate is the largest peak observed (times ``margin``), and the
+    number of threads is the largest average CPU usage observed (rounded up).
+    Returns the number of nodes updated.
+
+    >>> from nipype.pipeline import engine as pe
+    >>> from nipype.interfaces import utility as niu
+    >>> wf = pe.Workflow(name='wf')
+    >>> wf.add_nodes([pe.Node(niu.IdentityInterface(fields=['a']), name='ident')])
+    >>> records = [{'node': 'ident', 'interface': 'IdentityInterface', 'duration': 2.0,
+    ...             'cpu_time': 7.0, 'mem_peak_gb': 1.0}]
+    >>> apply_profile(wf, {'nodes': records}, max_threads=2)
+    1
+    >>> node = wf.get_node('ident')
+    >>> node.mem_gb, node.n_procs
+    (1.2, 2)
+
+    """
+    if not isinstance(profile, dict):
+        with open(str(profile)) as fobj:
+            profile = json.load(fobj)
+
+    estimates = {}
+    for record in profile['nodes']:
+        key = (record['node'], record['interface'])
+        mem_gb, n_procs = estimates.get(key, (None, None))
+        if record.get('mem_peak_gb') is not None:
+            mem_gb = max(mem_gb or 0.0, record['mem_peak_gb'] * margin)
+        if record.get('cpu_time') is not None and record.get('duration'):
+            n_procs = max(n_procs or 1, int(ceil(record['cpu_time'] / record['duration'])))
+        estimates[key] = (mem_gb, n_procs)
+
+    updated = 0
+    for node in workflow._get_all_nodes():
+        mem_gb, n_procs = estimates.get((node.name, type(node.interface).__name__),
+                                        (None, None))
+        if mem_gb is not None:
+            node._mem_gb = round(mem_gb, 3)
+        if n_procs is not None:
+            node.n_procs = min(n_procs, max_threads or n_procs)
+        updated += int(mem_gb is not None or n_procs is not None)
+    return updated
+
+
+def _cpu_time(runtime):
+    """Integrate the CPU usage sampled by nipype's resource monitor."""
+    prof = getattr(runtime, 'prof_dict', None)
+    if not prof or len(prof['time']) < 2:
+        return None
+    # Each sample is the average usage (in %) since the previous sample
+    return sum((t1 - t0) * cpus / 100.0 for t0, t1, cpus in zip(
+        prof['time'][:-1], prof['time'][1:], prof['cpus'][1:]))
+
+
+def _input_bytes(value, seen=None):
+    """Total size of the (existing) files in a structure of inputs."""
+    seen = set() if seen is None else seen
+    if isinstance(value, dict):
+        return sum(_input_bytes(v, seen) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_input_bytes(v, seen) for v in value)
+    if isinstance(value, str) and value not in seen and os.path.isfile(value):
+        seen.add(value)
+        return os.path.getsize(value)
+    return 0
+
+
+def _tree_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(str(path)):
+        for fname in filenames:
+            fpath = os.path.join(dirpath, fname)
+            if os.path.isfile(fpath):
+                total += os.path.getsize(fpath)
+    return total
+
+
+def _sum_or_none(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def _max_or_none(values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
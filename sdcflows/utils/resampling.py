@@ -0,0 +1,332 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Resampling of EPI series along the phase-encoding axis.
+
+Susceptibility distortions only displace voxels along the phase-encoding (PE)
+axis, and the displacements are the same for all the volumes of a run.
+Therefore, unwarping a 4D series reduces to a 1D interpolation along the PE
+axis with sampling locations and weights that can be calculated only once
+(:func:`pe_sampling_table`) and then applied to every volume
+(:func:`resample_pe`).
+:func:`stream_resample_pe` reads, resamples and writes out the series in
+chunks of a few volumes, so that memory usage does not scale with the
+length of the run.
+:func:`stream_resample_composed` generalizes the latter to compose
+head-motion correction (HMC) transforms with the displacements field,
+so that each volume is interpolated once.
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nb
+
+KERNELS = {
+    # kernel: (function, radius in voxels)
+    'nearest': (lambda x: (np.abs(x) < 0.5) | (x == 0.5), 1),
+    'linear': (lambda x: np.clip(1.0 - np.abs(x), 0.0, None), 1),
+    'cubic': (lambda x: _keys_kernel(x), 2),
+    'lanczos': (lambda x: np.sinc(x) * np.sinc(x / 3.0) * (np.abs(x) < 3.0), 3),
+}
+
+
+def _keys_kernel(x, a=-0.5):
+    """Evaluate the cubic convolution kernel of Keys (1981)."""
+    x = np.abs(x)
+    return np.where(
+        x <= 1.0, ((a + 2.0) * x - (a + 3.0)) * x * x + 1.0,
+        np.where(x < 2.0, a * (((x - 5.0) * x + 8.0) * x - 4.0), 0.0))
+
+
+def pe_sampling_table(shift, axis, kernel='linear'):
+    """
+    Calculate the sampling indices and weights of a displacement along one axis.
+
+    The voxel at index :math:`n` along ``axis`` is resampled from the location
+    :math:`n + \\mathrm{shift}`.
+    Taps falling outside the field of view are dropped (and the remaining weights
+    renormalized), and locations beyond the edges of the field of view get zero
+    weights.
+
+    Parameters
+    ----------
+    shift : numpy.ndarray
+        Displacements (in voxels) along ``axis``, for every voxel.
+    axis : int
+        The axis of displacements.
+    kernel : str
+        Interpolation kernel (``'nearest'``, ``'linear'``, ``'cubic'`` or
+        ``'lanczos'``).
+
+    Returns
+    -------
+    indices : numpy.ndarray
+        Integer array of shape ``(ntaps, ) + shift.shape``, with the index along
+        ``axis`` of each tap of the kernel.
+    weights : numpy.ndarray
+        Array with the same shape as ``indices``, with the (normalized) weights.
+
+    >>> indices, weights = pe_sampling_table(np.full((1, 4, 1), 0.25), axis=1)
+    >>> indices[:, 0, :, 0].tolist()
+    [[0, 1, 2, 3], [1, 2, 3, 3]]
+    >>> weights[:, 0, :, 0].tolist()
+    [[0.75, 0.75, 0.75, 1.0], [0.25, 0.25, 0.25, 0.0]]
+
+    """
+    try:
+        func, radius = KERNELS[kernel]
+    except KeyError:
+        raise ValueError('Unknown interpolation kernel "%s".' % kernel)
+
+    shift = np.asanyarray(shift, dtype=float)
+    npoints = shift.shape[axis]
+    grid = np.arange(npoints).reshape([-1 if i == axis else 1
+                                       for i in range(shift.ndim)])
+    location = grid + shift
+    base = np.floor(location).astype(np.intp)
+
+    offsets = np.arange(1 - radius, radius + 1)
+    indices = base[np.newaxis] + offsets.reshape((-1, ) + (1, ) * shift.ndim)
+    weights = func(location[np.newaxis] - indices).astype(np.float32)
+
+    # Taps out of the field of view are dropped and the remainder renormalized
+    weights[(indices < 0) | (indices >= npoints)] = 0.0
+    total = weights.sum(0)
+    valid = (total > 1e-6) & (location > -0.5) & (location < npoints - 0.5)
+    weights = np.divide(weights, total, out=np.zeros_like(weights), where=valid)
+    return np.clip(indices, 0, npoints - 1), weights
+
+
+def resample_pe(data, indices, weights, axis):
+    """
+    Apply a sampling table calculated with :func:`pe_sampling_table`.
+
+    ``data`` may have extra trailing dimensions (e.g., a block of volumes), which
+    are resampled identically.
+
+    >>> data = np.arange(4, dtype='f4').reshape((1, 4, 1))
+    >>> resample_pe(data, *pe_sampling_table(np.full((1, 4, 1), 0.25), 1), 1).ravel()
+    array([0.25, 1.25, 2.25, 3.  ], dtype=float32)
+
+    """
+    extra = data.ndim - indices.ndim + 1
+    shape = indices.shape[1:] + (1, ) * extra
+    result = np.zeros(data.shape, dtype=np.float32)
+    for idx, wgt in zip(indices, weights):
+        idx = np.broadcast_to(idx.reshape(shape), data.shape)
+        result += wgt.reshape(shape) * np.take_along_axis(data, idx, axis=axis)
+    return result
+
+
+def stream_resample_pe(in_file, out_file, shift, axis, kernel='linear', modulation=None,
+                       chunk_size=4, num_threads=1):
+    """
+    Resample a 3D or 4D image along one axis, in chunks of volumes.
+
+    Volumes are read through the image proxy, resampled in a thread pool,
+    and written out in order, so that at most ``2 * num_threads`` chunks
+    are held in memory at any given time.
+
+    Parameters
+    ----------
+    in_file : os.pathlike
+        The input (3D or 4D) NIfTI image.
+    out_file : os.pathlike
+        The output file name (may be gzipped).
+    shift : numpy.ndarray
+        3D array of displacements (in voxels) along ``axis``.
+    axis : int
+        The axis of displacements.
+    kernel : str
+        Interpolation kernel, see :func:`pe_sampling_table`.
+    modulation : numpy.ndarray
+        Optional 3D array multiplying every resampled volume (e.g., the Jacobian
+        determinant of the displacements).
+    chunk_size : int
+        Number of volumes resampled per task.
+    num_threads : int
+        Maximum number of threads.
+
+    """
+    img = nb.load(in_file)
+    indices, weights = pe_sampling_table(shift, axis, kernel=kernel)
+
+    def _resample(block, start):
+        block = resample_pe(block, indices, weights, axis)
+        if modulation is not None:
+            block *= modulation[..., np.newaxis]
+        return block
+
+    return _stream_volumes(img, out_file, _resample, img.shape[:3], img.affine,
+                           chunk_size=chunk_size, num_threads=num_threads)
+
+
+def stream_resample_composed(in_file, out_file, ref_shape, ref_affine, xfms=None,
+                             displacements=None, order=3, modulation=None,
+                             chunk_size=1, num_threads=1):
+    """
+    Resample a 4D series with per-volume rigid transforms and one displacements field.
+
+    For every voxel of the reference grid, the displacements field (SDC) and then
+    the transform of each volume (HMC) are applied to find the sampling location
+    within that volume, so that each volume is interpolated only once and
+    no composite transform is written out.
+
+    Parameters
+    ----------
+    in_file : os.pathlike
+        The input (3D or 4D) NIfTI image.
+    out_file : os.pathlike
+        The output file name (may be gzipped).
+    ref_shape : tuple
+        Shape of the output (reference) grid.
+    ref_affine : numpy.ndarray
+        Affine (RAS+) of the output grid.
+    xfms : list of numpy.ndarray
+        One :math:`4 \\times 4` matrix (LPS, reference-to-volume in ITK's
+        convention, see :func:`load_itk_affine`) per volume.
+        If ``None``, volumes are assumed aligned with the reference.
+    displacements : numpy.ndarray
+        Displacements field (LPS, mm) defined on the reference grid, with shape
+        ``ref_shape + (3, )``.
+        If ``None``, only the rigid transforms are applied.
+    order : int
+        Spline interpolation order, see :func:`scipy.ndimage.map_coordinates`.
+    modulation : numpy.ndarray
+        Optional 3D array (on the reference grid) multiplying every resampled
+        volume.
+    chunk_size : int
+        Number of volumes resampled per task.
+    num_threads : int
+        Maximum number of threads.
+
+    """
+    from scipy.ndimage import map_coordinates
+
+    img = nb.load(in_file)
+    ref_shape = tuple(ref_shape[:3])
+    nvols = img.shape[3] if len(img.shape) > 3 else 1
+    if xfms is not None and len(xfms) != nvols:
+        raise ValueError('Number of transforms (%d) and volumes (%d) do not match.'
+                         % (len(xfms), nvols))
+
+    # Physical (LPS) coordinates of the reference grid, after SDC
+    ras2lps = np.diag([-1., -1., 1., 1.])
+    ijk = np.indices(ref_shape, dtype=np.float32).reshape(3, -1)
+    points = (ras2lps.dot(ref_affine)[:3, :3].dot(ijk)
+              + ras2lps.dot(ref_affine)[:3, 3, np.newaxis])
+    if displacements is not None:
+        points += np.asanyarray(displacements, dtype=np.float32).reshape(-1, 3).T
+    points = points.astype(np.float32)
+    lps2vox = np.linalg.inv(ras2lps.dot(img.affine))
+
+    def _resample(block, start):
+        result = np.zeros(ref_shape + block.shape[3:], dtype=np.float32)
+        for i in range(block.shape[-1]):
+            xfm = lps2vox
+            if xfms is not None:
+                xfm = lps2vox.dot(xfms[start + i])
+            coords = xfm[:3, :3].dot(points) + xfm[:3, 3, np.newaxis]
+            result[..., i] = map_coordinates(
+                block[..., i], coords, order=order, mode='constant', cval=0.0,
+                prefilter=order > 1).reshape(ref_shape)
+        if modulation is not None:
+            result *= modulation[..., np.newaxis]
+        return result
+
+    return _stream_volumes(img, out_file, _resample, ref_shape, ref_affine,
+                           chunk_size=chunk_size, num_threads=num_threads)
+
+
+def load_itk_affine(in_file):
+    """
+    Read an ITK affine transform (text or MATLAB format) as a :math:`4 \\times 4` matrix.
+
+    The matrix maps LPS coordinates from the fixed (reference) space onto
+    the moving space (ITK's convention).
+
+    >>> with open('xfm.txt', 'w') as f:
+    ...     _ = f.write('''#Insight Transform File V1.0
+    ... #Transform 0
+    ... Transform: AffineTransform_double_3_3
+    ... Parameters: 1 0 0 0 1 0 0 0 1 1.5 -2 0
+    ... FixedParameters: 10 0 0
+    ... ''')
+    >>> load_itk_affine('xfm.txt')[:3, 3].tolist()
+    [1.5, -2.0, 0.0]
+
+    """
+    in_file = str(in_file)
+    if in_file.endswith('.mat'):
+        from scipy.io import loadmat
+
+        mat = loadmat(in_file)
+        params = [v for k, v in mat.items() if k.startswith(
+            ('AffineTransform', 'MatrixOffsetTransformBase', 'Euler3DTransform'))]
+        if not params or 'fixed' not in mat:
+            raise ValueError('"%s" is not an ITK affine transform file.' % in_file)
+        params, fixed = np.ravel(params[0]), np.ravel(mat['fixed'])
+    else:
+        params = fixed = None
+        with open(in_file) as f:
+            for line in f:
+                if line.startswith('Parameters:'):
+                    params = np.array(line.split(':', 1)[1].split(), dtype=float)
+                elif line.startswith('FixedParameters:'):
+                    fixed = np.array(line.split(':', 1)[1].split(), dtype=float)
+                    break
+        if params is None or fixed is None or params.size != 12:
+            raise ValueError('"%s" is not an ITK affine transform file.' % in_file)
+
+    matrix = params[:9].reshape(3, 3)
+    xfm = np.eye(4)
+    xfm[:3, :3] = matrix
+    xfm[:3, 3] = params[9:12] + fixed[:3] - matrix.dot(fixed[:3])
+    return xfm
+
+
+def _stream_volumes(img, out_file, resample, shape, affine, chunk_size=4, num_threads=1):
+    """Read, resample (in a thread pool) and write out an image in chunks of volumes."""
+    from .nifti import open_image
+
+    nvols = img.shape[3] if len(img.shape) > 3 else 1
+
+    hdr = img.header.copy()
+    hdr.set_data_shape(tuple(shape[:3]) + tuple(img.shape[3:]))
+    hdr.set_data_dtype('<f4')
+    hdr.set_slope_inter(1.0, 0.0)
+    hdr.set_qform(affine, int(hdr['qform_code']) or 1)
+    hdr.set_sform(affine, int(hdr['sform_code']) or 1)
+    offset = 352 + int(hdr.extensions.get_sizeondisk())
+    hdr.set_data_offset(offset)
+
+    def _write(fobj, block):
+        fobj.write(np.asarray(block, dtype='<f4').tobytes(order='F'))
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool, \
+            open_image(out_file, num_threads=num_threads) as fobj:
+        hdr.write_to(fobj)
+        fobj.write(b'\x00' * int(offset - fobj.tell()))
+
+        for start in range(0, nvols, chunk_size):
+            if len(img.shape) > 3:
+                block = np.asanyarray(img.dataobj[..., start:start + chunk_size])
+            else:
+                block = np.asanyarray(img.dataobj)[..., np.newaxis]
+            pending.append(pool.submit(resample, block.astype(np.float32), start))
+
+            if len(pending) >= 2 * num_threads:
+                _write(fobj, pending.popleft().result())
+
+        while pending:
+            _write(fobj, pending.popleft().result())
+
+    return out_file
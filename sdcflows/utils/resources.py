@@ -0,0 +1,124 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Resource estimates of nodes, from the size of the images they process.
+
+Nipype's schedulers only submit a node while the memory (``mem_gb``) and
+threads (``n_procs``) it is estimated to use fit within the resources left.
+:func:`node_resources` derives both from the shape of the images a node
+processes, with a linear cost model for each kind of processing
+(:data:`COST_MODELS`): the memory is a fixed overhead plus a number of bytes per
+voxel, and threads are only allocated while each of them gets enough voxels to
+pay off (small images are processed with fewer threads, so that more nodes
+run concurrently).
+The costs per voxel follow from the arrays each tool holds in memory; executions
+profiled with ``sdcflows --profile`` refine them (see
+:func:`~sdcflows.utils.profiling.apply_profile`).
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+        >>> import nibabel as nb
+        >>> nb.Nifti1Image(np.zeros((64, 64, 36, 10)), None, None).to_filename('bold.nii.gz')
+
+"""
+from collections import namedtuple
+from functools import reduce
+from math import ceil
+from operator import mul
+
+#: Shape assumed when the images are unknown (a typical 2.5mm EPI series)
+DEFAULT_SHAPE = (96, 96, 60, 1)
+
+CostModel = namedtuple('CostModel', ['overhead_gb', 'bytes_per_voxel',
+                                     'voxels_per_thread', 'series'])
+CostModel.__doc__ = """\
+The resources of one kind of processing.
+
+``overhead_gb`` and ``bytes_per_voxel`` define the memory, ``voxels_per_thread``
+the number of voxels a thread must get to be allocated (``None`` for
+single-threaded processing), and ``series`` whether the costs scale with the
+number of volumes (otherwise, only one volume is processed).
+"""
+
+#: Cost models of the kinds of processing found across workflows
+COST_MODELS = {
+    # In-process (numpy) processing of 3D images (a handful of float64 copies)
+    'image': CostModel(0.1, 40, None, False),
+    # FSL/AFNI command-line tools filtering or masking 3D images
+    'filter': CostModel(0.05, 24, None, False),
+    # ANTs resampling of one volume (input, output and the three components of the field)
+    'resample': CostModel(0.1, 64, 500000, False),
+    # Streaming the resampling of series (input and output series, and one field)
+    'resample_series': CostModel(0.1, 12, 1000000, True),
+    # Splitting and merging of series
+    'series': CostModel(0.05, 12, 1000000, True),
+    # Robust templates of series (all volumes, and their aligned copies)
+    'template': CostModel(0.2, 16, 200000, True),
+    # ANTs rigid or affine registration (multi-resolution pyramids and gradients)
+    'registration': CostModel(0.2, 200, 100000, False),
+    # ANTs SyN (also the displacement fields and their inverses, at every level)
+    'syn': CostModel(0.3, 600, 50000, False),
+    # AFNI's 3dQwarp (both images, the warps and their patch-wise optimization)
+    'qwarp': CostModel(0.2, 400, 50000, False),
+    # B-Spline estimators (images, the design of the grid and gradients)
+    'bspline': CostModel(0.2, 80, 100000, False),
+    # N4 bias field correction
+    'n4': CostModel(0.1, 100, 200000, False),
+    # Fitting of a dense B-Spline fieldmap (FieldEnhance)
+    'fmap_enhance': CostModel(0.5, 2000, 200000, False),
+    # Phase unwrapping
+    'unwrap': CostModel(0.1, 100, 200000, False),
+}
+
+
+def node_resources(kind, in_shape=None, omp_nthreads=1):
+    """
+    Estimate the memory and threads of a node processing images of shape ``in_shape``.
+
+    Returns the keyword arguments ``mem_gb`` and ``n_procs`` of
+    :class:`~nipype.pipeline.engine.Node`.
+
+    >>> node_resources('registration', (64, 64, 36), omp_nthreads=8)
+    {'mem_gb': 0.23, 'n_procs': 2}
+    >>> node_resources('registration', (128, 128, 80), omp_nthreads=8)
+    {'mem_gb': 0.44, 'n_procs': 8}
+    >>> node_resources('resample_series', (64, 64, 36, 300), omp_nthreads=8)
+    {'mem_gb': 0.59, 'n_procs': 8}
+    >>> node_resources('image')
+    {'mem_gb': 0.12, 'n_procs': 1}
+
+    """
+    model = COST_MODELS[kind]
+    shape = tuple(in_shape or DEFAULT_SHAPE)
+    nvoxels = reduce(mul, shape[:3], 1)
+    if model.series:
+        nvoxels *= reduce(mul, shape[3:], 1)
+
+    n_procs = 1
+    if model.voxels_per_thread is not None:
+        n_procs = max(1, min(omp_nthreads, int(ceil(nvoxels / model.voxels_per_thread))))
+    return {
+        'mem_gb': round(model.overhead_gb + model.bytes_per_voxel * nvoxels / 1024 ** 3, 2),
+        'n_procs': n_procs,
+    }
+
+
+def read_shape(in_file):
+    """
+    Read the shape of an image from its header, or ``None`` if it cannot be read.
+
+    >>> read_shape('bold.nii.gz')
+    (64, 64, 36, 10)
+    >>> read_shape('missing.nii.gz') is None
+    True
+
+    """
+    from nibabel.filebasedimages import ImageFileError
+    from .epimanip import image_shape
+
+    try:
+        return image_shape(in_file)
+    except (OSError, ImageFileError):
+        return None
@@ -0,0 +1,233 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Robust templates of EPI series.
+
+A template is built by rigidly aligning the volumes of a series (plus a global
+intensity scaling, i.e., seven degrees of freedom) to a reference, and
+taking the voxelwise median of the aligned volumes, which is robust to
+outlier volumes.
+Unlike FreeSurfer's ``mri_robust_template``, all volumes are kept in memory
+as one array (no file per volume), the alignments of the volumes are
+calculated in parallel, and only a subset of the volumes and voxels
+participate in the estimation.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.spatial.transform import Rotation
+
+
+def subsample_volumes(nvols, max_volumes=None):
+    """
+    Select (at most) ``max_volumes`` evenly spaced volumes, always keeping the first.
+
+    >>> subsample_volumes(10, 4).tolist()
+    [0, 3, 6, 9]
+    >>> subsample_volumes(3, 4).tolist()
+    [0, 1, 2]
+
+    """
+    if not max_volumes or nvols <= max_volumes:
+        return np.arange(nvols)
+    return np.unique(np.round(np.linspace(0, nvols - 1, max_volumes)).astype(int))
+
+
+def rigid_align(fixed, moving, zooms=(1.0, 1.0, 1.0), mask=None, init=None,
+                max_iter=30, tol=1e-3, levels=(2, 1), nsamples=20000, seed=0):
+    """
+    Estimate the rigid-body transform and intensity scaling aligning two volumes.
+
+    The sum of squared differences between ``fixed`` and the scaled, resampled
+    ``moving`` image is minimized with Gauss-Newton iterations on a coarse-to-fine
+    sequence of (smoothed) images, evaluating the cost only on a random subset of
+    the voxels within ``mask``.
+    Iterations stop early once the update is smaller than ``tol`` (in mm, with
+    rotations measured as the displacement at 50 mm from the center).
+
+    Parameters
+    ----------
+    fixed, moving : numpy.ndarray
+        3D volumes on the same grid.
+    zooms : tuple
+        Voxel sizes (in mm).
+    mask : numpy.ndarray
+        Voxels of ``fixed`` where the cost is evaluated (default: above the mean).
+    init : tuple
+        Initial ``(rotation, translation)``, as returned by a previous call.
+    max_iter : int
+        Maximum number of iterations per level.
+    tol : float
+        Early stopping threshold (in mm).
+    levels : tuple
+        Smoothing (in voxels, FWHM) of each level of the pyramid.
+    nsamples : int
+        Maximum number of voxels sampled to evaluate the cost.
+
+    Returns
+    -------
+    rotation : numpy.ndarray
+        3x3 rotation matrix (in mm, about the center of the volume).
+    translation : numpy.ndarray
+        Translation (in mm).
+    scale : float
+        Intensity scaling that best matches ``moving`` to ``fixed``.
+
+    >>> fixed = np.zeros((24, 24, 24), dtype='float32')
+    >>> fixed[6:18, 8:16, 5:15] = 100.0
+    >>> moving = np.roll(fixed, 2, axis=0) * 0.5
+    >>> rot, trans, scale = rigid_align(fixed, moving, zooms=(2.0, 2.0, 2.0))
+    >>> np.allclose(trans, (4.0, 0.0, 0.0), atol=0.1), round(float(scale), 2)
+    (True, 2.0)
+
+    """
+    zooms = np.asanyarray(zooms, dtype=float)
+    center = (np.array(fixed.shape) - 1) * 0.5
+    if mask is None:
+        mask = fixed > fixed.mean()
+
+    rng = np.random.RandomState(seed)
+    samples = np.argwhere(mask)
+    if nsamples and len(samples) > nsamples:
+        samples = samples[rng.choice(len(samples), nsamples, replace=False)]
+    points = (samples - center) * zooms  # mm, centered
+
+    rot, trans = (np.eye(3), np.zeros(3)) if init is None else (
+        np.array(init[0], dtype=float), np.array(init[1], dtype=float))
+    scale = 1.0
+
+    for fwhm in levels:
+        sigma = fwhm / 2.3548 if fwhm > 1 else 0
+        fix = ndi.gaussian_filter(fixed, sigma) if sigma else fixed
+        mov = ndi.gaussian_filter(moving, sigma) if sigma else moving
+        target = fix[tuple(samples.T)].astype(float)
+        grads = np.gradient(np.asanyarray(mov, dtype='float32'), *zooms)
+
+        for _ in range(max_iter):
+            moved = points.dot(rot.T) + trans
+            coords = (moved / zooms + center).T
+            values = ndi.map_coordinates(mov, coords, order=1, mode='nearest')
+            grad = np.stack([ndi.map_coordinates(g, coords, order=1, mode='nearest')
+                             for g in grads], axis=-1)
+
+            # Closed-form intensity scaling
+            scale = values.dot(target) / max(values.dot(values), 1e-8)
+
+            # Jacobian w.r.t. an incremental rotation (q x g) and translation (g)
+            jac = scale * np.hstack((np.cross(moved, grad), grad))
+            resid = scale * values - target
+            hess = jac.T.dot(jac)
+            hess[np.diag_indices(6)] *= 1.0 + 1e-3  # Levenberg-Marquardt damping
+            try:
+                step = -np.linalg.solve(hess, jac.T.dot(resid))
+            except np.linalg.LinAlgError:
+                break
+
+            delta = Rotation.from_rotvec(step[:3]).as_matrix()
+            rot = delta.dot(rot)
+            trans = delta.dot(trans) + step[3:]
+            if np.abs(step[3:]).max() + 50.0 * np.abs(step[:3]).max() < tol:
+                break
+
+    return rot, trans, scale
+
+
+def apply_rigid(moving, rotation, translation, zooms=(1.0, 1.0, 1.0), order=3):
+    """Resample a volume with a transform estimated by :func:`rigid_align`."""
+    zooms = np.asanyarray(zooms, dtype=float)
+    center = (np.array(moving.shape) - 1) * 0.5
+    # Voxel (fixed) -> voxel (moving) mapping
+    matrix = np.diag(1.0 / zooms).dot(rotation).dot(np.diag(zooms))
+    offset = center + translation / zooms - matrix.dot(center)
+    return ndi.affine_transform(moving, matrix, offset=offset, order=order,
+                                mode='nearest')
+
+
+def robust_template(data, zooms=(1.0, 1.0, 1.0), max_volumes=None, max_iter=5,
+                    tol=1e-3, order=3, num_threads=1, **kwargs):
+    """
+    Calculate a robust (median) template of a 4D series.
+
+    Volumes are aligned to the first one (rigid plus intensity scaling), and then
+    iteratively to the median of the aligned volumes, until the template
+    changes less than ``tol`` (relative RMS) or ``max_iter`` iterations.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The series (volumes along the last axis).
+    zooms : tuple
+        Voxel sizes (in mm).
+    max_volumes : int
+        Maximum number of (evenly spaced) volumes to use (all, if ``None``).
+    max_iter : int
+        Maximum number of template updates.
+    tol : float
+        Early stopping threshold.
+    order : int
+        Order of the spline interpolation of the final resampling.
+    num_threads : int
+        Number of volumes aligned in parallel.
+
+    Other keyword arguments are passed on to :func:`rigid_align`.
+
+    Returns
+    -------
+    template : numpy.ndarray
+        The template (on the intensity scale of the first volume).
+    transforms : list
+        The ``(rotation, translation, scale)`` of every selected volume.
+    indices : numpy.ndarray
+        The indices of the selected volumes.
+
+    >>> base = np.zeros((24, 24, 24), dtype='float32')
+    >>> base[6:18, 8:16, 5:15] = 100.0
+    >>> data = np.stack([base, np.roll(base, 1, axis=1) * 1.2, base * 0.9], axis=-1)
+    >>> template, xfms, _ = robust_template(data, zooms=(2.0, 2.0, 2.0), order=1)
+    >>> float(np.abs(template - base).max()) < 5.0
+    True
+
+    """
+    data = np.asanyarray(data, dtype='float32')
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+
+    indices = subsample_volumes(data.shape[-1], max_volumes)
+    volumes = [data[..., i] for i in indices]
+    if len(volumes) == 1:
+        return volumes[0], [(np.eye(3), np.zeros(3), 1.0)], indices
+
+    mask = volumes[0] > volumes[0].mean()
+    reference = volumes[0]
+    transforms = [(np.eye(3), np.zeros(3), 1.0)] * len(volumes)
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+        for _ in range(max(1, max_iter)):
+            transforms = list(pool.map(
+                lambda args: rigid_align(reference, args[0], zooms=zooms, mask=mask,
+                                         init=args[1][:2], **kwargs),
+                zip(volumes, transforms)))
+            aligned = list(pool.map(
+                lambda args: args[1][2] * apply_rigid(args[0], *args[1][:2],
+                                                      zooms=zooms, order=1),
+                zip(volumes, transforms)))
+            template = np.median(aligned, axis=0)
+
+            change = np.sqrt(np.mean((template - reference)[mask] ** 2))
+            change /= max(np.sqrt(np.mean(template[mask] ** 2)), 1e-8)
+            reference = template
+            if change < tol:
+                break
+
+        if order != 1:
+            aligned = list(pool.map(
+                lambda args: args[1][2] * apply_rigid(args[0], *args[1][:2],
+                                                      zooms=zooms, order=order),
+                zip(volumes, transforms)))
+            template = np.median(aligned, axis=0)
+
+    # Bring the template back to the intensity scale of the first volume
+    template /= transforms[0][2]
+    return template.astype('float32'), transforms, indices
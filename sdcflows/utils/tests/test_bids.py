@@ -0,0 +1,54 @@
+"""Test the persisted BIDS indexes."""
+import os
+import json
+from pathlib import Path
+
+from ..bids import get_layouts, get_fmaps
+
+
+def _make_dataset(root):
+    root.mkdir()
+    (root / 'dataset_description.json').write_text(
+        json.dumps({'Name': 'test', 'BIDSVersion': '1.4.0'}))
+    for sub in ('01', '02'):
+        func = root / ('sub-%s' % sub) / 'func'
+        fmap = root / ('sub-%s' % sub) / 'fmap'
+        func.mkdir(parents=True)
+        fmap.mkdir()
+        bold = 'sub-%s_task-rest_bold' % sub
+        (func / (bold + '.nii.gz')).write_text('')
+        (func / (bold + '.json')).write_text(json.dumps({'PhaseEncodingDirection': 'j'}))
+        epi = 'sub-%s_dir-AP_epi' % sub
+        (fmap / (epi + '.nii.gz')).write_text('')
+        (fmap / (epi + '.json')).write_text(json.dumps({
+            'PhaseEncodingDirection': 'j-',
+            'IntendedFor': 'func/%s.nii.gz' % bold}))
+
+
+def test_get_layouts(tmpdir):
+    """Check that indexes are reused, and only rebuilt when a subject changes."""
+    root = Path(str(tmpdir)) / 'ds'
+    database_dir = Path(str(tmpdir)) / 'db'
+    _make_dataset(root)
+
+    layouts = get_layouts(root, database_dir, validate=False)
+    assert [layout.get_subjects() for layout in layouts] == [['01'], ['02']]
+
+    stamps = {sub: os.stat(str(database_dir / ('sub-%s.sqlite' % sub))).st_mtime_ns
+              for sub in ('01', '02')}
+
+    # Reloading does not reindex, and associations are stored
+    layouts = get_layouts(root, database_dir, validate=False)
+    for sub, layout in zip(('01', '02'), layouts):
+        assert os.stat(str(database_dir / ('sub-%s.sqlite' % sub))).st_mtime_ns == stamps[sub]
+        bold = layout.get(suffix='bold', extension='.nii.gz')[0]
+        assert [f.filename for f in get_fmaps(bold)['epi']] == [
+            'sub-%s_dir-AP_epi.nii.gz' % sub]
+
+    # Adding a run invalidates the index of its subject only
+    (root / 'sub-02' / 'func' / 'sub-02_task-rest_run-2_bold.nii.gz').write_text('')
+    layouts = get_layouts(root, database_dir, validate=False)
+    assert os.stat(str(database_dir / 'sub-01.sqlite')).st_mtime_ns == stamps['01']
+    assert os.stat(str(database_dir / 'sub-02.sqlite')).st_mtime_ns != stamps['02']
+    assert [len(layout.get(suffix='bold', extension='.nii.gz'))
+            for layout in layouts] == [1, 2]
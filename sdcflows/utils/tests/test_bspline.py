@@ -0,0 +1,37 @@
+"""Test the B-Spline approximation of fieldmaps."""
+import numpy as np
+import nibabel as nb
+import pytest
+
+from ..bspline import BSplineFieldmap
+
+
+@pytest.mark.parametrize('njobs', [1, 3])
+def test_bspline_weighted_fit(njobs):
+    """Check the separable solution against a dense weighted least-squares fit."""
+    rng = np.random.RandomState(2019)
+    data = rng.normal(size=(11, 9, 8))
+    weights = (rng.rand(*data.shape) > 0.2).astype(np.uint8)
+    fmapnii = nb.Nifti1Image(data, np.diag([2., 2., 2.5, 1.]))
+
+    bsp = BSplineFieldmap(fmapnii, weights=weights, knots_zooms=[8., 8., 10.],
+                          regularization=0., njobs=njobs)
+    bsp.fit()
+
+    design = np.kron(np.kron(*bsp._design[:2]), bsp._design[2])
+    sqrtw = np.sqrt(weights.reshape(-1))[:, np.newaxis]
+    expected = np.linalg.lstsq(design * sqrtw, (data.reshape(-1, 1) * sqrtw),
+                               rcond=None)[0]
+    smoothed = bsp.get_smoothed()
+    mask = weights.reshape(-1) > 0
+
+    assert smoothed.shape == data.shape
+    assert np.allclose(smoothed.get_fdata().reshape(-1)[mask],
+                       (design @ expected).ravel()[mask], atol=1e-4)
+
+
+def test_bspline_not_fit():
+    """Coefficients are unavailable before fitting."""
+    bsp = BSplineFieldmap(nb.Nifti1Image(np.zeros((5, 5, 5)), np.eye(4)))
+    with pytest.raises(RuntimeError):
+        bsp.get_smoothed()
@@ -0,0 +1,69 @@
+"""Test the persistent store of fieldmaps."""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import time
+
+from ..cache import FieldmapCache, fieldmap_key
+
+
+def _put(args):
+    root, index = args
+    src = Path(root).parent / ('fmap%02d.nii.gz' % index)
+    src.write_bytes(bytes([index % 256]) * 4096)
+    cache = FieldmapCache(root, max_size=5 * 5000)
+    stored = cache.put('%064x' % (index % 8), {'fmap': str(src)})
+    # The entry may have been evicted by another process already
+    return stored is None or Path(stored['fmap']).stat().st_size == 4096
+
+
+def test_concurrent_access(tmpdir):
+    """Many processes storing (some identical) keys with eviction."""
+    root = str(tmpdir / 'cache')
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(_put, [(root, i) for i in range(32)]))
+
+    assert all(results)
+    cache = FieldmapCache(root)
+    assert 0 < cache.size() <= 5 * 5000
+    assert not list((Path(root) / 'tmp').iterdir())
+    for entry, _, _ in cache._entries():
+        assert cache.get(entry.name) is not None
+
+
+def test_lru(tmpdir):
+    """The least recently accessed entries are evicted first."""
+    tmpdir.chdir()
+    Path('fmap.nii.gz').write_bytes(b'0' * 1000)
+    cache = FieldmapCache('cache', max_size=2800)
+
+    keys = [fieldmap_key(['fmap.nii.gz'], estimator='test%d' % i) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        entry = Path(cache.put(key, {'fmap': 'fmap.nii.gz'})['fmap']).parent
+        os.utime(str(entry), (time() - 100 + i, time() - 100 + i))
+
+    # Accessing the first entry makes the second the least recently used
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[2], {'fmap': 'fmap.nii.gz'})
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
+
+    # Recently accessed entries are protected
+    cache = FieldmapCache('cache', max_size=0, keep_recent=3600)
+    cache.evict()
+    assert cache.get(keys[0]) is not None
+
+
+def test_bound_by_path(tmpdir):
+    """Stores opened by their path (e.g., by nodes) keep evicting to the saved bound."""
+    from ...interfaces.cache import StoreFieldmap
+
+    tmpdir.chdir()
+    FieldmapCache('cache', max_size=2500)
+    for i in range(4):
+        Path('fmap%d.nii.gz' % i).write_bytes(bytes([i]) * 1000)
+        StoreFieldmap(cache='cache', in_files=['fmap%d.nii.gz' % i],
+                      estimator='test', fmap='fmap%d.nii.gz' % i).run()
+
+    assert FieldmapCache('cache').size() <= 2500
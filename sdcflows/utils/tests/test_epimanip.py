@@ -0,0 +1,74 @@
+"""Test the calculation of readout parameters."""
+import os
+import json
+from pathlib import Path
+import numpy as np
+import nibabel as nb
+import pytest
+
+from ..epimanip import get_readout, image_shape, resolve_readouts
+
+
+@pytest.mark.parametrize('meta,expected', [
+    ({'EffectiveEchoSpacing': 0.0005, 'TotalReadoutTime': 0.03}, (0.0005, 0.03)),
+    ({'EffectiveEchoSpacing': 0.0005}, (0.0005, 0.0005 * 39)),
+    ({'TotalReadoutTime': 0.039}, (0.001, 0.039)),
+    ({'TotalReadoutTime': 0.019, 'ParallelReductionFactorInPlane': 2}, (0.001, 0.019)),
+    ({'WaterFatShift': 10.0, 'MagneticFieldStrength': 3},
+     (10.0 / (3 * 3.4 * 42.57 * 40), 10.0 / (3 * 3.4 * 42.57))),
+    ({}, (None, None)),
+])
+def test_get_readout(tmpdir, meta, expected):
+    """Check the readout parameters of an image with 40 voxels along the PE axis."""
+    tmpdir.chdir()
+    nb.Nifti1Image(np.zeros((20, 40, 10), dtype='uint8'), np.eye(4)).to_filename('epi.nii')
+
+    meta['PhaseEncodingDirection'] = 'j-'
+    ees, trt = get_readout(meta, 'epi.nii')
+    assert (ees is None) == (expected[0] is None)
+    assert (trt is None) == (expected[1] is None)
+    if ees is not None:
+        assert np.isclose(ees, expected[0])
+        assert np.isclose(trt, expected[1])
+
+
+def test_image_shape_memo(tmpdir):
+    """The memoized shape is invalidated when the file changes."""
+    tmpdir.chdir()
+    nb.Nifti1Image(np.zeros((5, 6, 7), dtype='uint8'), np.eye(4)).to_filename('epi.nii')
+    assert image_shape('epi.nii') == (5, 6, 7)
+
+    nb.Nifti1Image(np.zeros((5, 6, 8), dtype='uint8'), np.eye(4)).to_filename('epi.nii')
+    stat = os.stat('epi.nii')
+    os.utime('epi.nii', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert image_shape('epi.nii') == (5, 6, 8)
+
+
+def test_resolve_readouts(tmpdir):
+    """All the EPI scans of a dataset are resolved at once, reading only their headers."""
+    from bids.layout import BIDSLayout
+
+    root = Path(str(tmpdir)) / 'ds'
+    func = root / 'sub-01' / 'func'
+    fmap = root / 'sub-01' / 'fmap'
+    func.mkdir(parents=True)
+    fmap.mkdir()
+    (root / 'dataset_description.json').write_text(
+        json.dumps({'Name': 'test', 'BIDSVersion': '1.4.0'}))
+    for path, meta in (
+        (func / 'sub-01_task-rest_bold', {'PhaseEncodingDirection': 'j',
+                                          'TotalReadoutTime': 0.039}),
+        (fmap / 'sub-01_dir-AP_epi', {'PhaseEncodingDirection': 'j-',
+                                      'EffectiveEchoSpacing': 0.001}),
+        (func / 'sub-01_task-nope_bold', {}),
+    ):
+        nb.Nifti1Image(np.zeros((20, 40, 10), dtype='uint8'),
+                       np.eye(4)).to_filename(str(path) + '.nii.gz')
+        Path(str(path) + '.json').write_text(json.dumps(meta))
+
+    readouts = resolve_readouts(BIDSLayout(str(root), validate=False))
+    assert sorted(Path(path).name for path in readouts) == [
+        'sub-01_dir-AP_epi.nii.gz', 'sub-01_task-rest_bold.nii.gz']
+    for meta in readouts.values():
+        assert np.isclose(meta['EffectiveEchoSpacing'], 0.001)
+        assert np.isclose(meta['TotalReadoutTime'], 0.039)
@@ -0,0 +1,70 @@
+"""Test the hashing strategies of nodes."""
+import os
+import pytest
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility as niu
+from nipype.interfaces.base import specs
+from nipype.utils import filemanip
+
+from ..hashing import _HASHES, hash_infile, memoize_content_hashes, set_hash_strategy
+
+
+def _copy(in_file):
+    from pathlib import Path
+    out = Path('copy.txt').absolute()
+    out.write_text(Path(in_file).read_text())
+    return str(out)
+
+
+def _workflow(tmpdir, raw_file):
+    wf = pe.Workflow(name='hashed_wf', base_dir=str(tmpdir / 'work'))
+    inputnode = pe.Node(niu.IdentityInterface(fields=['in_file']), name='inputnode')
+    inputnode.inputs.in_file = raw_file
+    read = pe.Node(niu.Function(function=_copy), name='read')
+    copy = pe.Node(niu.Function(function=_copy), name='copy')
+    wf.connect([
+        (inputnode, read, [('in_file', 'in_file')]),
+        (read, copy, [('out', 'in_file')]),
+    ])
+    return wf
+
+
+def test_mixed_strategy(tmpdir):
+    """Raw inputs are hashed by contents, intermediates by timestamps."""
+    tmpdir.chdir()
+    raw_dir = tmpdir.mkdir('bids')
+    raw_file = raw_dir.join('sub-01_bold.txt')
+    raw_file.write('raw data')
+
+    wf = _workflow(tmpdir, str(raw_file))
+    assert set_hash_strategy(wf, 'mixed', raw_dirs=[str(raw_dir)]) == ['hashed_wf.read']
+    with memoize_content_hashes():
+        wf.run(plugin='Linear')
+        assert any(key[0] == os.path.realpath(str(raw_file)) for key in _HASHES)
+    # The memo is scoped to the block
+    assert specs.hash_infile is filemanip.hash_infile
+    assert not _HASHES
+
+    result = tmpdir / 'work' / 'hashed_wf' / 'read' / 'result_read.pklz'
+    mtime = result.mtime()
+
+    # Touching the raw file does not trigger recomputing
+    os.utime(str(raw_file), (0, 0))
+    wf = _workflow(tmpdir, str(raw_file))
+    set_hash_strategy(wf, 'mixed', raw_dirs=[str(raw_dir)])
+    wf.run(plugin='Linear')
+    assert result.mtime() == mtime
+
+    with pytest.raises(ValueError):
+        set_hash_strategy(wf, 'fast')
+
+
+def test_hash_infile(tmpdir):
+    """Memoized hashes follow the changes of files."""
+    tmpdir.chdir()
+    tmpdir.join('data.txt').write('some data')
+    assert hash_infile('data.txt') == filemanip.hash_infile('data.txt')
+
+    tmpdir.join('data.txt').write('other data')
+    assert hash_infile('data.txt') == filemanip.hash_infile('data.txt')
+    assert hash_infile('missing.txt') is None
@@ -0,0 +1,63 @@
+"""Test the writing of NIfTI images."""
+import gzip
+import zlib
+import numpy as np
+import nibabel as nb
+import pytest
+
+from ..nifti import ParallelGzipFile, gzip_level, set_gzip_level, to_filename
+
+
+@pytest.mark.parametrize('num_threads', [1, 3])
+@pytest.mark.parametrize('block_size', [1000, 2 ** 16])
+@pytest.mark.parametrize('level', [1, 9])
+def test_parallel_gzip(tmpdir, num_threads, block_size, level):
+    """The blocks compressed in parallel form one standard gzip stream."""
+    tmpdir.chdir()
+    rng = np.random.RandomState(0)
+    data = np.cumsum(rng.randint(-3, 4, size=100000)).astype('<i2').tobytes()
+    with ParallelGzipFile('data.gz', num_threads=num_threads, level=level,
+                          block_size=block_size) as fobj:
+        for start in range(0, len(data), 7777):
+            fobj.write(data[start:start + 7777])
+        assert fobj.tell() == len(data)
+
+    raw = open('data.gz', 'rb').read()
+    assert gzip.decompress(raw) == data
+    # A single member, decompressed by zlib with the checks of the trailer
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decomp.decompress(raw) == data
+    assert decomp.eof and not decomp.unused_data
+
+
+def test_parallel_gzip_empty(tmpdir):
+    tmpdir.chdir()
+    ParallelGzipFile('empty.gz').close()
+    assert gzip.decompress(open('empty.gz', 'rb').read()) == b''
+
+
+def test_to_filename(tmpdir, monkeypatch):
+    """Images are the same as NiBabel writes them, at the configured level."""
+    tmpdir.chdir()
+    data = np.cumsum(np.ones((20, 30, 40, 3), dtype='f4'), axis=0)
+    img = nb.Nifti1Image(data, np.diag([2., 2., 2., 1.]))
+    img.to_filename('nibabel.nii.gz')
+
+    # Restored (unset) after the test
+    monkeypatch.setenv('SDCFLOWS_GZIP_LEVEL', '9')
+    monkeypatch.delenv('SDCFLOWS_GZIP_LEVEL')
+    assert gzip_level() == 1
+    to_filename(img, 'fast.nii.gz', num_threads=2)
+    set_gzip_level(9)
+    to_filename(img, 'small.nii.gz', num_threads=2)
+    to_filename(img, 'plain.nii')
+
+    expected = gzip.open('nibabel.nii.gz').read()
+    assert gzip.open('fast.nii.gz').read() == expected
+    assert gzip.open('small.nii.gz').read() == expected
+    assert open('plain.nii', 'rb').read() == expected
+    assert tmpdir.join('small.nii.gz').size() < tmpdir.join('fast.nii.gz').size()
+    assert np.array_equal(nb.load('small.nii.gz').get_fdata(), data)
+
+    with pytest.raises(ValueError):
+        set_gzip_level(10)
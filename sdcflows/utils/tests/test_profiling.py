@@ -0,0 +1,42 @@
+"""Test the profiling of workflows."""
+import json
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility as niu
+
+from ..profiling import NodeProfiler, dependencies, write_profile
+
+
+def _write(size):
+    from pathlib import Path
+    out = Path('data.bin').absolute()
+    out.write_bytes(b'0' * size)
+    return str(out)
+
+
+def _read(in_file):
+    from pathlib import Path
+    return len(Path(in_file).read_bytes())
+
+
+def test_profiler(tmpdir):
+    """Check that every node is recorded, with its files and the critical path."""
+    tmpdir.chdir()
+
+    wf = pe.Workflow(name='profiled_wf', base_dir=str(tmpdir))
+    write = pe.Node(niu.Function(function=_write), name='write')
+    write.inputs.size = 1000
+    read = pe.Node(niu.Function(function=_read), name='read')
+    wf.connect(write, 'out', read, 'in_file')
+
+    profiler = NodeProfiler()
+    graph = wf.run(plugin='Linear', plugin_args={'status_callback': profiler})
+    assert set(profiler.records) == {'profiled_wf.write', 'profiled_wf.read'}
+
+    assert profiler.records['profiled_wf.write']['output_bytes'] >= 1000
+    assert profiler.records['profiled_wf.read']['input_bytes'] == 1000
+    assert profiler.records['profiled_wf.read']['interface'] == 'Function'
+
+    write_profile(profiler.records, str(tmpdir / 'profile.json'), dependencies(graph))
+    profile = json.loads((tmpdir / 'profile.json').read())
+    assert profile['critical_path']['nodes'] == ['profiled_wf.write', 'profiled_wf.read']
+    assert (tmpdir / 'profile.csv').read().splitlines()[0].startswith('name,node,')
@@ -0,0 +1,28 @@
+"""Test the resource estimates of nodes."""
+import pytest
+
+from ..resources import COST_MODELS, DEFAULT_SHAPE, node_resources
+
+
+@pytest.mark.parametrize('kind', sorted(COST_MODELS))
+def test_node_resources(kind):
+    """Estimates grow with the images, and threads never exceed the limit."""
+    small = node_resources(kind, (48, 48, 30, 100), omp_nthreads=4)
+    large = node_resources(kind, (192, 192, 120, 100), omp_nthreads=4)
+
+    assert 0 < small['mem_gb'] < large['mem_gb']
+    assert 1 <= small['n_procs'] <= large['n_procs'] <= 4
+    assert node_resources(kind, omp_nthreads=4) == node_resources(
+        kind, DEFAULT_SHAPE, omp_nthreads=4)
+
+
+def test_node_resources_series():
+    """Only the processing of series scales with the number of volumes."""
+    assert node_resources('filter', (64, 64, 36, 200)) == node_resources('filter', (64, 64, 36))
+    assert node_resources('series', (64, 64, 36, 200))['mem_gb'] > node_resources(
+        'series', (64, 64, 36))['mem_gb']
+
+
+def test_node_resources_unknown():
+    with pytest.raises(KeyError):
+        node_resources('unknown')
@@ -0,0 +1,40 @@
+"""Test the robust EPI template."""
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.spatial.transform import Rotation
+
+from ..template import apply_rigid, robust_template
+
+
+def test_robust_template():
+    """Recover the motion of a synthetic series, and build its template."""
+    rng = np.random.RandomState(1)
+    zooms = (3.0, 3.0, 3.0)
+    base = ndi.gaussian_filter(rng.rand(40, 40, 30).astype('float32'), 2)
+    base = 1000 * (base - base.min()) / (base.max() - base.min())
+    base[:5] = base[-5:] = base[:, :5] = base[:, -5:] = 0
+
+    truth, volumes = [], []
+    for _ in range(8):
+        rot = Rotation.from_rotvec(rng.randn(3) * 0.01).as_matrix()
+        trans = rng.randn(3)
+        truth.append((rot, trans))
+        volumes.append(apply_rigid(base, rot, trans, zooms=zooms) * (1 + 0.1 * rng.randn())
+                       + 5 * rng.randn(*base.shape))
+    data = np.stack(volumes, axis=-1)
+
+    template, xfms, indices = robust_template(data, zooms=zooms, max_volumes=6,
+                                              num_threads=2)
+    assert indices.tolist() == [0, 1, 3, 4, 6, 7]
+
+    # Volumes are aligned to the first one
+    rot0, trans0 = truth[0]
+    for (rot, trans, _), index in zip(xfms, indices):
+        rot_i, trans_i = truth[index]
+        assert np.abs(rot_i.T.dot(rot0) - rot).max() * 50 < 0.3
+        assert np.abs(rot_i.T.dot(trans0 - trans_i) - trans).max() < 0.3
+
+    # The template is in the space of the first volume
+    expected = apply_rigid(base, rot0, trans0, zooms=zooms)
+    mask = expected > 200
+    assert np.corrcoef(template[mask], expected[mask])[0, 1] > 0.99
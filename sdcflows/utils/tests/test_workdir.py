@@ -0,0 +1,69 @@
+"""Test the collection of intermediate files."""
+import os
+import pytest
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility as niu
+
+from ..workdir import MANIFEST, WorkdirCollector, workflow_dependencies
+
+
+def _write(size):
+    from pathlib import Path
+    out = Path('data.bin').absolute()
+    out.write_bytes(b'1' * size)
+    return str(out)
+
+
+def _read(in_file, scale=1):
+    from pathlib import Path
+    return len(Path(in_file[0]).read_bytes()) * scale
+
+
+def _workflow(base_dir, scale=1):
+    wf = pe.Workflow(name='collected_wf', base_dir=str(base_dir))
+    wf.config['execution']['crashdump_dir'] = str(base_dir)
+    write = pe.Node(niu.Function(function=_write), name='write')
+    write.inputs.size = 2 ** 21
+    # Merge passes the file through, so it must outlive the merge node
+    merge = pe.Node(niu.Merge(1), name='merge')
+    read = pe.Node(niu.Function(function=_read), name='read')
+    read.inputs.scale = scale
+    wf.connect([
+        (write, merge, [('out', 'in1')]),
+        (merge, read, [('out', 'in_file')]),
+    ])
+    return wf
+
+
+def test_collector(tmpdir):
+    """Check that intermediates are collected once read, and reruns are not affected."""
+    tmpdir.chdir()
+    wf = _workflow(tmpdir)
+    collector = WorkdirCollector(workflow_dependencies(wf))
+    wf.run(plugin='Linear', plugin_args={'status_callback': collector})
+
+    data = tmpdir / 'collected_wf' / 'write' / 'data.bin'
+    stat = os.stat(str(data))
+    assert stat.st_size == 2 ** 21
+    assert stat.st_blocks * 512 < 2 ** 20
+    assert (tmpdir / 'collected_wf' / 'write' / MANIFEST).check()
+    assert not (tmpdir / 'collected_wf' / 'read' / MANIFEST).check()
+
+    summary = collector.summary()
+    assert summary['collected_nodes'] == 1
+    assert summary['collected_bytes'] >= 2 ** 21
+    assert summary['peak_bytes'] >= 2 ** 21 > summary['current_bytes']
+    assert set(summary['groups']) == {'collected_wf'}
+
+    # Nothing is recomputed from the collected files
+    wf = _workflow(tmpdir)
+    results = wf.run(plugin='Linear', plugin_args={
+        'status_callback': WorkdirCollector(workflow_dependencies(wf))})
+    read = [node for node in results.nodes() if node.name == 'read'][0]
+    assert read.result.outputs.out == 2 ** 21
+
+    # ... and consumers that must run again do not read them
+    wf = _workflow(tmpdir, scale=2)
+    with pytest.raises(RuntimeError, match='were collected'):
+        wf.run(plugin='Linear', plugin_args={
+            'status_callback': WorkdirCollector(workflow_dependencies(wf))})
@@ -0,0 +1,119 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+A cache of the versions of external tools.
+
+Workflow builders report the versions of the tools they use in their boilerplate
+(``__desc__``), and probing a version means starting the external binary.
+:func:`tool_version` runs each probe once per process and, optionally, stores
+the results in a JSON file (set with the ``SDCFLOWS_VERSIONS_CACHE`` environment
+variable, or :func:`set_versions_cache`) that other processes reuse.
+Stored versions are invalidated when the executable of the tool changes
+(i.e., when its path or modification time differ).
+
+    .. testsetup::
+
+        >>> tmpdir = getfixture('tmpdir')
+        >>> tmp = tmpdir.chdir() # changing to a temporary directory
+
+"""
+import os
+import json
+from shutil import which
+from tempfile import mkstemp
+
+_VERSIONS = {}
+_CACHE_FILE = [os.getenv('SDCFLOWS_VERSIONS_CACHE')]
+
+
+def _afni_version():
+    from nipype.interfaces import afni
+    return ''.join(['%02d' % v for v in afni.Info().version() or []]) or None
+
+
+def _ants_version():
+    from nipype.interfaces.ants import Registration
+    return Registration().version
+
+
+#: Probes of the versions of external tools, and their main executables
+PROBES = {
+    'afni': (_afni_version, '3dQwarp'),
+    'ants': (_ants_version, 'antsRegistration'),
+}
+
+
+def set_versions_cache(path):
+    """Set (or unset, with ``None``) the file where versions are stored."""
+    _CACHE_FILE[0] = None if path is None else str(path)
+
+
+def tool_version(tool, cache_file=None):
+    """
+    Return the version of an external tool (``None`` if not installed).
+
+    >>> from sdcflows.utils import versions
+    >>> versions.PROBES['mytool'] = (lambda: '1.0.2', 'ls')
+    >>> tool_version('mytool', cache_file='versions.json')
+    '1.0.2'
+    >>> versions.PROBES['mytool'] = (lambda: '2.0.0', 'ls')
+    >>> tool_version('mytool')  # The result was memoized
+    '1.0.2'
+    >>> versions._VERSIONS.clear()
+    >>> tool_version('mytool', cache_file='versions.json')  # Stored on disk
+    '1.0.2'
+    >>> del versions.PROBES['mytool']; versions._VERSIONS.clear()
+
+    """
+    if tool in _VERSIONS:
+        return _VERSIONS[tool]
+
+    probe, executable = PROBES[tool]
+    cache_file = cache_file or _CACHE_FILE[0]
+    stamp = _executable_stamp(executable)
+
+    stored = _read_cache(cache_file).get(tool) if cache_file else None
+    if stored is not None and stored.get('executable') == stamp:
+        version = stored.get('version')
+    else:
+        try:
+            version = probe()
+        except Exception:  # Failing to probe a version must not break workflows
+            version = None
+        if cache_file:
+            _update_cache(cache_file, tool, {'version': version, 'executable': stamp})
+
+    _VERSIONS[tool] = version
+    return version
+
+
+def _executable_stamp(executable):
+    """Identify the installed executable by its path and modification time."""
+    path = which(executable)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    return [path, os.stat(path).st_mtime_ns]
+
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file) as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_cache(cache_file, tool, entry):
+    """Add an entry to the on-disk cache, replacing the file atomically."""
+    dirname = os.path.dirname(os.path.abspath(cache_file))
+    try:
+        os.makedirs(dirname, exist_ok=True)
+        contents = _read_cache(cache_file)
+        contents[tool] = entry
+        fd, tmpname = mkstemp(dir=dirname, prefix='.versions-')
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(contents, fobj, indent=2)
+        os.replace(tmpname, cache_file)
+    except OSError:  # A read-only cache is just not updated
+        pass
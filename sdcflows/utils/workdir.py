@@ -0,0 +1,276 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Eager collection of the intermediate files of the working directory.
+
+:class:`WorkdirCollector` is a ``status_callback`` for nipype's execution plugins,
+which frees the scratch space held by the outputs of a node as soon as every
+node consuming them has finished.
+Nodes passing files through (e.g., ``Merge`` or ``Select``) extend the lifetime
+of the files they forward until their own consumers finish, and the outputs of
+nodes without consumers (the results of the workflow) are never collected.
+
+Collected files are not deleted, but *truncated*: they are replaced by sparse
+files (which take no disk space) of the same size and modification time, and
+listed in a ``_sdcflows_collected.json`` manifest of the working directory of
+the node.
+The hash files and results of nodes are kept, so that rerun decisions, which
+with nipype's default ``timestamp`` hashing only depend on the size and time of
+files, are unchanged: re-running a finished workflow (or resuming one that
+crashed) does not recompute anything.
+A node that must actually run again (e.g., because its parameters changed) on
+collected inputs stops the execution with an error instead of reading them
+(nodes that the ``MultiProc`` plugin runs without submitting are not checked);
+the working directories of the collected nodes must then be removed.
+
+The collector also accounts the scratch space (disk usage) of the working
+directories of nodes, and its peak, overall and by groups of nodes
+(:meth:`WorkdirCollector.summary`).
+
+"""
+import os
+import json
+from fnmatch import fnmatch
+
+#: The manifest of the files collected within the working directory of a node
+MANIFEST = '_sdcflows_collected.json'
+
+#: Files that are never collected (hash files, results and reports of nodes)
+KEEP_PATTERNS = ('_0x*.json', '*.pklz', 'command.txt', '_report', MANIFEST)
+
+
+class WorkdirCollector:
+    """
+    Collect the intermediate files of nodes once their consumers have finished.
+
+    Pass it as the ``status_callback`` argument of the plugin, along with the
+    dependencies of the nodes to run (see :func:`workflow_dependencies`)::
+
+        collector = WorkdirCollector(workflow_dependencies(workflow))
+        workflow.run(plugin='MultiProc', plugin_args={'status_callback': collector})
+        print(collector.summary()['peak_bytes'])
+
+    **Parameters**
+
+        dependencies : dict
+            Map of the (full) names of nodes onto those of their predecessors
+        min_bytes : int
+            Files smaller than this are not collected
+        group_depth : int or None
+            Scratch usage is also reported for groups of nodes, by the first
+            ``group_depth`` levels of their hierarchy of workflows (e.g., ``3`` for
+            the runs of :func:`~sdcflows.workflows.base.init_sdc_participant_wf`);
+            by default, the workflow directly containing the nodes
+
+    """
+
+    def __init__(self, dependencies, min_bytes=1024 ** 2, group_depth=None):
+        self.min_bytes = min_bytes
+        self.group_depth = group_depth
+        self._predecessors = {name: set(preds) for name, preds in dependencies.items()}
+        self._successors = {name: set() for name in dependencies}
+        for name, preds in dependencies.items():
+            for pred in preds:
+                self._successors.setdefault(pred, set()).add(name)
+
+        self._dirs = {}
+        self._finished = set()
+        self._released = set()
+        self._collected = set()
+        # The nodes referencing the outputs of each node, and vice versa
+        self._holders = {}
+        self._held = {}
+
+        self._usage = {}
+        self._groups = {}
+        self.current_bytes = 0
+        self.peak_bytes = 0
+        self.collected_bytes = 0
+
+    def __call__(self, node, status):
+        name = node.fullname
+        if name not in self._predecessors:  # e.g., the subnodes of MapNodes
+            return
+        if status == 'start':
+            self._check_inputs(node)
+        elif status == 'end':
+            self._finish(node)
+
+    def summary(self):
+        """Report the peak scratch usage, overall and by groups, and the space freed."""
+        return {
+            'peak_bytes': self.peak_bytes,
+            'current_bytes': self.current_bytes,
+            'collected_bytes': self.collected_bytes,
+            'collected_nodes': len(self._collected),
+            'groups': {group: peak for group, (_, peak) in sorted(self._groups.items())},
+        }
+
+    def _finish(self, node):
+        name = node.fullname
+        outdir = node.output_dir()
+        self._dirs[name] = outdir
+        self._finished.add(name)
+        if os.path.isfile(os.path.join(outdir, MANIFEST)):
+            self._collected.add(name)  # collected by a previous execution
+
+        self._holders.setdefault(name, set()).add(name)
+        self._held.setdefault(name, set()).add(name)
+        for owner in self._owners(_output_files(node)):
+            self._holders.setdefault(owner, set()).add(name)
+            self._held[name].add(owner)
+        self._account(name)
+
+        # The nodes whose outputs may not be needed anymore
+        candidates = set()
+        for holder in self._predecessors[name] | {name}:
+            candidates.update(self._held.get(holder, ()))
+        for candidate in sorted(candidates):
+            if candidate not in self._released and self._collectable(candidate):
+                self._collect(candidate)
+
+    def _collectable(self, name):
+        for holder in self._holders.get(name, ()):
+            successors = self._successors.get(holder, set())
+            if not successors or not successors <= self._finished:
+                return False
+        return True
+
+    def _collect(self, name):
+        outdir = self._dirs[name]
+        manifest = _read_manifest(outdir)
+        for path in _tree_files(outdir):
+            relpath = os.path.relpath(path, outdir)
+            if relpath in manifest or _keep(relpath):
+                continue
+            stat = os.lstat(path)
+            # Hard links may share their data with inputs (even raw data)
+            if stat.st_size < self.min_bytes or stat.st_nlink > 1:
+                continue
+            self.collected_bytes += _disk_bytes(stat)
+            os.truncate(path, 0)
+            os.truncate(path, stat.st_size)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            manifest[relpath] = [stat.st_size, stat.st_mtime_ns]
+
+        self._released.add(name)
+        if manifest:
+            with open(os.path.join(outdir, MANIFEST), 'w') as fobj:
+                json.dump(manifest, fobj, indent=2)
+            self._collected.add(name)
+            self._account(name)
+
+    def _check_inputs(self, node):
+        """Stop before a node that must run again reads collected files."""
+        name = node.fullname
+        collected = set()
+        for pred in self._predecessors[name]:
+            collected.update(owner for owner in self._held.get(pred, ())
+                             if owner in self._collected)
+        if not collected or node.is_cached()[1]:
+            return
+        raise RuntimeError(
+            'Node "%s" must run again, but the outputs of %s were collected. '
+            'Remove their working directories (%s) to recompute them.' % (
+                name, ', '.join('"%s"' % c for c in sorted(collected)),
+                ', '.join(self._dirs[c] for c in sorted(collected))))
+
+    def _owners(self, paths):
+        """Find the nodes whose working directories contain some files."""
+        owners = set()
+        for path in paths:
+            for name, outdir in self._dirs.items():
+                if path.startswith(outdir + os.sep):
+                    owners.add(name)
+        return owners
+
+    def _account(self, name):
+        usage = _tree_bytes(self._dirs[name])
+        delta = usage - self._usage.get(name, 0)
+        self._usage[name] = usage
+        self.current_bytes += delta
+        self.peak_bytes = max(self.peak_bytes, self.current_bytes)
+
+        group = '.'.join(name.split('.')[:-1][:self.group_depth])
+        current, peak = self._groups.get(group, (0, 0))
+        self._groups[group] = (current + delta, max(peak, current + delta))
+
+
+def workflow_dependencies(workflow):
+    """
+    Map the (full) names of the nodes a workflow will run onto those of their predecessors.
+
+    Identity nodes, which nipype removes from the graph it executes, are skipped.
+
+    >>> from nipype.pipeline import engine as pe
+    >>> from nipype.interfaces import utility as niu
+    >>> wf = pe.Workflow(name='wf')
+    >>> a = pe.Node(niu.Function(function=lambda x: x), name='a')
+    >>> ident = pe.Node(niu.IdentityInterface(fields=['x']), name='ident')
+    >>> b = pe.Node(niu.Function(function=lambda x: x), name='b')
+    >>> wf.connect([(a, ident, [('out', 'x')]), (ident, b, [('x', 'x')])])
+    >>> sorted(workflow_dependencies(wf).items())
+    [('wf.a', []), ('wf.b', ['wf.a'])]
+
+    """
+    from .profiling import dependencies
+
+    return dependencies(executed_graph(workflow))
+
+
+def executed_graph(workflow):
+    """Generate (a copy of) the graph of nodes nipype executes when running a workflow."""
+    from copy import deepcopy
+    from nipype.pipeline.engine.utils import generate_expanded_graph
+
+    return generate_expanded_graph(deepcopy(workflow._create_flat_graph()))
+
+
+def _output_files(node):
+    """List the files referenced by the outputs of a finished node."""
+    outputs = getattr(node.result, 'outputs', None)
+    files = []
+    _find_files(outputs.get() if outputs is not None else {}, files)
+    return [os.path.abspath(f) for f in files]
+
+
+def _find_files(value, files):
+    if isinstance(value, dict):
+        for val in value.values():
+            _find_files(val, files)
+    elif isinstance(value, (list, tuple)):
+        for val in value:
+            _find_files(val, files)
+    elif isinstance(value, str) and os.path.isfile(value):
+        files.append(value)
+
+
+def _keep(relpath):
+    return any(fnmatch(part, pattern) for part in relpath.split(os.sep)
+               for pattern in KEEP_PATTERNS)
+
+
+def _read_manifest(outdir):
+    try:
+        with open(os.path.join(outdir, MANIFEST)) as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return {}
+
+
+def _tree_files(path):
+    for dirpath, _, filenames in os.walk(str(path)):
+        for fname in filenames:
+            fpath = os.path.join(dirpath, fname)
+            if os.path.isfile(fpath) and not os.path.islink(fpath):
+                yield fpath
+
+
+def _disk_bytes(stat):
+    """The space a file takes on disk (sparse files take less than their size)."""
+    blocks = getattr(stat, 'st_blocks', None)
+    return stat.st_size if blocks is None else blocks * 512
+
+
+def _tree_bytes(path):
+    return sum(_disk_bytes(os.lstat(f)) for f in _tree_files(path))
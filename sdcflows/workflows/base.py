@@ -40,8 +40,14 @@ from nipype.interfaces import utility as niu
 from nipype import logging
 
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
+from niworkflows.func.util import init_bold_reference_wf
+from niworkflows.interfaces.bids import DerivativesDataSink
 from niworkflows.interfaces.utility import KeySelect
 
+from ..utils.bids import get_fmaps
+from ..utils.epimanip import resolve_readout, resolve_readouts
+from ..utils.resources import read_shape
+
 # Fieldmap workflows
 from .pepolar import init_pepolar_unwarp_wf
 from .syn import init_syn_sdc_wf
@@ -57,7 +63,8 @@ FMAP_PRIORITY = {
 DEFAULT_MEMORY_MIN_GB = 0.01
 
 
-def init_sdc_wf(boldref, omp_nthreads=1, debug=False, ignore=None):
+def init_sdc_wf(boldref, omp_nthreads=1, debug=False, ignore=None, compact_warp=False,
+                fmap_cache=None):
     """
     This workflow implements the heuristics to choose a
     :abbr:`SDC (susceptibility distortion correction)` strategy.
@@ -71,6 +78,12 @@ def init_sdc_wf(boldref, omp_nthreads=1, debug=False, ignore=None):
     distortion correction)` method applied is that with the
     highest priority.
 
+    Fieldmaps that do not depend on the target run (e.g., PEPOLAR fieldmaps with
+    both PE blips) are estimated in their native space with
+    :func:`init_sdc_estimate_wf`, and then mapped onto the run.
+    Please use :func:`init_sdc_session_wf` to share these estimations among
+    all the runs of a session.
+
     .. workflow::
         :graph2use: orig
         :simple_form: yes
@@ -98,6 +111,14 @@ def init_sdc_wf(boldref, omp_nthreads=1, debug=False, ignore=None):
             Maximum number of threads an individual process may use
         debug : bool
             Enable debugging outputs
+        ignore : list
+            Fieldmap estimation strategies that should be skipped
+        compact_warp : bool
+            Write ``out_warp`` in the compact format (only the displacements along
+            the PE axis), see :mod:`sdcflows.interfaces.unwarp`
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) of estimated fieldmaps, which is
+            looked up before building the estimation workflows
 
     **Inputs**
         bold_ref
@@ -141,12 +162,7 @@ def init_sdc_wf(boldref, omp_nthreads=1, debug=False, ignore=None):
     if not isinstance(ignore, (list, tuple)):
         ignore = tuple(ignore)
 
-    fmaps = defaultdict(list, [])
-    for associated in boldref.get_associations(kind='InformedBy'):
-        if associated.suffix == 'epi':
-            fmaps[associated.suffix].append(associated)
-        # elif associated.suffix in ('phase', 'phasediff', 'fieldmap'):
-        #     fmaps['fieldmap'].append(associated)
+    fmaps = get_fmaps(boldref)
 
     workflow = Workflow(name='sdc_wf' if boldref else 'sdc_bypass_wf')
     inputnode = pe.Node(niu.IdentityInterface(
@@ -182,14 +198,16 @@ co-registration with the anatomical reference.
 
     # PEPOLAR path
     if 'epi' in fmaps:
-        outputnode.inputs.method = 'PEB/PEPOLAR (phase-encoding based / PE-POLARity)'
-        # Get EPI polarities and their metadata
-        sdc_unwarp_wf = init_pepolar_unwarp_wf(
-            bold_meta=boldref.get_metadata(),
-            epi_fmaps=[(fmap, fmap.get_metadata()["PhaseEncodingDirection"])
-                       for fmap in fmaps['epi']],
-            omp_nthreads=omp_nthreads,
-            name='pepolar_unwarp_wf')
+        estimate_wf = None
+        if _estimation_key(boldref, fmaps) is not None:
+            estimate_wf = init_sdc_estimate_wf(
+                fmaps['epi'], boldref.get_metadata()['PhaseEncodingDirection'],
+                omp_nthreads=omp_nthreads, fmap_cache=fmap_cache)
+
+        sdc_unwarp_wf, outputnode.inputs.method = _init_sdc_apply_wf(
+            workflow, boldref, fmaps, estimate_wf=estimate_wf,
+            omp_nthreads=omp_nthreads, debug=debug, compact_warp=compact_warp,
+            fmap_cache=fmap_cache)
 
         workflow.connect([
             (inputnode, sdc_unwarp_wf, [
@@ -286,3 +304,416 @@ co-registration with the anatomical reference.
     ])
 
     return workflow
+
+
+def init_sdc_estimate_wf(fmaps, pe_dir, omp_nthreads=1, fmap_cache=None, readouts=None,
+                         name='sdc_estimate_wf'):
+    """
+    Estimate a fieldmap in its native space, independently of the target EPI runs.
+
+    Currently, only :abbr:`PEPOLAR (PE-POLARity)` fieldmaps containing both the
+    matched and the opposed PE blips of the target runs are supported (see
+    :func:`~sdcflows.workflows.pepolar.init_pepolar_estimate_wf`).
+    The outputs of this workflow feed
+    :func:`~sdcflows.workflows.unwarp.init_sdc_unwarp_wf`, once per target run.
+    When the estimation is found in ``fmap_cache``, the workflow just forwards
+    the stored files.
+
+    **Parameters**
+
+        fmaps : list of pybids.BIDSFile
+            The ``epi`` fieldmaps that will be pooled into the estimation.
+        pe_dir : str
+            The PE direction of the target EPI runs.
+        omp_nthreads : int
+            Maximum number of threads an individual process may use
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) of estimated fieldmaps, which is
+            looked up before building the estimation workflows
+        readouts : dict
+            Metadata with the readout parameters resolved, indexed by path (see
+            :func:`~sdcflows.utils.epimanip.resolve_readouts`)
+        name : str
+            Name for this workflow
+
+    **Outputs**
+
+        fmap
+            The fieldmap in Hz
+        fmap_ref
+            The reference image corresponding to ``fmap``
+        fmap_mask
+            A brain mask corresponding to ``fmap``
+
+    """
+    from .pepolar import init_pepolar_estimate_wf, check_pes
+
+    epi_fmaps = [(fmap.path, fmap.get_metadata()['PhaseEncodingDirection'])
+                 for fmap in fmaps]
+    if not check_pes(epi_fmaps, pe_dir):
+        raise ValueError('Fieldmaps cannot be estimated independently of the target '
+                         'runs without EPI images with matched PE (%s).' % pe_dir)
+
+    matched = [fmap for fmap, (_, fmap_pe) in zip(fmaps, epi_fmaps) if fmap_pe == pe_dir]
+    metadata = _readout(matched[0], readouts)
+
+    if fmap_cache is not None:
+        from ..utils.cache import lookup_fieldmap
+        from .pepolar import _epi_paths, _pe_params
+
+        cached = lookup_fieldmap(fmap_cache, _epi_paths(epi_fmaps),
+                                 metadata, 'pepolar', _pe_params(pe_dir))
+        if cached is not None:
+            LOGGER.info('Reusing stored fieldmap estimation (%s).', cached['fmap'])
+            workflow = Workflow(name=name)
+            outputnode = pe.Node(niu.IdentityInterface(
+                fields=['fmap', 'fmap_ref', 'fmap_mask']), name='outputnode')
+            outputnode.inputs.trait_set(**cached)
+            workflow.add_nodes([outputnode])
+            return workflow
+
+    estimate_wf = init_pepolar_estimate_wf(omp_nthreads=omp_nthreads,
+                                           fmap_cache=fmap_cache,
+                                           in_shape=read_shape(matched[0].path),
+                                           name=name)
+    estimate_wf.inputs.inputnode.fmaps_epi = epi_fmaps
+    estimate_wf.inputs.inputnode.epi_pe_dir = pe_dir
+    estimate_wf.inputs.inputnode.metadata = metadata
+    return estimate_wf
+
+
+def init_sdc_session_wf(boldrefs, omp_nthreads=1, debug=False, ignore=None,
+                        compact_warp=False, fmap_cache=None, layout=None, readouts=None,
+                        name='sdc_session_wf'):
+    """
+    Build the :abbr:`SDC (susceptibility distortion correction)` of several runs at once.
+
+    Runs are grouped by their fieldmap associations, so that each unique fieldmap
+    is estimated only once (with :func:`init_sdc_estimate_wf`), and then mapped
+    onto every run it is intended for (with
+    :func:`~sdcflows.workflows.unwarp.init_sdc_unwarp_wf`).
+    Runs whose fieldmaps cannot be estimated independently (i.e., PEPOLAR
+    without matched-PE images) fall back to one
+    :func:`~sdcflows.workflows.pepolar.init_pepolar_unwarp_wf` per run.
+
+    **Parameters**
+
+        boldrefs : list of pybids.BIDSFile
+            BIDSFile objects with suffix ``bold``, ``sbref`` or ``dwi``.
+        omp_nthreads : int
+            Maximum number of threads an individual process may use
+        debug : bool
+            Enable debugging outputs
+        ignore : list
+            Fieldmap estimation strategies that should be skipped
+        compact_warp : bool
+            Write ``out_warp`` in the compact format (only the displacements along
+            the PE axis), see :mod:`sdcflows.interfaces.unwarp`
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) of estimated fieldmaps, which is
+            looked up before building the estimation workflows
+        layout : bids.layout.BIDSLayout
+            The BIDS layout indexing ``boldrefs``, to resolve the readout parameters
+            of all their EPI scans in one pass
+        readouts : dict
+            Metadata with the readout parameters already resolved, indexed by path
+            (see :func:`~sdcflows.utils.epimanip.resolve_readouts`), which takes
+            precedence over ``layout``
+        name : str
+            Name for this workflow
+
+    **Inputs**
+        bold_ref
+            List of BOLD references (one per item of ``boldrefs``)
+        bold_ref_brain
+            Same as above, but brain-masked
+        bold_mask
+            List of brain masks (one per item of ``boldrefs``)
+
+    **Outputs**
+        bold_ref
+            List of unwarped BOLD references (one per item of ``boldrefs``)
+        bold_mask
+            List of new masks after unwarping
+        bold_ref_brain
+            List of brain-extracted, unwarped BOLD references
+        out_warp
+            List of deformation fields to unwarp the susceptibility distortions
+            (``None`` for runs without fieldmaps)
+        method
+            List of the SDC methods applied to each run
+
+    """
+    if ignore is None:
+        ignore = tuple()
+
+    if readouts is None and layout is not None:
+        readouts = resolve_readouts(
+            layout, subject=sorted({boldref.entities['subject'] for boldref in boldrefs}))
+
+    keys = [boldref.path for boldref in boldrefs]
+    fields = ['bold_ref', 'bold_mask', 'bold_ref_brain', 'out_warp', 'method']
+
+    workflow = Workflow(name=name)
+    inputnode = pe.Node(niu.IdentityInterface(
+        fields=['bold_ref', 'bold_ref_brain', 'bold_mask']), name='inputnode')
+    outputnode = pe.Node(niu.IdentityInterface(fields=fields), name='outputnode')
+
+    merges = {}
+    for field in fields:
+        merges[field] = pe.Node(niu.Merge(len(boldrefs)), name='merge_%s' % field,
+                                run_without_submitting=True)
+        workflow.connect(merges[field], 'out', outputnode, field)
+
+    estimators = {}
+    for i, boldref in enumerate(boldrefs, 1):
+        run_name = _run_name(boldref)
+        select = pe.Node(KeySelect(fields=['bold_ref', 'bold_ref_brain', 'bold_mask'],
+                                   keys=keys, key=boldref.path),
+                         name='select_%s' % run_name, run_without_submitting=True)
+        workflow.connect([
+            (inputnode, select, [('bold_ref', 'bold_ref'),
+                                 ('bold_ref_brain', 'bold_ref_brain'),
+                                 ('bold_mask', 'bold_mask')]),
+        ])
+
+        fmaps = get_fmaps(boldref)
+        if not fmaps or 'fieldmaps' in ignore:
+            merges['method'].set_input('in%d' % i, 'None')
+            merges['out_warp'].set_input('in%d' % i, None)
+            for field in ('bold_ref', 'bold_mask', 'bold_ref_brain'):
+                workflow.connect(select, field, merges[field], 'in%d' % i)
+            continue
+
+        estimate_wf = None
+        key = _estimation_key(boldref, fmaps)
+        if key is not None:
+            if key not in estimators:
+                estimators[key] = init_sdc_estimate_wf(
+                    fmaps['epi'], boldref.get_metadata()['PhaseEncodingDirection'],
+                    omp_nthreads=omp_nthreads, fmap_cache=fmap_cache, readouts=readouts,
+                    name='sdc_estimate_%02d_wf' % (len(estimators) + 1))
+            estimate_wf = estimators[key]
+
+        sdc_unwarp_wf, method = _init_sdc_apply_wf(
+            workflow, boldref, fmaps, estimate_wf=estimate_wf,
+            omp_nthreads=omp_nthreads, debug=debug, compact_warp=compact_warp,
+            fmap_cache=fmap_cache, readouts=readouts,
+            name='sdc_unwarp_%s_wf' % run_name)
+        merges['method'].set_input('in%d' % i, method)
+
+        workflow.connect([
+            (select, sdc_unwarp_wf, [
+                ('bold_ref', 'inputnode.in_reference'),
+                ('bold_mask', 'inputnode.in_mask'),
+                ('bold_ref_brain', 'inputnode.in_reference_brain')]),
+            (sdc_unwarp_wf, merges['out_warp'], [('outputnode.out_warp', 'in%d' % i)]),
+            (sdc_unwarp_wf, merges['bold_ref'], [
+                ('outputnode.out_reference', 'in%d' % i)]),
+            (sdc_unwarp_wf, merges['bold_ref_brain'], [
+                ('outputnode.out_reference_brain', 'in%d' % i)]),
+            (sdc_unwarp_wf, merges['bold_mask'], [('outputnode.out_mask', 'in%d' % i)]),
+        ])
+
+    LOGGER.info('Building SDC for %d runs with %d shared fieldmap estimations.',
+                len(boldrefs), len(estimators))
+    return workflow
+
+
+def init_sdc_participant_wf(boldrefs, output_dir, omp_nthreads=1, debug=False,
+                            ignore=None, compact_warp=False, fmap_cache=None,
+                            layouts=None, name='sdcflows_wf'):
+    """
+    Build the :abbr:`SDC (susceptibility distortion correction)` of many participants.
+
+    The runs of each subject are grouped in one workflow, which calculates their
+    references (with :func:`~niworkflows.func.util.init_bold_reference_wf`),
+    corrects them with :func:`init_sdc_session_wf` (so that shared fieldmaps are
+    estimated only once), and writes the deformation fields and the unwarped
+    references of runs with fieldmaps into ``output_dir``.
+    All subjects are nested within one workflow, so that a single scheduler
+    runs them in parallel, within the resources it is given.
+
+    **Parameters**
+
+        boldrefs : list of pybids.BIDSFile
+            BIDSFile objects with suffix ``bold``, ``sbref`` or ``dwi``
+            (of any number of subjects).
+        output_dir : str
+            The root folder of the derivatives
+        omp_nthreads : int
+            Maximum number of threads an individual process may use
+        debug : bool
+            Enable debugging outputs
+        ignore : list
+            Fieldmap estimation strategies that should be skipped
+        compact_warp : bool
+            Write ``out_warp`` in the compact format (only the displacements along
+            the PE axis), see :mod:`sdcflows.interfaces.unwarp`
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) of estimated fieldmaps, which is
+            looked up before building the estimation workflows
+        layouts : list of bids.layout.BIDSLayout
+            The BIDS layouts indexing ``boldrefs`` (see
+            :func:`~sdcflows.utils.bids.get_layouts`), to resolve the readout
+            parameters of all their EPI scans in one pass
+        name : str
+            Name for this workflow
+
+    """
+    if ignore is None:
+        ignore = tuple()
+
+    subjects = defaultdict(list)
+    for boldref in boldrefs:
+        subjects[boldref.entities['subject']].append(boldref)
+
+    readouts = None
+    if layouts is not None:
+        readouts = {}
+        for layout in layouts:
+            readouts.update(resolve_readouts(layout, subject=sorted(subjects)))
+
+    workflow = Workflow(name=name)
+    for subject, sub_boldrefs in sorted(subjects.items()):
+        session_wf = init_sdc_session_wf(
+            sub_boldrefs, omp_nthreads=omp_nthreads, debug=debug, ignore=ignore,
+            compact_warp=compact_warp, fmap_cache=fmap_cache, readouts=readouts,
+            name='sdc_sub_%s_wf' % subject)
+        _connect_participant_io(session_wf, sub_boldrefs, output_dir,
+                                omp_nthreads=omp_nthreads, ignore=ignore)
+        workflow.add_nodes([session_wf])
+
+    LOGGER.info('Building SDC for %d subjects (%d runs).', len(subjects), len(boldrefs))
+    return workflow
+
+
+def _connect_participant_io(workflow, boldrefs, output_dir, omp_nthreads=1, ignore=()):
+    """Feed the references of runs into a session workflow, and store its results."""
+    fields = ['bold_ref', 'bold_ref_brain', 'bold_mask']
+    merges = {}
+    for field in fields:
+        merges[field] = pe.Node(niu.Merge(len(boldrefs)), name='merge_in_%s' % field,
+                                run_without_submitting=True)
+        workflow.connect(merges[field], 'out', workflow.get_node('inputnode'), field)
+
+    outputnode = workflow.get_node('outputnode')
+    for i, boldref in enumerate(boldrefs, 1):
+        run_name = _run_name(boldref)
+        bold_reference_wf = init_bold_reference_wf(
+            omp_nthreads=omp_nthreads, bold_file=boldref.path,
+            name='bold_reference_%s_wf' % run_name)
+        workflow.connect([
+            (bold_reference_wf, merges['bold_ref'], [('outputnode.ref_image', 'in%d' % i)]),
+            (bold_reference_wf, merges['bold_ref_brain'], [
+                ('outputnode.ref_image_brain', 'in%d' % i)]),
+            (bold_reference_wf, merges['bold_mask'], [('outputnode.bold_mask', 'in%d' % i)]),
+        ])
+
+        if not get_fmaps(boldref) or 'fieldmaps' in ignore:
+            continue
+
+        for field, desc, suffix in (('out_warp', 'sdc', 'warp'),
+                                    ('bold_ref', 'sdc', 'boldref')):
+            select = pe.Node(niu.Select(index=[i - 1]),
+                             name='select_%s_%s' % (field, run_name),
+                             run_without_submitting=True)
+            # Derivatives are gzipped even if intermediates are not (--uncompressed-intermediates)
+            dsink = pe.Node(DerivativesDataSink(
+                base_directory=str(output_dir), source_file=boldref.path,
+                desc=desc, suffix=suffix, compress=True),
+                name='ds_%s_%s' % (field, run_name),
+                mem_gb=DEFAULT_MEMORY_MIN_GB, run_without_submitting=True)
+            dsink.interface.out_path_base = 'sdcflows'
+            workflow.connect([
+                (outputnode, select, [(field, 'inlist')]),
+                (select, dsink, [('out', 'in_file')]),
+            ])
+
+
+def _init_sdc_apply_wf(workflow, boldref, fmaps, estimate_wf=None, omp_nthreads=1,
+                       debug=False, compact_warp=False, fmap_cache=None, readouts=None,
+                       name='pepolar_unwarp_wf'):
+    """
+    Generate the workflow applying SDC to one run, connected to its fieldmap estimation.
+
+    Returns the workflow and the name of the SDC method.
+    """
+    from .pepolar import check_pes
+
+    method = 'PEB/PEPOLAR (phase-encoding based / PE-POLARity)'
+    metadata = boldref.get_metadata()
+
+    if estimate_wf is None:
+        epi_fmaps = [(fmap.path, fmap.get_metadata()['PhaseEncodingDirection'])
+                     for fmap in fmaps['epi']]
+        sdc_unwarp_wf = init_pepolar_unwarp_wf(
+            omp_nthreads=omp_nthreads,
+            matched_pe=check_pes(epi_fmaps, metadata['PhaseEncodingDirection']),
+            compact_warp=compact_warp,
+            fmap_cache=fmap_cache,
+            cache_inputs={'fmaps_epi': epi_fmaps, 'in_file': boldref.path,
+                          'bold_pe_dir': metadata['PhaseEncodingDirection']},
+            in_shape=read_shape(fmaps['epi'][0].path),
+            name=name)
+        sdc_unwarp_wf.inputs.inputnode.fmaps_epi = epi_fmaps
+        sdc_unwarp_wf.inputs.inputnode.bold_pe_dir = metadata['PhaseEncodingDirection']
+        return sdc_unwarp_wf, method
+
+    sdc_unwarp_wf = init_sdc_unwarp_wf(
+        omp_nthreads=omp_nthreads,
+        fmap_demean=False,
+        debug=debug,
+        vsm_method='native',
+        compact_warp=compact_warp,
+        in_shape=read_shape(boldref.path),
+        name=name)
+    sdc_unwarp_wf.inputs.inputnode.metadata = _readout(boldref, readouts)
+
+    workflow.connect([
+        (estimate_wf, sdc_unwarp_wf, [
+            ('outputnode.fmap', 'inputnode.fmap'),
+            ('outputnode.fmap_ref', 'inputnode.fmap_ref'),
+            ('outputnode.fmap_mask', 'inputnode.fmap_mask')]),
+    ])
+    return sdc_unwarp_wf, method
+
+
+def _estimation_key(boldref, fmaps):
+    """
+    Identify the fieldmap estimation a run requires, if it can be shared with other runs.
+
+    Returns ``None`` when the estimation depends on the run itself.
+    """
+    from .pepolar import check_pes
+
+    pe_dir = boldref.get_metadata()['PhaseEncodingDirection']
+    epi_fmaps = [(fmap.path, fmap.get_metadata()['PhaseEncodingDirection'])
+                 for fmap in fmaps.get('epi', [])]
+    if not epi_fmaps or not check_pes(epi_fmaps, pe_dir):
+        return None
+    return ('epi', pe_dir, tuple(sorted(path for path, _ in epi_fmaps)))
+
+
+def _readout(bids_file, readouts=None):
+    """Get the metadata of an EPI scan, with the readout parameters resolved."""
+    if readouts and bids_file.path in readouts:
+        return readouts[bids_file.path]
+    return resolve_readout(bids_file.get_metadata(), bids_file.path)
+
+
+def _run_name(boldref):
+    """
+    Generate a valid workflow name from the file name of an EPI run.
+
+    >>> class _File:
+    ...     path = '/data/sub-01/func/sub-01_task-rest_run-1_bold.nii.gz'
+    >>> _run_name(_File())
+    'sub_01_task_rest_run_1_bold'
+
+    """
+    import re
+    from os import path as op
+
+    fname = op.basename(boldref.path).split('.')[0]
+    return re.sub(r'[^a-zA-Z0-9]', '_', fname)
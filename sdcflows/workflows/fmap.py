@@ -18,6 +18,7 @@ of the BIDS specification.
 
 """
 
+from nipype import logging
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu, fsl, ants
 from nipype.workflows.dmri.fsl.utils import demean_image, cleanup_edge_pipeline
@@ -26,12 +27,19 @@ from niworkflows.interfaces.bids import DerivativesDataSink
 from niworkflows.interfaces.images import IntraModalMerge
 from niworkflows.interfaces.masks import BETRPT
 
+from ..interfaces.cache import StoreFieldmap
 from ..interfaces.fmap import (
     FieldEnhance, FieldToRadS, FieldToHz
 )
+from ..utils.cache import lookup_fieldmap, split_cache_inputs
+from ..utils.resources import node_resources
+from .phdiff import _unwrap_node
 
+LOGGER = logging.getLogger('nipype.workflow')
 
-def init_fmap_wf(omp_nthreads, fmap_bspline, name='fmap_wf'):
+
+def init_fmap_wf(omp_nthreads, fmap_bspline, unwrap_method='prelude', fmap_cache=None,
+                 cache_inputs=None, in_shape=None, name='fmap_wf'):
     """
     Fieldmap workflow - when we have a sequence that directly measures the fieldmap
     we just need to mask it (using the corresponding magnitude image) to remove the
@@ -44,25 +52,83 @@ def init_fmap_wf(omp_nthreads, fmap_bspline, name='fmap_wf'):
         from sdcflows.workflows.fmap import init_fmap_wf
         wf = init_fmap_wf(omp_nthreads=6, fmap_bspline=False)
 
+    **Parameters**:
+
+        omp_nthreads : int
+            Maximum number of threads an individual process may use
+        fmap_bspline : bool
+            Whether the fieldmap should be smoothed with B-Splines
+        unwrap_method : str
+            Phase unwrapping engine: FSL PRELUDE (``'prelude'``) or the
+            in-process Laplacian unwrapper (``'laplacian'``).
+            Unused when ``fmap_bspline`` is ``True``.
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) where the results of the estimation
+            are saved, for later invocations to reuse them (see
+            :func:`~sdcflows.utils.cache.lookup_fieldmap`).
+        cache_inputs : dict
+            The inputs identifying the estimation in ``fmap_cache``, known when
+            building the workflow (e.g., the ``fieldmap`` and ``magnitude`` files,
+            see :func:`~sdcflows.utils.cache.split_cache_inputs`).
+            When the estimation is found, the workflow just forwards the stored files.
+        in_shape : tuple
+            Shape of the fieldmap, to estimate the resources of the nodes
+            (see :func:`~sdcflows.utils.resources.node_resources`).
+
     """
 
+    params = {'fmap_bspline': fmap_bspline, 'unwrap_method': unwrap_method}
+
     workflow = Workflow(name=name)
     inputnode = pe.Node(niu.IdentityInterface(
         fields=['magnitude', 'fieldmap']), name='inputnode')
     outputnode = pe.Node(niu.IdentityInterface(fields=['fmap', 'fmap_ref', 'fmap_mask']),
                          name='outputnode')
 
+    if fmap_cache is not None and cache_inputs is not None:
+        in_files, metadata, extra = split_cache_inputs(cache_inputs)
+        params.update(extra)
+        cached = lookup_fieldmap(fmap_cache, in_files, metadata, 'fmap', params)
+        if cached is not None:
+            LOGGER.info('Reusing stored fieldmap estimation (%s).', cached['fmap'])
+            # Keep the inputnode (left unconnected), so that callers can wire it
+            outputnode.inputs.trait_set(**cached)
+            workflow.add_nodes([inputnode, outputnode])
+            return workflow
+
+    if fmap_cache is not None:
+        store_fmap = pe.Node(StoreFieldmap(cache=fmap_cache, estimator='fmap',
+                                           params=params),
+                             name='store_fmap', run_without_submitting=True)
+        workflow.connect([
+            (outputnode, store_fmap, [('fmap', 'fmap'),
+                                      ('fmap_ref', 'fmap_ref'),
+                                      ('fmap_mask', 'fmap_mask')]),
+        ])
+        if cache_inputs is not None:
+            store_fmap.inputs.in_files = in_files
+            store_fmap.inputs.metadata = metadata
+        else:
+            store_inputs = pe.Node(niu.Merge(2, ravel_inputs=True), name='store_inputs',
+                                   run_without_submitting=True)
+            workflow.connect([
+                (inputnode, store_inputs, [('magnitude', 'in1'),
+                                           ('fieldmap', 'in2')]),
+                (store_inputs, store_fmap, [('out', 'in_files')]),
+            ])
+
     # Merge input magnitude images
-    magmrg = pe.Node(IntraModalMerge(), name='magmrg')
+    magmrg = pe.Node(IntraModalMerge(), name='magmrg',
+                     **node_resources('series', in_shape))
     # Merge input fieldmap images
     fmapmrg = pe.Node(IntraModalMerge(zero_based_avg=False, hmc=False),
-                      name='fmapmrg')
+                      name='fmapmrg', **node_resources('series', in_shape))
 
     # de-gradient the fields ("bias/illumination artifact")
     n4_correct = pe.Node(ants.N4BiasFieldCorrection(dimension=3, copy_header=True),
-                         name='n4_correct', n_procs=omp_nthreads)
+                         name='n4_correct', **node_resources('n4', in_shape, omp_nthreads))
     bet = pe.Node(BETRPT(generate_report=True, frac=0.6, mask=True),
-                  name='bet')
+                  name='bet', **node_resources('filter', in_shape))
     ds_report_fmap_mask = pe.Node(DerivativesDataSink(
         desc='brain', suffix='mask'), name='ds_report_fmap_mask',
         run_without_submitting=True)
@@ -81,7 +147,8 @@ def init_fmap_wf(omp_nthreads, fmap_bspline, name='fmap_wf'):
     if fmap_bspline:
         # despike_threshold=1.0, mask_erode=1),
         fmapenh = pe.Node(FieldEnhance(unwrap=False, despike=False),
-                          name='fmapenh', mem_gb=4, n_procs=omp_nthreads)
+                          name='fmapenh',
+                          **node_resources('fmap_enhance', in_shape, omp_nthreads))
 
         workflow.connect([
             (bet, fmapenh, [('mask_file', 'in_mask'),
@@ -91,24 +158,26 @@ def init_fmap_wf(omp_nthreads, fmap_bspline, name='fmap_wf'):
         ])
 
     else:
-        torads = pe.Node(FieldToRadS(), name='torads')
-        prelude = pe.Node(fsl.PRELUDE(), name='prelude')
-        tohz = pe.Node(FieldToHz(), name='tohz')
+        torads = pe.Node(FieldToRadS(), name='torads', **node_resources('image', in_shape))
+        unwrap = _unwrap_node(unwrap_method, omp_nthreads, in_shape)
+        tohz = pe.Node(FieldToHz(), name='tohz', **node_resources('image', in_shape))
 
         denoise = pe.Node(fsl.SpatialFilter(operation='median', kernel_shape='sphere',
-                                            kernel_size=3), name='denoise')
-        demean = pe.Node(niu.Function(function=demean_image), name='demean')
+                                            kernel_size=3), name='denoise',
+                          **node_resources('filter', in_shape))
+        demean = pe.Node(niu.Function(function=demean_image), name='demean',
+                         **node_resources('image', in_shape))
         cleanup_wf = cleanup_edge_pipeline(name='cleanup_wf')
 
-        applymsk = pe.Node(fsl.ApplyMask(), name='applymsk')
+        applymsk = pe.Node(fsl.ApplyMask(), name='applymsk',
+                           **node_resources('filter', in_shape))
 
         workflow.connect([
-            (bet, prelude, [('mask_file', 'mask_file'),
-                            ('out_file', 'magnitude_file')]),
+            (bet, unwrap, [('mask_file', 'mask_file')]),
             (fmapmrg, torads, [('out_file', 'in_file')]),
             (torads, tohz, [('fmap_range', 'range_hz')]),
-            (torads, prelude, [('out_file', 'phase_file')]),
-            (prelude, tohz, [('unwrapped_phase_file', 'in_file')]),
+            (torads, unwrap, [('out_file', 'phase_file')]),
+            (unwrap, tohz, [('unwrapped_phase_file', 'in_file')]),
             (tohz, denoise, [('out_file', 'in_file')]),
             (denoise, demean, [('out_file', 'in_file')]),
             (demean, cleanup_wf, [('out', 'inputnode.in_file')]),
@@ -118,4 +187,7 @@ def init_fmap_wf(omp_nthreads, fmap_bspline, name='fmap_wf'):
             (applymsk, outputnode, [('out_file', 'fmap')]),
         ])
 
+        if unwrap_method == 'prelude':
+            workflow.connect([(bet, unwrap, [('out_file', 'magnitude_file')])])
+
     return workflow
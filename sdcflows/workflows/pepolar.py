@@ -8,20 +8,31 @@ Phase Encoding POLARity (*PEPOLAR*) techniques
 
 """
 
-import pkg_resources as pkgr
-
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 from niworkflows.interfaces import CopyHeader
 from niworkflows.interfaces.freesurfer import StructuralReference
 from niworkflows.interfaces.registration import ANTSApplyTransformsRPT
 from niworkflows.func.util import init_enhance_and_skullstrip_bold_wf
 
+from nipype import logging
 from nipype.pipeline import engine as pe
 from nipype.interfaces import afni, ants, utility as niu
 
+from ..data import data_path
+from ..interfaces.cache import StoreFieldmap
+from ..interfaces.epi import PEPolarWarp, RobustTemplate
+from ..interfaces.fmap import WarpToField
+from ..interfaces.unwarp import CompactWarp
+from ..utils.cache import lookup_fieldmap, split_cache_inputs
+from ..utils.resources import node_resources
+from ..utils.versions import tool_version
+
+LOGGER = logging.getLogger('nipype.workflow')
 
-def init_pepolar_unwarp_wf(omp_nthreads=1, matched_pe=False,
-                           name="pepolar_unwarp_wf"):
+
+def init_pepolar_unwarp_wf(omp_nthreads=1, matched_pe=False, compact_warp=False,
+                           fmap_cache=None, cache_inputs=None, template_method='freesurfer',
+                           estimator='qwarp', in_shape=None, name="pepolar_unwarp_wf"):
     """
     Create the PE-Polar field estimation workflow.
 
@@ -39,8 +50,8 @@ def init_pepolar_unwarp_wf(omp_nthreads=1, matched_pe=False,
     '_epi' file(s) (for example 'i' and 'j') is not supported.
 
     The warp field correcting for the distortions is estimated using AFNI's
-    3dQwarp, with displacement estimation limited to the target file phase
-    encoding direction.
+    3dQwarp (or :class:`~sdcflows.interfaces.epi.PEPolarWarp`), with displacement
+    estimation limited to the target file phase encoding direction.
 
     It also calculates a new mask for the input dataset that takes into
     account the distortions.
@@ -59,10 +70,33 @@ def init_pepolar_unwarp_wf(omp_nthreads=1, matched_pe=False,
             Whether the input ``fmaps_epi`` will contain images with matched
             PE blips or not. Please use :func:`sdcflows.workflows.pepolar.check_pes`
             to determine whether they exist or not.
+        compact_warp : bool
+            Write ``out_warp`` in the compact format (only the displacements along
+            the PE axis), see :mod:`sdcflows.interfaces.unwarp`.
+        estimator : str
+            Estimate displacements with AFNI's 3dQwarp (``'qwarp'``) or with
+            :class:`~sdcflows.interfaces.epi.PEPolarWarp` (``'native'``).
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) where the estimated displacements
+            field is saved, for later invocations to reuse it (see
+            :func:`~sdcflows.utils.cache.lookup_fieldmap`).
+        cache_inputs : dict
+            The inputs identifying the estimation in ``fmap_cache``, known when
+            building the workflow (e.g., the ``fmaps_epi``, the ``bold_pe_dir`` and
+            the target run, see :func:`~sdcflows.utils.cache.split_cache_inputs`).
+            When the displacements field is found, the estimation is skipped and
+            the stored field is applied to ``in_reference``.
         name : str
             Name for this workflow
         omp_nthreads : int
             Parallelize internal tasks across the number of CPUs given by this option.
+        in_shape : tuple
+            Shape of the (3D or 4D) EPI fieldmaps, to estimate the resources of nodes
+            (see :func:`~sdcflows.utils.resources.node_resources`).
+        template_method : str
+            How the EPI images are averaged into references: ``'freesurfer'``
+            (``mri_robust_template``) or ``'native'``
+            (:class:`~sdcflows.interfaces.epi.RobustTemplate`).
 
     **Inputs**:
 
@@ -93,17 +127,23 @@ def init_pepolar_unwarp_wf(omp_nthreads=1, matched_pe=False,
             The ``in_reference`` after unwarping and skullstripping
         out_warp : pathlike
             The corresponding :abbr:`DFM (displacements field map)` compatible with
-            ANTs.
+            ANTs (or in compact format, if ``compact_warp`` is set).
         out_mask : pathlike
             Mask of the unwarped input file
 
     """
+    cached = None
+    if fmap_cache is not None and cache_inputs is not None:
+        in_files, metadata, params = split_cache_inputs(cache_inputs)
+        params.update(estimator=estimator, template_method=template_method)
+        cached = lookup_fieldmap(fmap_cache, in_files, metadata, 'pepolar_unwarp', params)
+
     workflow = Workflow(name=name)
     workflow.__desc__ = """\
 A deformation field to correct for susceptibility distortions was estimated
 based on two echo-planar imaging (EPI) references with opposing phase-encoding
-directions, using `3dQwarp` @afni (AFNI {afni_ver}).
-""".format(afni_ver=''.join(['%02d' % v for v in afni.Info().version() or []]))
+directions, using {tool}.
+""".format(tool=_estimator_desc(estimator))
 
     inputnode = pe.Node(niu.IdentityInterface(
         fields=['fmaps_epi', 'in_reference', 'in_reference_brain',
@@ -113,41 +153,41 @@ directions, using `3dQwarp` @afni (AFNI {afni_ver}).
         fields=['out_reference', 'out_reference_brain', 'out_warp', 'out_mask']),
         name='outputnode')
 
-    prepare_epi_wf = init_prepare_epi_wf(omp_nthreads=omp_nthreads,
-                                         matched_pe=matched_pe,
-                                         name="prepare_epi_wf")
-
-    qwarp = pe.Node(afni.QwarpPlusMinus(
-        pblur=[0.05, 0.05], blur=[-1, -1], noweight=True, minpatch=9, nopadWARP=True,
-        environ={'OMP_NUM_THREADS': '%d' % omp_nthreads}),
-        name='qwarp', n_procs=omp_nthreads)
-
-    to_ants = pe.Node(niu.Function(function=_fix_hdr), name='to_ants',
-                      mem_gb=0.01)
-
-    cphdr_warp = pe.Node(CopyHeader(), name='cphdr_warp', mem_gb=0.01)
-
     unwarp_reference = pe.Node(ANTSApplyTransformsRPT(dimension=3,
                                                       generate_report=False,
                                                       float=True,
                                                       interpolation='LanczosWindowedSinc'),
-                               name='unwarp_reference')
+                               name='unwarp_reference',
+                               **node_resources('resample', in_shape, omp_nthreads))
 
     enhance_and_skullstrip_bold_wf = init_enhance_and_skullstrip_bold_wf(
         omp_nthreads=omp_nthreads)
 
+    if cached is not None:
+        LOGGER.info('Reusing stored displacements field (%s).', cached['out_warp'])
+        warp_node = pe.Node(niu.IdentityInterface(fields=['out_warp']), name='cached_warp')
+        warp_node.inputs.out_warp = cached['out_warp']
+        warp_field = 'out_warp'
+    else:
+        prepare_epi_wf = init_prepare_epi_wf(omp_nthreads=omp_nthreads,
+                                             matched_pe=matched_pe,
+                                             template_method=template_method,
+                                             in_shape=in_shape,
+                                             name="prepare_epi_wf")
+        warp_node, warp_field = _connect_estimator(
+            workflow, estimator, omp_nthreads,
+            epis=(prepare_epi_wf, 'outputnode.opposed_pe', 'outputnode.matched_pe'),
+            pe_dir=(inputnode, 'bold_pe_dir'), hdr_file=(inputnode, 'in_reference'),
+            in_shape=in_shape)
+        workflow.connect([
+            (inputnode, prepare_epi_wf, [
+                ('fmaps_epi', 'inputnode.maps_pe'),
+                ('bold_pe_dir', 'inputnode.epi_pe'),
+                ('in_reference_brain', 'inputnode.ref_brain')]),
+        ])
+
     workflow.connect([
-        (inputnode, qwarp, [(('bold_pe_dir', _qwarp_args), 'args')]),
-        (inputnode, cphdr_warp, [('in_reference', 'hdr_file')]),
-        (inputnode, prepare_epi_wf, [
-            ('fmaps_epi', 'inputnode.maps_pe'),
-            ('bold_pe_dir', 'inputnode.epi_pe'),
-            ('in_reference_brain', 'inputnode.ref_brain')]),
-        (prepare_epi_wf, qwarp, [('outputnode.opposed_pe', 'base_file'),
-                                 ('outputnode.matched_pe', 'in_file')]),
-        (qwarp, cphdr_warp, [('source_warp', 'in_file')]),
-        (cphdr_warp, to_ants, [('out_file', 'in_file')]),
-        (to_ants, unwarp_reference, [('out', 'transforms')]),
+        (warp_node, unwarp_reference, [(warp_field, 'transforms')]),
         (inputnode, unwarp_reference, [('in_reference', 'reference_image'),
                                        ('in_reference', 'input_image')]),
         (unwarp_reference, enhance_and_skullstrip_bold_wf, [
@@ -156,14 +196,176 @@ directions, using `3dQwarp` @afni (AFNI {afni_ver}).
         (enhance_and_skullstrip_bold_wf, outputnode, [
             ('outputnode.mask_file', 'out_mask'),
             ('outputnode.skull_stripped_file', 'out_reference_brain')]),
-        (to_ants, outputnode, [('out', 'out_warp')]),
     ])
 
+    if fmap_cache is not None and cached is None:
+        store_fmap = pe.Node(StoreFieldmap(cache=fmap_cache, estimator='pepolar_unwarp'),
+                             name='store_fmap', run_without_submitting=True)
+        workflow.connect([
+            (warp_node, store_fmap, [(warp_field, 'out_warp')]),
+        ])
+        if cache_inputs is not None:
+            store_fmap.inputs.in_files = in_files
+            store_fmap.inputs.metadata = metadata
+            store_fmap.inputs.params = params
+        else:
+            store_inputs = pe.Node(niu.Merge(2, ravel_inputs=True), name='store_inputs',
+                                   run_without_submitting=True)
+            workflow.connect([
+                (inputnode, store_inputs, [(('fmaps_epi', _epi_paths), 'in1'),
+                                           ('in_reference_brain', 'in2')]),
+                (inputnode, store_fmap, [(('bold_pe_dir', _pe_params), 'params')]),
+                (store_inputs, store_fmap, [('out', 'in_files')]),
+            ])
+
+    if compact_warp:
+        compress_warp = pe.Node(CompactWarp(), name='compress_warp', mem_gb=0.01)
+        workflow.connect([
+            (inputnode, compress_warp, [('bold_pe_dir', 'pe_dir')]),
+            (warp_node, compress_warp, [(warp_field, 'in_file')]),
+            (compress_warp, outputnode, [('out_file', 'out_warp')]),
+        ])
+    else:
+        workflow.connect([
+            (warp_node, outputnode, [(warp_field, 'out_warp')]),
+        ])
+
+    return workflow
+
+
+def init_pepolar_estimate_wf(omp_nthreads=1, fmap_cache=None, template_method='freesurfer',
+                             estimator='qwarp', in_shape=None, name="pepolar_estimate_wf"):
+    """
+    Estimate a fieldmap from EPI images with opposed PE blips, in their native space.
+
+    Unlike :func:`init_pepolar_unwarp_wf`, the target EPI run does not take part in
+    the estimation, which requires ``fmaps_epi`` to contain images with both the
+    matched and the opposed PE blips of ``epi_pe_dir``.
+    The estimated displacements field is converted into a fieldmap
+    in Hz, so that it can be mapped onto any number of EPI runs with
+    :func:`~sdcflows.workflows.unwarp.init_sdc_unwarp_wf` (estimate once,
+    apply many).
+
+    .. workflow ::
+        :graph2use: orig
+        :simple_form: yes
+
+        from sdcflows.workflows.pepolar import init_pepolar_estimate_wf
+        wf = init_pepolar_estimate_wf()
+
+
+    **Parameters**:
+
+        estimator : str
+            Estimate displacements with AFNI's 3dQwarp (``'qwarp'``) or with
+            :class:`~sdcflows.interfaces.epi.PEPolarWarp` (``'native'``).
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) where the results of the estimation
+            are saved, for later invocations to reuse them (see
+            :func:`~sdcflows.utils.cache.lookup_fieldmap`).
+        name : str
+            Name for this workflow
+        omp_nthreads : int
+            Parallelize internal tasks across the number of CPUs given by this option.
+        in_shape : tuple
+            Shape of the (3D or 4D) EPI fieldmaps, to estimate the resources of nodes
+            (see :func:`~sdcflows.utils.resources.node_resources`).
+        template_method : str
+            How the EPI images are averaged into references: ``'freesurfer'``
+            (``mri_robust_template``) or ``'native'``
+            (:class:`~sdcflows.interfaces.epi.RobustTemplate`).
+
+    **Inputs**:
+
+        fmaps_epi : list of tuple(pathlike, str)
+            The list of EPI images that will be used in PE-Polar correction, and
+            their corresponding ``PhaseEncodingDirection`` metadata.
+        epi_pe_dir : str
+            The PE direction of the images with matched PE blips (which define the
+            space of the outputs).
+        metadata : dict
+            Metadata of the images with matched PE blips (the readout time is
+            necessary to convert displacements into Hz).
+
+    **Outputs**:
+
+        fmap : pathlike
+            The estimated fieldmap in Hz.
+        fmap_ref : pathlike
+            The (distorted) average of the images with matched PE blips, which
+            is used to map the fieldmap onto EPI runs with the same PE.
+        fmap_mask : pathlike
+            A brain mask corresponding to ``fmap_ref``.
+
+    """
+    workflow = Workflow(name=name)
+    workflow.__desc__ = """\
+A fieldmap was estimated based on two echo-planar imaging (EPI) references
+with opposing phase-encoding directions, using {tool}.
+""".format(tool=_estimator_desc(estimator))
+
+    inputnode = pe.Node(niu.IdentityInterface(
+        fields=['fmaps_epi', 'epi_pe_dir', 'metadata']), name='inputnode')
+
+    outputnode = pe.Node(niu.IdentityInterface(
+        fields=['fmap', 'fmap_ref', 'fmap_mask']), name='outputnode')
+
+    # The average of matched-PE EPIs defines the space of estimation, and the
+    # opposed-PE EPIs are aligned to it (i.e., it replaces the target EPI)
+    prepare_epi_wf = init_prepare_epi_wf(omp_nthreads=omp_nthreads, matched_pe=False,
+                                         template_method=template_method,
+                                         in_shape=in_shape, name="prepare_epi_wf")
+
+    split = pe.Node(niu.Function(function=_split_epi_lists), name='split',
+                    **node_resources('series', in_shape, omp_nthreads))
+    split.inputs.compress = False
+    split.inputs.merge = template_method == 'native'
+    merge_ref = _epi_template_node(template_method, omp_nthreads, name='merge_ref',
+                                   in_shape=in_shape)
+    ref_wf = init_enhance_and_skullstrip_bold_wf(omp_nthreads=omp_nthreads, name='ref_wf')
+
+    warp_node, warp_field = _connect_estimator(
+        workflow, estimator, omp_nthreads,
+        epis=(prepare_epi_wf, 'outputnode.opposed_pe', 'outputnode.matched_pe'),
+        pe_dir=(inputnode, 'epi_pe_dir'), hdr_file=(ref_wf, 'outputnode.bias_corrected_file'),
+        in_shape=in_shape)
+    warp2field = pe.Node(WarpToField(), name='warp2field', mem_gb=0.01)
+
+    workflow.connect([
+        (inputnode, split, [('fmaps_epi', 'in_files'),
+                            ('epi_pe_dir', 'pe_dir')]),
+        (split, merge_ref, [(('out', _last), 'in_files')]),
+        (merge_ref, ref_wf, [('out_file', 'inputnode.in_file')]),
+        (inputnode, prepare_epi_wf, [
+            ('fmaps_epi', 'inputnode.maps_pe'),
+            ('epi_pe_dir', 'inputnode.epi_pe')]),
+        (ref_wf, prepare_epi_wf, [
+            ('outputnode.skull_stripped_file', 'inputnode.ref_brain')]),
+        (warp_node, warp2field, [(warp_field, 'in_file')]),
+        (inputnode, warp2field, [('metadata', 'metadata'),
+                                 ('epi_pe_dir', 'pe_dir')]),
+        (warp2field, outputnode, [('out_file', 'fmap')]),
+        (ref_wf, outputnode, [('outputnode.bias_corrected_file', 'fmap_ref'),
+                              ('outputnode.mask_file', 'fmap_mask')]),
+    ])
+
+    if fmap_cache is not None:
+        store_fmap = pe.Node(StoreFieldmap(cache=fmap_cache, estimator='pepolar'),
+                             name='store_fmap', run_without_submitting=True)
+        workflow.connect([
+            (inputnode, store_fmap, [(('fmaps_epi', _epi_paths), 'in_files'),
+                                     ('metadata', 'metadata'),
+                                     (('epi_pe_dir', _pe_params), 'params')]),
+            (outputnode, store_fmap, [('fmap', 'fmap'),
+                                      ('fmap_ref', 'fmap_ref'),
+                                      ('fmap_mask', 'fmap_mask')]),
+        ])
+
     return workflow
 
 
-def init_prepare_epi_wf(omp_nthreads, matched_pe=False,
-                        name="prepare_epi_wf"):
+def init_prepare_epi_wf(omp_nthreads, matched_pe=False, template_method='freesurfer',
+                        in_shape=None, name="prepare_epi_wf"):
     """
     Prepare opposed-PE EPI images for PE-POLAR SDC.
 
@@ -172,7 +374,8 @@ def init_prepare_epi_wf(omp_nthreads, matched_pe=False,
     estimation.
 
     The procedure involves: estimating a robust template using FreeSurfer's
-    ``mri_robust_template``, bias field correction using ANTs ``N4BiasFieldCorrection``
+    ``mri_robust_template`` (or :class:`~sdcflows.interfaces.epi.RobustTemplate`),
+    bias field correction using ANTs ``N4BiasFieldCorrection``
     and AFNI ``3dUnifize``, skullstripping using FSL BET and AFNI ``3dAutomask``,
     and rigid coregistration to the reference using ANTs.
 
@@ -194,6 +397,13 @@ def init_prepare_epi_wf(omp_nthreads, matched_pe=False,
             Name for this workflow
         omp_nthreads : int
             Parallelize internal tasks across the number of CPUs given by this option.
+        in_shape : tuple
+            Shape of the (3D or 4D) EPI fieldmaps, to estimate the resources of nodes
+            (see :func:`~sdcflows.utils.resources.node_resources`).
+        template_method : str
+            How the EPI images are averaged into references: ``'freesurfer'``
+            (``mri_robust_template``) or ``'native'``
+            (:class:`~sdcflows.interfaces.epi.RobustTemplate`).
 
     **Inputs**:
 
@@ -219,28 +429,22 @@ def init_prepare_epi_wf(omp_nthreads, matched_pe=False,
     outputnode = pe.Node(niu.IdentityInterface(fields=['opposed_pe', 'matched_pe']),
                          name='outputnode')
 
-    ants_settings = pkgr.resource_filename('sdcflows',
-                                           'data/translation_rigid.json')
+    ants_settings = data_path('translation_rigid.json')
 
-    split = pe.Node(niu.Function(function=_split_epi_lists), name='split')
+    split = pe.Node(niu.Function(function=_split_epi_lists), name='split',
+                    **node_resources('series', in_shape, omp_nthreads))
+    split.inputs.compress = False
+    split.inputs.merge = template_method == 'native'
 
-    merge_op = pe.Node(
-        StructuralReference(auto_detect_sensitivity=True,
-                            initial_timepoint=1,
-                            fixed_timepoint=True,  # Align to first image
-                            intensity_scaling=True,
-                            # 7-DOF (rigid + intensity)
-                            no_iteration=True,
-                            subsample_threshold=200,
-                            out_file='template.nii.gz'),
-        name='merge_op')
+    merge_op = _epi_template_node(template_method, omp_nthreads, name='merge_op',
+                                  in_shape=in_shape)
 
     ref_op_wf = init_enhance_and_skullstrip_bold_wf(
         omp_nthreads=omp_nthreads, name='ref_op_wf')
 
     op2ref_reg = pe.Node(ants.Registration(
         from_file=ants_settings, output_warped_image=True),
-        name='op2ref_reg', n_procs=omp_nthreads)
+        name='op2ref_reg', **node_resources('registration', in_shape, omp_nthreads))
 
     workflow = Workflow(name=name)
     workflow.connect([
@@ -260,23 +464,15 @@ def init_prepare_epi_wf(omp_nthreads, matched_pe=False,
         ])
         return workflow
 
-    merge_ma = pe.Node(
-        StructuralReference(auto_detect_sensitivity=True,
-                            initial_timepoint=1,
-                            fixed_timepoint=True,  # Align to first image
-                            intensity_scaling=True,
-                            # 7-DOF (rigid + intensity)
-                            no_iteration=True,
-                            subsample_threshold=200,
-                            out_file='template.nii.gz'),
-        name='merge_ma')
+    merge_ma = _epi_template_node(template_method, omp_nthreads, name='merge_ma',
+                                  in_shape=in_shape)
 
     ref_ma_wf = init_enhance_and_skullstrip_bold_wf(
         omp_nthreads=omp_nthreads, name='ref_ma_wf')
 
     ma2ref_reg = pe.Node(ants.Registration(
         from_file=ants_settings, output_warped_image=True),
-        name='ma2ref_reg', n_procs=omp_nthreads)
+        name='ma2ref_reg', **node_resources('registration', in_shape, omp_nthreads))
 
     workflow.connect([
         (split, merge_ma, [(('out', _last), 'in_files')]),
@@ -301,15 +497,90 @@ def _last(inlist):
     return inlist
 
 
+def _epi_template_node(template_method, omp_nthreads, name, in_shape=None):
+    """Create a node that averages EPI images into a robust template."""
+    resources = node_resources('template', in_shape, omp_nthreads)
+    if template_method == 'native':
+        return pe.Node(RobustTemplate(), name=name, **resources)
+    if template_method == 'freesurfer':
+        return pe.Node(
+            StructuralReference(auto_detect_sensitivity=True,
+                                initial_timepoint=1,
+                                fixed_timepoint=True,  # Align to first image
+                                intensity_scaling=True,
+                                # 7-DOF (rigid + intensity)
+                                no_iteration=True,
+                                subsample_threshold=200,
+                                out_file='template.nii.gz'),
+            name=name, mem_gb=resources['mem_gb'])
+    raise ValueError('Unknown template method "%s".' % template_method)
+
+
+def _epi_paths(in_files):
+    return [epi_path for epi_path, _ in in_files]
+
+
+def _pe_params(pe_dir):
+    return {'pe_dir': pe_dir}
+
+
+def _connect_estimator(workflow, estimator, omp_nthreads, epis, pe_dir, hdr_file,
+                       in_shape=None):
+    """
+    Add the nodes estimating the displacements field from the prepared EPIs.
+
+    ``epis`` is a tuple ``(node, opposed_field, matched_field)``, and ``pe_dir``
+    and ``hdr_file`` are tuples ``(node, field)``.
+    Returns the node and field of the resulting ANTs-compatible displacements field.
+    """
+    if estimator == 'native':
+        estimate = pe.Node(PEPolarWarp(), name='estimate_warp',
+                           **node_resources('bspline', in_shape, omp_nthreads))
+        workflow.connect([
+            (epis[0], estimate, [(epis[1], 'in_opposed'),
+                                 (epis[2], 'in_matched')]),
+            (pe_dir[0], estimate, [(pe_dir[1], 'pe_dir')]),
+        ])
+        return estimate, 'out_warp'
+
+    if estimator != 'qwarp':
+        raise ValueError('Unknown PEPOLAR estimator "%s".' % estimator)
+
+    resources = node_resources('qwarp', in_shape, omp_nthreads)
+    qwarp = pe.Node(afni.QwarpPlusMinus(
+        pblur=[0.05, 0.05], blur=[-1, -1], noweight=True, minpatch=9, nopadWARP=True,
+        environ={'OMP_NUM_THREADS': '%d' % resources['n_procs']}),
+        name='qwarp', **resources)
+    cphdr_warp = pe.Node(CopyHeader(), name='cphdr_warp', mem_gb=0.01)
+    to_ants = pe.Node(niu.Function(function=_fix_hdr), name='to_ants',
+                      mem_gb=0.01)
+    workflow.connect([
+        (pe_dir[0], qwarp, [((pe_dir[1], _qwarp_args), 'args')]),
+        (epis[0], qwarp, [(epis[1], 'base_file'),
+                          (epis[2], 'in_file')]),
+        (hdr_file[0], cphdr_warp, [(hdr_file[1], 'hdr_file')]),
+        (qwarp, cphdr_warp, [('source_warp', 'in_file')]),
+        (cphdr_warp, to_ants, [('out_file', 'in_file')]),
+    ])
+    return to_ants, 'out'
+
+
+def _estimator_desc(estimator):
+    """Describe the PEPOLAR estimator for the boilerplate."""
+    if estimator == 'native':
+        return 'a B-Spline model of displacements along the phase-encoding axis'
+    return '`3dQwarp` @afni (AFNI {afni_ver})'.format(afni_ver=tool_version('afni') or '')
+
+
 def _fix_hdr(in_file, newpath=None):
     import nibabel as nb
-    from nipype.utils.filemanip import fname_presuffix
+    from sdcflows.utils.nifti import intermediate_fname
 
     nii = nb.load(in_file)
     hdr = nii.header.copy()
     hdr.set_data_dtype('<f4')
     hdr.set_intent('vector', (), '')
-    out_file = fname_presuffix(in_file, "_warpfield", newpath=newpath)
+    out_file = intermediate_fname(in_file, "_warpfield", newpath=newpath)
     nb.Nifti1Image(nii.get_data().astype('<f4'), nii.affine, hdr).to_filename(
         out_file)
     return out_file
@@ -340,10 +611,14 @@ def _qwarp_args(pe_dir):
             'k': '-noXdis -noYdis'}[pe_dir[0]]
 
 
-def _split_epi_lists(in_files, pe_dir, max_trs=50):
+def _split_epi_lists(in_files, pe_dir, max_trs=50, compress=None, merge=False,
+                     num_threads=1):
     """
     Split input EPIs and generate an output list of PEs.
 
+    Only the first ``max_trs`` volumes of each image are read (through the image
+    proxy), and the outputs are written in parallel.
+
     **Inputs**:
 
         in_files : list of ``BIDSFile``s
@@ -353,27 +628,72 @@ def _split_epi_lists(in_files, pe_dir, max_trs=50):
         max_trs : int
             Index of frame after which all volumes will be discarded
             from the input EPI images.
+        compress : bool
+            Write out gzip-compressed files (``.nii.gz``) instead of ``.nii``
+            (by default, as set by :func:`~sdcflows.utils.nifti.set_compress_intermediates`).
+        merge : bool
+            Write out one single 4D file per PE direction (instead of one file
+            per volume).
+        num_threads : int
+            Number of files written in parallel.
 
     """
     from os import path as op
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
     import nibabel as nb
+    from sdcflows.utils.nifti import compress_intermediates
 
-    matched_pe = []
-    opposed_pe = []
+    if compress is None:
+        compress = compress_intermediates()
+    ext = '.nii.gz' if compress else '.nii'
+    groups = {'matched': [], 'opposed': []}
 
     for i, (epi_path, epi_pe) in enumerate(in_files):
-        if epi_pe[0] == pe_dir[0]:
-            splitnii = nb.four_to_three(nb.load(epi_path))[:max_trs]
-
-            for j, nii in enumerate(splitnii):
-                out_name = op.abspath(
-                    'dir-%s_tstep-%03d_pe-%03d.nii.gz' % (epi_pe, i, j))
-                nii.to_filename(out_name)
-
-                if epi_pe == pe_dir:
-                    matched_pe.append(out_name)
-                else:
-                    opposed_pe.append(out_name)
+        if epi_pe[0] != pe_dir[0]:
+            continue
+
+        img = nb.load(epi_path)
+        if len(img.shape) > 3:
+            data = np.asanyarray(img.dataobj[..., :max_trs])
+        else:
+            data = np.asanyarray(img.dataobj)[..., np.newaxis]
+
+        hdr = img.header.copy()
+        if data.dtype != hdr.get_data_dtype():  # Scaled data
+            data = data.astype('<f4')
+            hdr.set_data_dtype('<f4')
+            hdr.set_slope_inter(1.0, 0.0)
+
+        groups['matched' if epi_pe == pe_dir else 'opposed'].append(
+            (epi_pe, i, data, img.affine, hdr))
+
+    jobs = {'matched': [], 'opposed': []}
+    for key, images in groups.items():
+        if merge and images:
+            epi_pe, _, _, affine, hdr = images[0]
+            jobs[key].append((
+                op.abspath('dir-%s_%s%s' % (epi_pe, key, ext)),
+                np.concatenate([data for _, _, data, _, _ in images], axis=-1),
+                affine, hdr))
+            continue
+
+        for epi_pe, i, data, affine, hdr in images:
+            for j in range(data.shape[-1]):
+                jobs[key].append((
+                    op.abspath('dir-%s_tstep-%03d_pe-%03d%s' % (epi_pe, i, j, ext)),
+                    data[..., j], affine, hdr))
+
+    def _write(job):
+        out_name, data, affine, hdr = job
+        hdr = hdr.copy()
+        hdr.set_data_shape(data.shape)
+        nb.Nifti1Image(data, affine, hdr).to_filename(out_name)
+        return out_name
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+        opposed_pe = list(pool.map(_write, jobs['opposed']))
+        matched_pe = list(pool.map(_write, jobs['matched']))
 
     if matched_pe:
         return [opposed_pe, matched_pe]
@@ -18,6 +18,7 @@ Fieldmap preprocessing workflow for fieldmap data structure
 
 """
 
+from nipype import logging
 from nipype.interfaces import ants, fsl, utility as niu
 from nipype.pipeline import engine as pe
 from nipype.workflows.dmri.fsl.utils import siemens2rads, demean_image, \
@@ -26,10 +27,16 @@ from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 from niworkflows.interfaces.images import IntraModalMerge
 from niworkflows.interfaces.masks import BETRPT
 
-from ..interfaces.fmap import Phasediff2Fieldmap
+from ..interfaces.cache import StoreFieldmap
+from ..interfaces.fmap import Phasediff2Fieldmap, PhaseUnwrap, ProcessPhasediff
+from ..utils.cache import lookup_fieldmap, split_cache_inputs
+from ..utils.resources import node_resources
 
+LOGGER = logging.getLogger('nipype.workflow')
 
-def init_phdiff_wf(omp_nthreads, name='phdiff_wf'):
+
+def init_phdiff_wf(omp_nthreads, unwrap_method=None, fused=False, fmap_cache=None,
+                   cache_inputs=None, in_shape=None, name='phdiff_wf'):
     """
     Distortion correction of EPI sequences using phase-difference maps.
 
@@ -49,6 +56,27 @@ def init_phdiff_wf(omp_nthreads, name='phdiff_wf'):
 
         omp_nthreads : int
             Maximum number of threads an individual process may use
+        unwrap_method : str
+            Phase unwrapping engine: FSL PRELUDE (``'prelude'``, the default) or the
+            in-process Laplacian unwrapper (``'laplacian'``).
+        fused : bool
+            Run the whole phase-difference to Hz conversion (rescaling, unwrapping,
+            median filtering, demeaning, edge cleanup and scaling) in one single node,
+            on one in-memory array.
+            The fused node always uses the in-process Laplacian unwrapper, and
+            therefore cannot be combined with other ``unwrap_method``.
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) where the results of the estimation
+            are saved, for later invocations to reuse them (see
+            :func:`~sdcflows.utils.cache.lookup_fieldmap`).
+        cache_inputs : dict
+            The inputs identifying the estimation in ``fmap_cache``, known when
+            building the workflow (e.g., the ``phasediff`` and ``magnitude`` files
+            and the ``metadata``, see :func:`~sdcflows.utils.cache.split_cache_inputs`).
+            When the estimation is found, the workflow just forwards the stored files.
+        in_shape : tuple
+            Shape of the phase-difference map, to estimate the resources of the nodes
+            (see :func:`~sdcflows.utils.resources.node_resources`).
 
     **Inputs**:
 
@@ -69,7 +97,32 @@ def init_phdiff_wf(omp_nthreads, name='phdiff_wf'):
             The estimated fieldmap in Hz
 
     """
+    if fused and unwrap_method not in (None, 'laplacian'):
+        raise ValueError('The fused phase-difference conversion only supports the '
+                         '"laplacian" unwrapping method (got "%s").' % unwrap_method)
+    if unwrap_method is None:
+        unwrap_method = 'laplacian' if fused else 'prelude'
+
+    params = {'unwrap_method': unwrap_method, 'fused': fused}
+
     workflow = Workflow(name=name)
+    inputnode = pe.Node(niu.IdentityInterface(fields=['magnitude', 'phasediff', 'metadata']),
+                        name='inputnode')
+
+    outputnode = pe.Node(niu.IdentityInterface(
+        fields=['fmap', 'fmap_ref', 'fmap_mask']), name='outputnode')
+
+    if fmap_cache is not None and cache_inputs is not None:
+        in_files, metadata, extra = split_cache_inputs(cache_inputs)
+        params.update(extra)
+        cached = lookup_fieldmap(fmap_cache, in_files, metadata, 'phdiff', params)
+        if cached is not None:
+            LOGGER.info('Reusing stored fieldmap estimation (%s).', cached['fmap'])
+            # Keep the inputnode (left unconnected), so that callers can wire it
+            outputnode.inputs.trait_set(**cached)
+            workflow.add_nodes([inputnode, outputnode])
+            return workflow
+
     workflow.__desc__ = """\
 A deformation field to correct for susceptibility distortions was estimated
 based on a field map that was co-registered to the BOLD reference,
@@ -78,39 +131,79 @@ using a custom workflow of *fMRIPrep* derived from D. Greve's `epidewarp.fsl`
 further improvements of HCP Pipelines [@hcppipelines].
 """
 
-    inputnode = pe.Node(niu.IdentityInterface(fields=['magnitude', 'phasediff', 'metadata']),
-                        name='inputnode')
-
-    outputnode = pe.Node(niu.IdentityInterface(
-        fields=['fmap', 'fmap_ref', 'fmap_mask']), name='outputnode')
+    if fmap_cache is not None:
+        store_fmap = pe.Node(StoreFieldmap(cache=fmap_cache, estimator='phdiff',
+                                           params=params),
+                             name='store_fmap', run_without_submitting=True)
+        workflow.connect([
+            (outputnode, store_fmap, [('fmap', 'fmap'),
+                                      ('fmap_ref', 'fmap_ref'),
+                                      ('fmap_mask', 'fmap_mask')]),
+        ])
+        if cache_inputs is not None:
+            store_fmap.inputs.in_files = in_files
+            store_fmap.inputs.metadata = metadata
+        else:
+            store_inputs = pe.Node(niu.Merge(2, ravel_inputs=True), name='store_inputs',
+                                   run_without_submitting=True)
+            workflow.connect([
+                (inputnode, store_inputs, [('magnitude', 'in1'),
+                                           ('phasediff', 'in2')]),
+                (inputnode, store_fmap, [('metadata', 'metadata')]),
+                (store_inputs, store_fmap, [('out', 'in_files')]),
+            ])
 
     # Merge input magnitude images
-    magmrg = pe.Node(IntraModalMerge(), name='magmrg')
+    magmrg = pe.Node(IntraModalMerge(), name='magmrg',
+                     **node_resources('series', in_shape))
 
     # de-gradient the fields ("bias/illumination artifact")
     n4 = pe.Node(ants.N4BiasFieldCorrection(dimension=3, copy_header=True),
-                 name='n4', n_procs=omp_nthreads)
+                 name='n4', **node_resources('n4', in_shape, omp_nthreads))
     bet = pe.Node(BETRPT(generate_report=True, frac=0.6, mask=True),
-                  name='bet')
+                  name='bet', **node_resources('filter', in_shape))
+
+    workflow.connect([
+        (inputnode, magmrg, [('magnitude', 'in_files')]),
+        (magmrg, n4, [('out_avg', 'input_image')]),
+        (n4, bet, [('output_image', 'in_file')]),
+        (bet, outputnode, [('mask_file', 'fmap_mask'),
+                           ('out_file', 'fmap_ref')]),
+    ])
+
+    if fused:
+        phdiff2fmap = pe.Node(ProcessPhasediff(), name='phdiff2fmap',
+                              **node_resources('unwrap', in_shape, omp_nthreads))
+        workflow.connect([
+            (inputnode, phdiff2fmap, [('phasediff', 'in_file'),
+                                      ('metadata', 'metadata')]),
+            (bet, phdiff2fmap, [('mask_file', 'in_mask')]),
+            (phdiff2fmap, outputnode, [('out_file', 'fmap')]),
+        ])
+        return workflow
 
     # uses mask from bet; outputs a mask
     # dilate = pe.Node(fsl.maths.MathsCommand(
     #     nan2zeros=True, args='-kernel sphere 5 -dilM'), name='MskDilate')
 
     # phase diff -> radians
-    pha2rads = pe.Node(niu.Function(function=siemens2rads), name='pha2rads')
+    pha2rads = pe.Node(niu.Function(function=siemens2rads), name='pha2rads',
+                       **node_resources('image', in_shape))
 
-    # FSL PRELUDE will perform phase-unwrapping
-    prelude = pe.Node(fsl.PRELUDE(), name='prelude')
+    # FSL PRELUDE (or the in-process unwrapper) will perform phase-unwrapping
+    unwrap = _unwrap_node(unwrap_method, omp_nthreads, in_shape)
 
     denoise = pe.Node(fsl.SpatialFilter(operation='median', kernel_shape='sphere',
-                                        kernel_size=3), name='denoise')
+                                        kernel_size=3), name='denoise',
+                      **node_resources('filter', in_shape))
 
-    demean = pe.Node(niu.Function(function=demean_image), name='demean')
+    demean = pe.Node(niu.Function(function=demean_image), name='demean',
+                     **node_resources('image', in_shape))
 
     cleanup_wf = cleanup_edge_pipeline(name="cleanup_wf")
 
-    compfmap = pe.Node(Phasediff2Fieldmap(), name='compfmap')
+    compfmap = pe.Node(Phasediff2Fieldmap(), name='compfmap',
+                       **node_resources('image', in_shape))
 
     # The phdiff2fmap interface is equivalent to:
     # rad2rsec (using rads2radsec from nipype.workflows.dmri.fsl.utils)
@@ -119,21 +212,28 @@ further improvements of HCP Pipelines [@hcppipelines].
 
     workflow.connect([
         (inputnode, compfmap, [('metadata', 'metadata')]),
-        (inputnode, magmrg, [('magnitude', 'in_files')]),
-        (magmrg, n4, [('out_avg', 'input_image')]),
-        (n4, prelude, [('output_image', 'magnitude_file')]),
-        (n4, bet, [('output_image', 'in_file')]),
-        (bet, prelude, [('mask_file', 'mask_file')]),
+        (bet, unwrap, [('mask_file', 'mask_file')]),
         (inputnode, pha2rads, [('phasediff', 'in_file')]),
-        (pha2rads, prelude, [('out', 'phase_file')]),
-        (prelude, denoise, [('unwrapped_phase_file', 'in_file')]),
+        (pha2rads, unwrap, [('out', 'phase_file')]),
+        (unwrap, denoise, [('unwrapped_phase_file', 'in_file')]),
         (denoise, demean, [('out_file', 'in_file')]),
         (demean, cleanup_wf, [('out', 'inputnode.in_file')]),
         (bet, cleanup_wf, [('mask_file', 'inputnode.in_mask')]),
         (cleanup_wf, compfmap, [('outputnode.out_file', 'in_file')]),
         (compfmap, outputnode, [('out_file', 'fmap')]),
-        (bet, outputnode, [('mask_file', 'fmap_mask'),
-                           ('out_file', 'fmap_ref')]),
     ])
 
+    if unwrap_method == 'prelude':
+        workflow.connect([(n4, unwrap, [('output_image', 'magnitude_file')])])
+
     return workflow
+
+
+def _unwrap_node(unwrap_method, omp_nthreads, in_shape=None):
+    """Create the phase-unwrapping node corresponding to ``unwrap_method``."""
+    resources = node_resources('unwrap', in_shape, omp_nthreads)
+    if unwrap_method == 'prelude':
+        return pe.Node(fsl.PRELUDE(), name='prelude', mem_gb=resources['mem_gb'])
+    if unwrap_method == 'laplacian':
+        return pe.Node(PhaseUnwrap(), name='unwrap', **resources)
+    raise ValueError('Unknown phase unwrapping method "%s".' % unwrap_method)
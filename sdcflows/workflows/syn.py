@@ -22,8 +22,6 @@ Feedback will be enthusiastically received.
 
 
 """
-import pkg_resources as pkgr
-
 from nipype import logging
 from nipype.pipeline import engine as pe
 from nipype.interfaces import fsl, utility as niu
@@ -34,12 +32,20 @@ from niworkflows.interfaces.fixes import (FixHeaderApplyTransforms as ApplyTrans
                                           FixHeaderRegistration as Registration)
 from niworkflows.func.util import init_skullstrip_bold_wf
 
+from ..data import data_path
+from ..interfaces.cache import StoreFieldmap
+from ..interfaces.unwarp import CompactWarp
+from ..utils.cache import lookup_fieldmap, split_cache_inputs
+from ..utils.resources import node_resources
+from ..utils.versions import tool_version
+
 DEFAULT_MEMORY_MIN_GB = 0.01
 LOGGER = logging.getLogger('nipype.workflow')
 
 
 def init_syn_sdc_wf(omp_nthreads, bold_pe=None,
-                    atlas_threshold=3, name='syn_sdc_wf'):
+                    atlas_threshold=3, compact_warp=False, fmap_cache=None,
+                    cache_inputs=None, in_shape=None, name='syn_sdc_wf'):
     """
     This workflow takes a skull-stripped T1w image and reference BOLD image and
     estimates a susceptibility distortion correction warp, using ANTs symmetric
@@ -64,6 +70,34 @@ def init_syn_sdc_wf(omp_nthreads, bold_pe=None,
             bold_pe='j',
             omp_nthreads=8)
 
+    **Parameters**
+
+        omp_nthreads : int
+            Maximum number of threads an individual process may use
+        bold_pe : str
+            Phase-encoding direction of the BOLD run
+        atlas_threshold : float
+            Minimum displacement (in mm) expected by the fieldmap atlas to
+            allow deformations
+        compact_warp : bool
+            Write ``out_warp`` in the compact format (only the displacements along
+            the PE axis), see :mod:`sdcflows.interfaces.unwarp`
+        fmap_cache : :class:`~sdcflows.utils.cache.FieldmapCache` or str
+            A persistent store (or its path) where the estimated displacements
+            field is saved, for later invocations to reuse it (see
+            :func:`~sdcflows.utils.cache.lookup_fieldmap`)
+        cache_inputs : dict
+            The inputs identifying the estimation in ``fmap_cache``, known when
+            building the workflow (e.g., the BOLD run and the T1w image, see
+            :func:`~sdcflows.utils.cache.split_cache_inputs`).
+            When the displacements field is found, the registration is skipped
+            and the stored field is applied to ``bold_ref``
+        in_shape : tuple
+            Shape of the BOLD reference, to estimate the resources of the nodes
+            working on its grid (see :func:`~sdcflows.utils.resources.node_resources`)
+        name : str
+            Name for this workflow
+
     **Inputs**
 
         bold_ref
@@ -85,7 +119,7 @@ def init_syn_sdc_wf(omp_nthreads, bold_pe=None,
             the ``bold_ref_brain`` image after unwarping
         out_warp
             the corresponding :abbr:`DFM (displacements field map)` compatible with
-            ANTs
+            ANTs (or in compact format, if ``compact_warp`` is set)
         out_mask
             mask of the unwarped input file
 
@@ -95,6 +129,13 @@ def init_syn_sdc_wf(omp_nthreads, bold_pe=None,
         LOGGER.warning('Incorrect phase-encoding direction, assuming PA (posterior-to-anterior).')
         bold_pe = 'j'
 
+    params = {'bold_pe': bold_pe, 'atlas_threshold': atlas_threshold}
+    cached = None
+    if fmap_cache is not None and cache_inputs is not None:
+        in_files, metadata, extra = split_cache_inputs(cache_inputs)
+        params.update(extra)
+        cached = lookup_fieldmap(fmap_cache, in_files, metadata, 'syn', params)
+
     workflow = Workflow(name=name)
     workflow.__desc__ = """\
 A deformation field to correct for susceptibility distortions was estimated
@@ -106,7 +147,7 @@ Registration is performed with `antsRegistration` (ANTs {ants_ver}), and
 the process regularized by constraining deformation to be nonzero only
 along the phase-encoding direction, and modulated with an average fieldmap
 template [@fieldmapless3].
-""".format(ants_ver=Registration().version or '<ver>')
+""".format(ants_ver=tool_version('ants') or '<ver>')
     inputnode = pe.Node(
         niu.IdentityInterface(['bold_ref', 'bold_ref_brain', 'template',
                                't1_brain', 'std2anat_xfm']),
@@ -116,12 +157,77 @@ template [@fieldmapless3].
                                'out_mask', 'out_warp']),
         name='outputnode')
 
+    if cached is not None:
+        LOGGER.info('Reusing stored displacements field (%s).', cached['out_warp'])
+        syn = pe.Node(niu.IdentityInterface(fields=['forward_transforms']),
+                      name='cached_warp')
+        syn.inputs.forward_transforms = [cached['out_warp']]
+    else:
+        syn = _connect_syn(workflow, inputnode, omp_nthreads, bold_pe, atlas_threshold,
+                           in_shape=in_shape)
+
+    unwarp_ref = pe.Node(ApplyTransforms(
+        dimension=3, float=True, interpolation='LanczosWindowedSinc'),
+        name='unwarp_ref', **node_resources('resample', in_shape, omp_nthreads))
+
+    skullstrip_bold_wf = init_skullstrip_bold_wf()
+
+    workflow.connect([
+        (syn, unwarp_ref, [('forward_transforms', 'transforms')]),
+        (inputnode, unwarp_ref, [('bold_ref', 'reference_image'),
+                                 ('bold_ref', 'input_image')]),
+        (unwarp_ref, skullstrip_bold_wf, [
+            ('output_image', 'inputnode.in_file')]),
+        (unwarp_ref, outputnode, [('output_image', 'out_reference')]),
+        (skullstrip_bold_wf, outputnode, [
+            ('outputnode.skull_stripped_file', 'out_reference_brain'),
+            ('outputnode.mask_file', 'out_mask')]),
+    ])
+
+    if fmap_cache is not None and cached is None:
+        store_fmap = pe.Node(StoreFieldmap(cache=fmap_cache, estimator='syn', params=params),
+                             name='store_fmap', run_without_submitting=True)
+        workflow.connect([
+            (syn, store_fmap, [(('forward_transforms', _pop), 'out_warp')]),
+        ])
+        if cache_inputs is not None:
+            store_fmap.inputs.in_files = in_files
+            store_fmap.inputs.metadata = metadata
+        else:
+            store_inputs = pe.Node(niu.Merge(4, ravel_inputs=True), name='store_inputs',
+                                   run_without_submitting=True)
+            workflow.connect([
+                (inputnode, store_inputs, [('bold_ref_brain', 'in1'),
+                                           ('t1_brain', 'in2'),
+                                           ('std2anat_xfm', 'in3'),
+                                           (('template', _prior_path), 'in4')]),
+                (store_inputs, store_fmap, [('out', 'in_files')]),
+            ])
+
+    if compact_warp:
+        compress_warp = pe.Node(CompactWarp(pe_dir=bold_pe), name='compress_warp',
+                                mem_gb=DEFAULT_MEMORY_MIN_GB)
+        workflow.connect([
+            (syn, compress_warp, [(('forward_transforms', _pop), 'in_file')]),
+            (compress_warp, outputnode, [('out_file', 'out_warp')]),
+        ])
+    else:
+        workflow.connect([
+            (syn, outputnode, [('forward_transforms', 'out_warp')]),
+        ])
+
+    return workflow
+
+
+def _connect_syn(workflow, inputnode, omp_nthreads, bold_pe, atlas_threshold,
+                 in_shape=None):
+    """Add the nodes estimating the displacements field, and return the registration node."""
     # Collect predefined data
     # Atlas image and registration affine
-    atlas_img = pkgr.resource_filename('sdcflows', 'data/fmap_atlas.nii.gz')
+    atlas_img = data_path('fmap_atlas.nii.gz')
     # Registration specifications
-    affine_transform = pkgr.resource_filename('sdcflows', 'data/affine.json')
-    syn_transform = pkgr.resource_filename('sdcflows', 'data/susceptibility_syn.json')
+    affine_transform = data_path('affine.json')
+    syn_transform = data_path('susceptibility_syn.json')
 
     invert_t1w = pe.Node(Rescale(invert=True), name='invert_t1w',
                          mem_gb=0.3)
@@ -129,7 +235,7 @@ template [@fieldmapless3].
     ref_2_t1 = pe.Node(Registration(from_file=affine_transform),
                        name='ref_2_t1', n_procs=omp_nthreads)
     t1_2_ref = pe.Node(ApplyTransforms(invert_transform_flags=[True]),
-                       name='t1_2_ref', n_procs=omp_nthreads)
+                       name='t1_2_ref', **node_resources('resample', in_shape, omp_nthreads))
 
     # 1) BOLD -> T1; 2) MNI -> T1; 3) ATLAS -> MNI
     transform_list = pe.Node(niu.Merge(3), name='transform_list',
@@ -140,14 +246,13 @@ template [@fieldmapless3].
     # ATLAS -> MNI -> T1 -> BOLD
     atlas_2_ref = pe.Node(
         ApplyTransforms(invert_transform_flags=[True, False, False]),
-        name='atlas_2_ref', n_procs=omp_nthreads,
-        mem_gb=0.3)
+        name='atlas_2_ref', **node_resources('resample', in_shape, omp_nthreads))
     atlas_2_ref.inputs.input_image = atlas_img
 
     threshold_atlas = pe.Node(
         fsl.maths.MathsCommand(args='-thr {:.8g} -bin'.format(atlas_threshold),
                                output_datatype='char'),
-        name='threshold_atlas', mem_gb=0.3)
+        name='threshold_atlas', **node_resources('filter', in_shape))
 
     fixed_image_masks = pe.Node(niu.Merge(2), name='fixed_image_masks',
                                 mem_gb=DEFAULT_MEMORY_MIN_GB)
@@ -156,13 +261,7 @@ template [@fieldmapless3].
     restrict = [[int(bold_pe[0] == 'i'), int(bold_pe[0] == 'j'), 0]] * 2
     syn = pe.Node(
         Registration(from_file=syn_transform, restrict_deformation=restrict),
-        name='syn', n_procs=omp_nthreads)
-
-    unwarp_ref = pe.Node(ApplyTransforms(
-        dimension=3, float=True, interpolation='LanczosWindowedSinc'),
-        name='unwarp_ref')
-
-    skullstrip_bold_wf = init_skullstrip_bold_wf()
+        name='syn', **node_resources('syn', in_shape, omp_nthreads))
 
     workflow.connect([
         (inputnode, invert_t1w, [('t1_brain', 'in_file'),
@@ -183,23 +282,17 @@ template [@fieldmapless3].
         (inputnode, syn, [('bold_ref_brain', 'moving_image')]),
         (t1_2_ref, syn, [('output_image', 'fixed_image')]),
         (fixed_image_masks, syn, [('out', 'fixed_image_masks')]),
-        (syn, outputnode, [('forward_transforms', 'out_warp')]),
-        (syn, unwarp_ref, [('forward_transforms', 'transforms')]),
-        (inputnode, unwarp_ref, [('bold_ref', 'reference_image'),
-                                 ('bold_ref', 'input_image')]),
-        (unwarp_ref, skullstrip_bold_wf, [
-            ('output_image', 'inputnode.in_file')]),
-        (unwarp_ref, outputnode, [('output_image', 'out_reference')]),
-        (skullstrip_bold_wf, outputnode, [
-            ('outputnode.skull_stripped_file', 'out_reference_brain'),
-            ('outputnode.mask_file', 'out_mask')]),
     ])
+    return syn
 
-    return workflow
+
+def _pop(inlist):
+    if isinstance(inlist, (list, tuple)):
+        return inlist[0]
+    return inlist
 
 
 def _prior_path(template):
     """Selects an appropriate input xform, based on template"""
-    from pkg_resources import resource_filename
-    return resource_filename(
-        'sdcflows', 'data/fmap_atlas_2_{}_affine.mat'.format(template))
+    from sdcflows.data import data_path
+    return data_path('fmap_atlas_2_{}_affine.mat'.format(template))
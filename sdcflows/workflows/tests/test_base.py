@@ -0,0 +1,31 @@
+"""Test the SDC heuristics and the session-level builder."""
+from ...utils.bids import get_fmaps
+from ..base import init_sdc_session_wf, init_sdc_participant_wf, _estimation_key
+
+
+def test_sdc_session_wf(bids_layouts, tmpdir):
+    """Check that shared fieldmaps are estimated only once."""
+    tmpdir.chdir()
+
+    layout = bids_layouts['testdata']
+    bolds = layout.get(suffix='bold', extension=['.nii.gz', '.nii'])
+
+    keys = {_estimation_key(bold, get_fmaps(bold)) for bold in bolds}
+    keys.discard(None)
+
+    wf = init_sdc_session_wf(bolds, omp_nthreads=1)
+    estimators = [name for name in wf.list_node_names()
+                  if name.startswith('sdc_estimate_')]
+    assert len({name.split('.')[0] for name in estimators}) == len(keys)
+
+
+def test_sdc_participant_wf(bids_layouts, tmpdir):
+    """Check that one graph nests one session workflow per subject."""
+    tmpdir.chdir()
+
+    layout = bids_layouts['testdata']
+    bolds = layout.get(suffix='bold', extension=['.nii.gz', '.nii'])
+
+    wf = init_sdc_participant_wf(bolds, str(tmpdir), omp_nthreads=1)
+    subjects = {name.split('.')[0] for name in wf.list_node_names()}
+    assert subjects == {'sdc_sub_%s_wf' % bold.entities['subject'] for bold in bolds}
@@ -0,0 +1,73 @@
+"""Test the reuse of stored estimations by the workflow builders."""
+from pathlib import Path
+import pytest
+from nipype.interfaces import utility as niu
+from nipype.pipeline import engine as pe
+
+from ...utils.cache import FieldmapCache
+from ..fmap import init_fmap_wf
+from ..pepolar import init_pepolar_unwarp_wf
+from ..phdiff import init_phdiff_wf, Workflow
+from ..syn import init_syn_sdc_wf
+
+BUILDERS = {
+    'phdiff': (init_phdiff_wf, {},
+               {'magnitude': ['magnitude1.nii.gz'], 'phasediff': 'phasediff.nii.gz',
+                'metadata': {'EchoTime1': 0.00519, 'EchoTime2': 0.00765}},
+               ('fmap', 'fmap_ref', 'fmap_mask')),
+    'fmap': (init_fmap_wf, {'fmap_bspline': False},
+             {'magnitude': ['magnitude.nii.gz'], 'fieldmap': 'fieldmap.nii.gz'},
+             ('fmap', 'fmap_ref', 'fmap_mask')),
+    'syn': (init_syn_sdc_wf, {'bold_pe': 'j'},
+            {'bold_ref_brain': 'boldref.nii.gz', 't1_brain': 't1w.nii.gz',
+             'std2anat_xfm': 'xfm.h5'},
+            ('out_warp', )),
+    'pepolar': (init_pepolar_unwarp_wf, {},
+                {'fmaps_epi': [('epi.nii.gz', 'j-')], 'in_file': 'boldref.nii.gz',
+                 'bold_pe_dir': 'j'},
+                ('out_warp', )),
+}
+
+
+def _write_inputs(values):
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            _write_inputs(value)
+        elif isinstance(value, str) and '.' in value:
+            Path(value).write_bytes(value.encode())
+
+
+@pytest.mark.parametrize('builder', sorted(BUILDERS))
+def test_builder_hit(tmpdir, builder):
+    """Builders serve stored estimations, and their inputnode can still be connected."""
+    tmpdir.chdir()
+    init_wf, kwargs, cache_inputs, stored = BUILDERS[builder]
+    _write_inputs(cache_inputs.values())
+    cache = str(FieldmapCache('cache', max_size=10000).root)
+
+    # First build: not found, the estimation is stored when it finishes
+    wf = init_wf(omp_nthreads=1, fmap_cache=cache, cache_inputs=cache_inputs, **kwargs)
+    store_fmap = wf.get_node('store_fmap')
+    for name in stored:
+        Path('%s.nii.gz' % name).write_bytes(name.encode())
+        setattr(store_fmap.interface.inputs, name, str(Path('%s.nii.gz' % name).absolute()))
+    results = store_fmap.interface.run().outputs
+
+    # Second build: found, the stored files are served and not stored again
+    wf = init_wf(omp_nthreads=1, fmap_cache=cache, cache_inputs=cache_inputs, **kwargs)
+    assert wf.get_node('store_fmap') is None
+    if builder == 'syn':
+        assert wf.get_node('cached_warp').inputs.forward_transforms == [results.out_warp]
+    elif builder == 'pepolar':
+        assert wf.get_node('cached_warp').inputs.out_warp == results.out_warp
+    else:
+        outputnode = wf.get_node('outputnode')
+        for name in stored:
+            assert getattr(outputnode.inputs, name) == getattr(results, name)
+
+    fields = wf.get_node('inputnode').interface._fields
+    src = pe.Node(niu.IdentityInterface(fields=fields), name='src')
+    parent = Workflow(name='parent')
+    parent.connect([
+        (src, wf, [(field, 'inputnode.%s' % field) for field in fields]),
+    ])
@@ -1,6 +1,7 @@
 """Test pepolar type of fieldmaps."""
 from os import cpu_count, getcwd
 import pytest
+import nibabel as nb
 from niworkflows.interfaces.bids import DerivativesDataSink
 from nipype.pipeline import engine as pe
 
@@ -40,6 +41,19 @@ def test_split_epi_lists(bids_layouts, tmpdir):
     assert len(a) == 3
     assert len(b) == 53
 
+    # Single 4D, uncompressed outputs
+    a, b = _split_epi_lists(
+        in_files=[(im.path, im.get_metadata()['PhaseEncodingDirection'])
+                  for im in epidata + [bold]],
+        pe_dir=bold.get_metadata()['PhaseEncodingDirection'],
+        compress=False, merge=True, num_threads=2,
+    )
+
+    assert len(a) == 1
+    assert a[0].endswith('.nii')
+    assert nb.load(a[0]).shape[-1] == 3
+    assert nb.load(b[0]).shape[-1] == 53
+
 
 def test_prepare_epi_wf0(bids_layouts, tmpdir):
     """Test preparation workflow."""
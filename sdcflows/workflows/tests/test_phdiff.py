@@ -49,3 +49,11 @@ def test_workflow(bids_layouts, tmpdir, output_path, dataset):
         wf.add_nodes([phdiff_wf])
 
     wf.run()
+
+
+def test_fused_unwrap_method():
+    """The fused conversion rejects unwrappers other than the Laplacian."""
+    assert init_phdiff_wf(omp_nthreads=1, fused=True).get_node('phdiff2fmap') is not None
+    init_phdiff_wf(omp_nthreads=1, fused=True, unwrap_method='laplacian')
+    with pytest.raises(ValueError):
+        init_phdiff_wf(omp_nthreads=1, fused=True, unwrap_method='prelude')
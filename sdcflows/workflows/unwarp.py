@@ -17,10 +17,8 @@ Unwarping
 
 """
 
-import pkg_resources as pkgr
-
 from nipype.pipeline import engine as pe
-from nipype.interfaces import ants, fsl, utility as niu
+from nipype.interfaces import fsl, utility as niu
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 from niworkflows.interfaces import itk
 from niworkflows.interfaces.images import DemeanImage, FilledImageLike
@@ -28,10 +26,15 @@ from niworkflows.interfaces.registration import ANTSApplyTransformsRPT, ANTSRegi
 from niworkflows.interfaces.bids import DerivativesDataSink
 from niworkflows.func.util import init_enhance_and_skullstrip_bold_wf
 
-from ..interfaces.fmap import get_ees as _get_ees, FieldToRadS
+from ..data import data_path
+from ..interfaces.fmap import FieldToRadS, FieldToWarp
+from ..interfaces.unwarp import ApplyPEWarp, CompactWarp, ResampleSeries, WarpJacobian
+from ..utils.resources import node_resources
 
 
-def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, name='sdc_unwarp_wf'):
+def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, vsm_method='fugue',
+                       jacobian_modulation=False, compact_warp=False, in_shape=None,
+                       in_file=None, name='sdc_unwarp_wf'):
     """
     Apply the warping given by a displacements fieldmap.
 
@@ -52,6 +55,33 @@ def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, name='sdc_unwarp_wf'):
                                 debug=False)
 
 
+    Parameters
+
+        omp_nthreads : int
+            Maximum number of threads an individual process may use
+        fmap_demean : bool
+            Demean the voxel-shift map within the fieldmap mask
+        debug : bool
+            Run fast (less accurate) registration settings
+        vsm_method : str
+            Generate the displacements field with FSL FUGUE and ANTs (``'fugue'``)
+            or with one single in-process node (``'native'``)
+        jacobian_modulation : bool
+            Modulate the intensities of the unwarped reference with the Jacobian
+            determinant of the displacements field
+        compact_warp : bool
+            Write ``out_warp`` in the compact format (only the displacements along
+            the PE axis), see :mod:`sdcflows.interfaces.unwarp`
+        in_shape : tuple
+            Shape of the reference image, to estimate the resources of nodes
+            (see :func:`~sdcflows.utils.resources.node_resources`)
+        in_file : str
+            Path to the EPI scan described by the ``metadata`` input, whose header
+            resolves the readout parameters missing from the metadata.
+            When not given, the metadata must have them resolved (see
+            :func:`~sdcflows.utils.epimanip.resolve_readout`).
+
+
     Inputs
 
         in_reference
@@ -61,7 +91,9 @@ def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, name='sdc_unwarp_wf'):
         in_mask
             a brain mask corresponding to ``in_reference``
         metadata
-            metadata associated to the ``in_reference`` EPI input
+            metadata associated to the ``in_reference`` EPI input, with the readout
+            parameters resolved (see :func:`~sdcflows.utils.epimanip.resolve_readout`),
+            unless the ``in_file`` parameter is set
         fmap
             the fieldmap in Hz
         fmap_ref
@@ -78,13 +110,16 @@ def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, name='sdc_unwarp_wf'):
             the ``in_reference`` after unwarping and skullstripping
         out_warp
             the corresponding :abbr:`DFM (displacements field map)` compatible with
-            ANTs
+            ANTs (or in compact format, if ``compact_warp`` is set)
         out_jacobian
             the jacobian of the field (for drop-out alleviation)
         out_mask
             mask of the unwarped input file
 
     """
+    if vsm_method not in ('fugue', 'native'):
+        raise ValueError('Unknown VSM generation method "%s".' % vsm_method)
+
     workflow = Workflow(name=name)
     inputnode = pe.Node(niu.IdentityInterface(
         fields=['in_reference', 'in_reference_brain', 'in_mask', 'metadata',
@@ -95,14 +130,13 @@ def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, name='sdc_unwarp_wf'):
 
     # Register the reference of the fieldmap to the reference
     # of the target image (the one that shall be corrected)
-    ants_settings = pkgr.resource_filename('sdcflows', 'data/fmap-any_registration.json')
+    ants_settings = data_path('fmap-any_registration.json')
     if debug:
-        ants_settings = pkgr.resource_filename(
-            'sdcflows', 'data/fmap-any_registration_testing.json')
+        ants_settings = data_path('fmap-any_registration_testing.json')
     fmap2ref_reg = pe.Node(
         ANTSRegistrationRPT(generate_report=True, from_file=ants_settings,
                             output_inverse_warped_image=True, output_warped_image=True),
-        name='fmap2ref_reg', n_procs=omp_nthreads)
+        name='fmap2ref_reg', **node_resources('registration', in_shape, omp_nthreads))
 
     ds_report_reg = pe.Node(DerivativesDataSink(
         desc='magnitude', suffix='bold'), name='ds_report_reg',
@@ -111,43 +145,34 @@ def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, name='sdc_unwarp_wf'):
     # Map the VSM into the EPI space
     fmap2ref_apply = pe.Node(ANTSApplyTransformsRPT(
         generate_report=True, dimension=3, interpolation='BSpline', float=True),
-        name='fmap2ref_apply')
+        name='fmap2ref_apply', **node_resources('resample', in_shape, omp_nthreads))
 
     fmap_mask2ref_apply = pe.Node(ANTSApplyTransformsRPT(
         generate_report=False, dimension=3, interpolation='MultiLabel',
         float=True),
-        name='fmap_mask2ref_apply')
+        name='fmap_mask2ref_apply', **node_resources('resample', in_shape, omp_nthreads))
 
     ds_report_vsm = pe.Node(DerivativesDataSink(
         desc='fieldmap', suffix='bold'), name='ds_report_vsm',
         mem_gb=0.01, run_without_submitting=True)
 
-    # Fieldmap to rads and then to voxels (VSM - voxel shift map)
-    torads = pe.Node(FieldToRadS(fmap_range=0.5), name='torads')
-
-    get_ees = pe.Node(niu.Function(function=_get_ees, output_names=['ees']), name='get_ees')
-
-    gen_vsm = pe.Node(fsl.FUGUE(save_unmasked_shift=True), name='gen_vsm')
-    # Convert the VSM into a DFM (displacements field map)
-    # or: FUGUE shift to ANTS warping.
-    vsm2dfm = pe.Node(itk.FUGUEvsm2ANTSwarp(), name='vsm2dfm')
-    jac_dfm = pe.Node(ants.CreateJacobianDeterminantImage(
-        imageDimension=3, outputImage='jacobian.nii.gz'), name='jac_dfm')
-
     unwarp_reference = pe.Node(ANTSApplyTransformsRPT(dimension=3,
                                                       generate_report=False,
                                                       float=True,
                                                       interpolation='LanczosWindowedSinc'),
-                               name='unwarp_reference')
+                               name='unwarp_reference',
+                               **node_resources('resample', in_shape, omp_nthreads))
 
-    fieldmap_fov_mask = pe.Node(FilledImageLike(dtype='uint8'), name='fieldmap_fov_mask')
+    fieldmap_fov_mask = pe.Node(FilledImageLike(dtype='uint8'), name='fieldmap_fov_mask',
+                                **node_resources('image', in_shape))
 
     fmap_fov2ref_apply = pe.Node(ANTSApplyTransformsRPT(
         generate_report=False, dimension=3, interpolation='NearestNeighbor',
         float=True),
-        name='fmap_fov2ref_apply')
+        name='fmap_fov2ref_apply', **node_resources('resample', in_shape, omp_nthreads))
 
-    apply_fov_mask = pe.Node(fsl.ApplyMask(), name="apply_fov_mask")
+    apply_fov_mask = pe.Node(fsl.ApplyMask(), name="apply_fov_mask",
+                             **node_resources('filter', in_shape))
 
     enhance_and_skullstrip_bold_wf = init_enhance_and_skullstrip_bold_wf(omp_nthreads=omp_nthreads,
                                                                          pre_mask=True)
@@ -165,25 +190,13 @@ def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, name='sdc_unwarp_wf'):
         (fmap2ref_reg, ds_report_reg, [('out_report', 'in_file')]),
         (inputnode, fmap2ref_apply, [('fmap', 'input_image')]),
         (inputnode, fmap_mask2ref_apply, [('fmap_mask', 'input_image')]),
-        (fmap2ref_apply, torads, [('output_image', 'in_file')]),
-        (inputnode, get_ees, [('in_reference', 'in_file'),
-                              ('metadata', 'in_meta')]),
-        (fmap_mask2ref_apply, gen_vsm, [('output_image', 'mask_file')]),
-        (get_ees, gen_vsm, [('ees', 'dwell_time')]),
-        (inputnode, gen_vsm, [(('metadata', _get_pedir_fugue), 'unwarp_direction')]),
-        (inputnode, vsm2dfm, [(('metadata', _get_pedir_bids), 'pe_dir')]),
-        (torads, gen_vsm, [('out_file', 'fmap_in_file')]),
-        (vsm2dfm, unwarp_reference, [('out_file', 'transforms')]),
         (inputnode, unwarp_reference, [('in_reference', 'reference_image')]),
         (inputnode, unwarp_reference, [('in_reference', 'input_image')]),
-        (vsm2dfm, outputnode, [('out_file', 'out_warp')]),
-        (vsm2dfm, jac_dfm, [('out_file', 'deformationField')]),
         (inputnode, fieldmap_fov_mask, [('fmap_ref', 'in_file')]),
         (fieldmap_fov_mask, fmap_fov2ref_apply, [('out_file', 'input_image')]),
         (inputnode, fmap_fov2ref_apply, [('in_reference', 'reference_image')]),
         (fmap2ref_reg, fmap_fov2ref_apply, [('composite_transform', 'transforms')]),
         (fmap_fov2ref_apply, apply_fov_mask, [('output_image', 'mask_file')]),
-        (unwarp_reference, apply_fov_mask, [('output_image', 'in_file')]),
         (apply_fov_mask, enhance_and_skullstrip_bold_wf, [('out_file', 'inputnode.in_file')]),
         (fmap_mask2ref_apply, enhance_and_skullstrip_bold_wf,
             [('output_image', 'inputnode.pre_mask')]),
@@ -191,23 +204,184 @@ def init_sdc_unwarp_wf(omp_nthreads, fmap_demean, debug, name='sdc_unwarp_wf'):
         (enhance_and_skullstrip_bold_wf, outputnode, [
             ('outputnode.mask_file', 'out_mask'),
             ('outputnode.skull_stripped_file', 'out_reference_brain')]),
-        (jac_dfm, outputnode, [('jacobian_image', 'out_jacobian')]),
     ])
 
-    if fmap_demean:
-        # Demean within mask
-        demean = pe.Node(DemeanImage(), name='demean')
+    if vsm_method == 'native':
+        # Fieldmap to VSM and DFM (displacements field map) in one go
+        gen_warp = pe.Node(FieldToWarp(demean=fmap_demean), name='gen_warp',
+                           **node_resources('image', in_shape))
+
+        workflow.connect([
+            (fmap2ref_apply, gen_warp, [('output_image', 'in_file')]),
+            (fmap_mask2ref_apply, gen_warp, [('output_image', 'in_mask')]),
+            (inputnode, gen_warp, [('metadata', 'metadata')]),
+        ])
+        dfm_source = (gen_warp, 'out_warp')
+
+    else:
+        # Fieldmap to rads and then to voxels (VSM - voxel shift map)
+        torads = pe.Node(FieldToRadS(fmap_range=0.5), name='torads',
+                         **node_resources('image', in_shape))
+
+        gen_vsm = pe.Node(fsl.FUGUE(save_unmasked_shift=True), name='gen_vsm',
+                          **node_resources('filter', in_shape))
+        # Convert the VSM into a DFM (displacements field map)
+        # or: FUGUE shift to ANTS warping.
+        vsm2dfm = pe.Node(itk.FUGUEvsm2ANTSwarp(), name='vsm2dfm',
+                          **node_resources('image', in_shape))
+
+        workflow.connect([
+            (fmap2ref_apply, torads, [('output_image', 'in_file')]),
+            (fmap_mask2ref_apply, gen_vsm, [('output_image', 'mask_file')]),
+            (inputnode, gen_vsm, [(('metadata', _get_ees, in_file), 'dwell_time')]),
+            (inputnode, gen_vsm, [(('metadata', _get_pedir_fugue), 'unwarp_direction')]),
+            (inputnode, vsm2dfm, [(('metadata', _get_pedir_bids), 'pe_dir')]),
+            (torads, gen_vsm, [('out_file', 'fmap_in_file')]),
+        ])
+        dfm_source = (vsm2dfm, 'out_file')
+
+        if fmap_demean:
+            # Demean within mask
+            demean = pe.Node(DemeanImage(), name='demean',
+                             **node_resources('image', in_shape))
+
+            workflow.connect([
+                (gen_vsm, demean, [('shift_out_file', 'in_file')]),
+                (fmap_mask2ref_apply, demean, [('output_image', 'in_mask')]),
+                (demean, vsm2dfm, [('out_file', 'in_file')]),
+            ])
+
+        else:
+            workflow.connect([
+                (gen_vsm, vsm2dfm, [('shift_out_file', 'in_file')]),
+            ])
+
+    # The DFM only has a component along the PE axis: calculate the Jacobian analytically
+    jac_dfm = pe.Node(WarpJacobian(), name='jac_dfm', **node_resources('image', in_shape))
 
+    dfm_node, dfm_field = dfm_source
+    workflow.connect([
+        (inputnode, jac_dfm, [(('metadata', _get_pedir_bids), 'pe_dir')]),
+        (dfm_node, jac_dfm, [(dfm_field, 'in_file')]),
+        (dfm_node, unwarp_reference, [(dfm_field, 'transforms')]),
+        (jac_dfm, outputnode, [('out_jacobian', 'out_jacobian')]),
+    ])
+
+    if compact_warp:
+        compress_warp = pe.Node(CompactWarp(), name='compress_warp', mem_gb=0.01)
+        workflow.connect([
+            (inputnode, compress_warp, [(('metadata', _get_pedir_bids), 'pe_dir')]),
+            (dfm_node, compress_warp, [(dfm_field, 'in_file')]),
+            (compress_warp, outputnode, [('out_file', 'out_warp')]),
+        ])
+    else:
         workflow.connect([
-            (gen_vsm, demean, [('shift_out_file', 'in_file')]),
-            (fmap_mask2ref_apply, demean, [('output_image', 'in_mask')]),
-            (demean, vsm2dfm, [('out_file', 'in_file')]),
+            (dfm_node, outputnode, [(dfm_field, 'out_warp')]),
         ])
 
+    if jacobian_modulation:
+        workflow.connect([
+            (unwarp_reference, jac_dfm, [('output_image', 'in_image')]),
+            (jac_dfm, apply_fov_mask, [('out_modulated', 'in_file')]),
+        ])
     else:
         workflow.connect([
-            (gen_vsm, vsm2dfm, [('shift_out_file', 'in_file')]),
+            (unwarp_reference, apply_fov_mask, [('output_image', 'in_file')]),
+        ])
+
+    return workflow
+
+
+def init_sdc_apply_wf(omp_nthreads, interpolation='cubic', jacobian_modulation=False,
+                      compose_hmc=False, in_shape=None, name='sdc_apply_wf'):
+    """
+    Apply the estimated displacements field to a full BOLD or DWI series.
+
+    All the volumes of the series are resampled along the phase-encoding axis
+    within one single process, which streams chunks of volumes through a thread
+    pool (instead of running one ANTs process per volume).
+    When ``compose_hmc`` is set, the head-motion correction transforms of each
+    volume are composed with the displacements field, and every volume is
+    interpolated only once.
+
+    .. workflow ::
+        :graph2use: orig
+        :simple_form: yes
+
+        from sdcflows.workflows.unwarp import init_sdc_apply_wf
+        wf = init_sdc_apply_wf(omp_nthreads=8)
+
+
+    Parameters
+
+        omp_nthreads : int
+            Maximum number of threads an individual process may use
+        interpolation : str
+            Interpolation kernel along the PE axis (``'cubic'``, ``'linear'``,
+            ``'lanczos'`` or ``'nearest'``)
+        jacobian_modulation : bool
+            Modulate the intensities of the unwarped series with the Jacobian
+            determinant of the displacements field
+        compose_hmc : bool
+            Apply the head-motion correction transforms (``hmc_xforms``) and the
+            displacements field within the same interpolation (the ``'lanczos'``
+            interpolation is not available in this mode)
+        in_shape : tuple
+            Shape of the (4D) series, to estimate the resources of nodes
+            (see :func:`~sdcflows.utils.resources.node_resources`)
+        name : str
+            Name for this workflow
+
+
+    Inputs
+
+        in_file
+            the 3D or 4D series to be unwarped (aligned with the reference image
+            of the SDC estimation workflow)
+        in_warp
+            the :abbr:`DFM (displacements field map)` (ANTs or compact format)
+        metadata
+            metadata associated to the ``in_file`` EPI input
+        hmc_xforms
+            list of ITK transforms (one per volume) mapping the reference onto
+            each volume (only used with ``compose_hmc``)
+
+
+    Outputs
+
+        out_file
+            the unwarped (and head-motion corrected, with ``compose_hmc``) series
+
+    """
+    spline_orders = {'nearest': 0, 'linear': 1, 'cubic': 3}
+    if compose_hmc and interpolation not in spline_orders:
+        raise ValueError('Interpolation "%s" is not available when composing '
+                         'head-motion transforms.' % interpolation)
+
+    workflow = Workflow(name=name)
+    inputnode = pe.Node(niu.IdentityInterface(
+        fields=['in_file', 'in_warp', 'metadata', 'hmc_xforms']), name='inputnode')
+    outputnode = pe.Node(niu.IdentityInterface(fields=['out_file']), name='outputnode')
+
+    resources = node_resources('resample_series', in_shape, omp_nthreads)
+    if compose_hmc:
+        apply_warp = pe.Node(ResampleSeries(order=spline_orders[interpolation],
+                                            jacobian=jacobian_modulation),
+                             name='apply_warp', **resources)
+        workflow.connect([
+            (inputnode, apply_warp, [('hmc_xforms', 'in_xfms')]),
         ])
+    else:
+        apply_warp = pe.Node(ApplyPEWarp(interpolation=interpolation,
+                                         jacobian=jacobian_modulation),
+                             name='apply_warp', **resources)
+
+    workflow.connect([
+        (inputnode, apply_warp, [('in_file', 'in_file'),
+                                 ('in_warp', 'in_warp'),
+                                 (('metadata', _get_pedir_bids), 'pe_dir')]),
+        (apply_warp, outputnode, [('out_file', 'out_file')]),
+    ])
 
     return workflow
 
@@ -296,3 +470,8 @@ def _get_pedir_bids(in_dict):
 
 def _get_pedir_fugue(in_dict):
     return in_dict['PhaseEncodingDirection'].replace('i', 'x').replace('j', 'y').replace('k', 'z')
+
+
+def _get_ees(metadata, in_file=None):
+    from sdcflows.interfaces.fmap import get_ees
+    return get_ees(metadata, in_file)